@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 
-from .descaleaamod import DescaleAAMod
\ No newline at end of file
+from .descaleaamod import DescaleAAMod
+from .descaleaamod import clear_memo as DescaleAAMod_clear_memo
\ No newline at end of file
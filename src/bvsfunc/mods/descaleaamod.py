@@ -1,6 +1,7 @@
 import re
 from fractions import Fraction
-from functools import partial
+from functools import lru_cache, partial
+from pathlib import Path
 from typing import Optional, Union
 
 from vsutil import get_w
@@ -9,6 +10,141 @@ import vapoursynth as vs
 
 core = vs.core
 
+# sample type and bit depth of each processing precision
+PRECISIONS = {
+    'int16': (vs.INTEGER, 16),
+    'float': (vs.FLOAT, 32),
+}
+
+
+def _query_format(fmt, sample_type, bits):
+    query = getattr(core, 'query_video_format', None) or core.register_format
+    return query(fmt.color_family, sample_type, bits, fmt.subsampling_w, fmt.subsampling_h)
+
+
+def _match_format(clip, fmt):
+    if clip.format.id == fmt.id:
+        return clip
+    return core.resize.Point(clip, format=fmt.id)
+
+
+def _to_precision(clip, sample_type, bits):
+    return _match_format(clip, _query_format(clip.format, sample_type, bits))
+
+
+# Every backend function returns a clip in the format of its input, so DescaleAAMod's intermediates stay in the
+# working format without converting them back.
+
+# wrappers backend: fvsfunc and nnedi3_resample. fvf.Resize already outputs the bit depth of its input,
+# nnedi3_resample is given it as csp so it converts to the working format itself
+
+@lru_cache(maxsize=None)
+def _import_wrappers():
+    import fvsfunc as fvf
+    from nnedi3_resample import nnedi3_resample
+    return fvf, nnedi3_resample
+
+
+def _wrappers_descale(clip, w, h, kernel, b, c, taps):
+    fvf, _ = _import_wrappers()
+    return fvf.Resize(clip, w, h, kernel=kernel, a1=b, a2=c, taps=taps, invks=True)
+
+
+def _wrappers_upscale(clip, w, h, kernel, b, c, taps):
+    fvf, _ = _import_wrappers()
+    return fvf.Resize(clip, w, h, kernel=kernel, a1=b, a2=c, taps=taps)
+
+
+def _wrappers_sharpen(clip, w, h):
+    _, nnedi3_resample = _import_wrappers()
+    return nnedi3_resample(clip, w, h, csp=clip.format.id, invks=True,invkstaps=2, kernel="bicubic",
+                           a1=0.70, a2=0, nns=4, qual=2, pscrn=4)
+
+
+def _wrappers_rescale(clip, w, h):
+    _, nnedi3_resample = _import_wrappers()
+    return nnedi3_resample(clip, w, h, csp=clip.format.id, invks=True, invkstaps=2, kernel="gauss", a1=30, nns=4, qual=2, pscrn=4 ,chromak_down="gauss",
+                           chromak_down_invks=True, chromak_down_invkstaps=2, chromak_down_taps=1, chromak_down_a1=16)
+
+
+# native backend: core.descale, core.znedi3/core.nnedi3, core.fmtc and core.resize
+
+def _native_descale(clip, w, h, kernel, b, c, taps):
+    kernel = kernel.lower()
+    if kernel == 'bicubic':
+        return core.descale.Debicubic(clip, w, h, b=b, c=c)
+    if kernel == 'lanczos':
+        return core.descale.Delanczos(clip, w, h, taps=taps)
+    if kernel in ('bilinear', 'spline16', 'spline36'):
+        return getattr(core.descale, 'De' + kernel)(clip, w, h)
+    raise ValueError(f"DescaleAAMod: kernel '{kernel}' is not supported by the native backend")
+
+
+def _native_upscale(clip, w, h, kernel, b, c, taps, **kwargs):
+    kernel = kernel.lower()
+    if kernel == 'bicubic':
+        return core.resize.Bicubic(clip, w, h, filter_param_a=b, filter_param_b=c, **kwargs)
+    if kernel == 'lanczos':
+        return core.resize.Lanczos(clip, w, h, filter_param_a=taps, **kwargs)
+    if kernel in ('bilinear', 'spline16', 'spline36'):
+        return getattr(core.resize, kernel.capitalize())(clip, w, h, **kwargs)
+    raise ValueError(f"DescaleAAMod: kernel '{kernel}' is not supported by the native backend")
+
+
+def _nnedi3_double(clip):
+    nnedi3 = core.znedi3.nnedi3 if hasattr(core, 'znedi3') else core.nnedi3.nnedi3
+    clip = nnedi3(clip.std.Transpose(), field=0, dh=True, nns=4, qual=2, pscrn=4)
+    return nnedi3(clip.std.Transpose(), field=0, dh=True, nns=4, qual=2, pscrn=4)
+
+
+# With field=0 and dh=True, nnedi3 copies source row k to row 2k+1 of its output, so doubled pixel j shows
+# the image at j where a centred doubling would show it at j+0.5. _nnedi3_double does this along both axes.
+# fmtc.resample reads its source from sx/sy, in pixels of the doubled clip, so starting half a pixel in
+# puts the image back on its centre whatever the output size.
+_NNEDI3_SHIFT = 0.5
+
+
+def _resample_doubled(doubled, w, h, **kwargs):
+    return core.fmtc.resample(doubled, w, h, sx=_NNEDI3_SHIFT, sy=_NNEDI3_SHIFT, **kwargs)
+
+
+def _native_sharpen(clip, w, h):
+    # the same inverted bicubic nnedi3_resample applies after doubling, called on core.fmtc directly
+    out = _resample_doubled(_nnedi3_double(clip), w, h, kernel="bicubic", a1=0.70, a2=0, invks=True, invkstaps=2)
+    return _match_format(out, clip.format)
+
+
+def _native_rescale(clip, w, h):
+    # every plane is doubled and brought back onto its own grid, so chroma siting does not matter.
+    # The kernels are nnedi3_resample's: inverted gauss a1=30 for luma, chromak_down's a1=16 with 1 tap for chroma.
+    planes = []
+    for index in range(clip.format.num_planes):
+        plane = core.std.ShufflePlanes(clip, planes=index, colorfamily=vs.GRAY)
+        chroma = index > 0 and clip.format.color_family == vs.YUV
+        kernel_args = dict(a1=16, taps=1) if chroma else dict(a1=30)
+        out = _resample_doubled(_nnedi3_double(plane), plane.width, plane.height,
+                                kernel="gauss", invks=True, invkstaps=2, **kernel_args)
+        planes.append(_match_format(out, plane.format))
+    return core.std.ShufflePlanes(planes, planes=[0, 0, 0], colorfamily=clip.format.color_family)
+
+
+BACKENDS = {
+    'wrappers': (_wrappers_descale, _wrappers_upscale, _wrappers_sharpen, _wrappers_rescale),
+    'native': (_native_descale, _native_upscale, _native_sharpen, _native_rescale),
+}
+
+# (src, parameters) -> output. Nodes hash and compare by identity, so src itself is the key: a hit needs the
+# very same node, and holding it keeps a recycled id from ever matching a different one.
+_MEMO = {}
+
+
+def clear_memo() -> None:
+    """
+    Drops every DescaleAAMod output memoized with memoize=True, releasing their nodes and frame caches.
+    """
+    _MEMO.clear()
+
+
 def DescaleAAMod(src: vs.VideoNode,
                  w: Optional[int] = None, h: int = 720, thr: int = 10,
                  kernel: str ='bicubic',
@@ -16,7 +152,12 @@ def DescaleAAMod(src: vs.VideoNode,
                  c: Union[float, Fraction] = Fraction(1, 2),
                  taps: int = 4,
                  expand: int = 3, inflate: int = 3,
-                 showmask: bool = False) -> vs.VideoNode:
+                 showmask: bool = False,
+                 mask_cache: Optional[str] = None,
+                 precision: Optional[str] = None,
+                 backend: str = 'wrappers',
+                 memoize: bool = False,
+                 mask_key: Optional[str] = None) -> vs.VideoNode:
     """
     Mod of DescaleAA to use nnedi3_resample, which produces sharper results than nnedi3 rpow2.
 
@@ -52,12 +193,53 @@ def DescaleAAMod(src: vs.VideoNode,
     :type inflate:      int
     :param showmask:    Return mask created, defaults to False
     :type showmask:     bool
+    :param mask_cache:  Directory to persist the luma and chroma masks in, defaults to None.
+                        The first run writes every rendered mask frame to disk. Once all frames are
+                        stored, later runs with the same source and parameters read the masks back
+                        instead of building the difference and edge masks. Requires numpy.
+                        The source is recognised by 32 frames spread over it, so an edit between them
+                        reuses stale masks unless mask_key is given.
+    :type mask_cache:   str, optional
+    :param precision:   Format all intermediate clips are processed in, 'int16' or 'float', defaults to None.
+                        The source is converted once on input and the result once on output, instead of
+                        letting every resizer pick its own format. None keeps the original behaviour.
+    :type precision:    str, optional
+    :param backend:     'wrappers' builds the clip with fvsfunc and nnedi3_resample, 'native' builds it
+                        directly from core.descale, core.znedi3 (or core.nnedi3), core.fmtc and core.resize,
+                        skipping the wrappers' own format conversions. The native backend works in
+                        float unless told otherwise and does not support 'int16'. Defaults to 'wrappers'.
+    :type backend:      str
+    :param memoize:     Return the same node for repeated calls with the same src node and parameters,
+                        so they share one graph and one frame cache, defaults to False.
+                        Every src[a:b] is a new node and never matches an earlier call, so to filter
+                        several trims of a source, call it once on the untrimmed source and trim the
+                        result, ie. DescaleAAMod(src, memoize=True)[100:500].
+                        Memoized nodes are kept until clear_memo() is called.
+    :type memoize:      bool
+    :param mask_key:    Identifies the source for mask_cache instead of its sampled frames, defaults to None.
+                        Anything that changes whenever the source does, ie. the script's path and
+                        modification time or a version string.
+    :type mask_key:     str, optional
 
     :return:            The filtered video
     :rtype:             VideoNode
     """
-    import fvsfunc as fvf
-    from nnedi3_resample import nnedi3_resample
+    if memoize:
+        key = (src, w, h, thr, kernel, b, c, taps, expand, inflate, showmask, mask_cache, precision, backend,
+               mask_key)
+        if key not in _MEMO:
+            _MEMO[key] = DescaleAAMod(src, w, h, thr, kernel, b, c, taps, expand, inflate, showmask,
+                                      mask_cache, precision, backend, mask_key=mask_key)
+        return _MEMO[key]
+
+    if backend not in BACKENDS:
+        raise ValueError(f"DescaleAAMod: backend must be one of {list(BACKENDS)}, not '{backend}'")
+    descale, upscale, sharpen, rescale = BACKENDS[backend]
+
+    if backend == 'native':
+        if precision == 'int16':
+            raise ValueError("DescaleAAMod: the native backend descales in float, use precision='float' or None")
+        precision = 'float'
 
     if kernel.lower().startswith('de'):
         kernel = kernel[2:]
@@ -68,6 +250,13 @@ def DescaleAAMod(src: vs.VideoNode,
     if w is None:
         w = get_w(h, src.width/src.height)
 
+    in_format = None
+    if precision is not None:
+        if precision not in PRECISIONS:
+            raise ValueError(f"DescaleAAMod: precision must be one of {list(PRECISIONS)}, not '{precision}'")
+        in_format = src.format
+        src = _to_precision(src, *PRECISIONS[precision])
+
     bits = src.format.bits_per_sample
     sample_type = src.format.sample_type
 
@@ -78,49 +267,66 @@ def DescaleAAMod(src: vs.VideoNode,
         maxvalue = 1
         thr /= (235 - 16)
 
+    if mask_cache is not None:
+        from .maskcache import cached_mask, mask_cache_key
+        params = dict(w=w, h=h, thr=thr, kernel=kernel, b=b, c=c, taps=taps, expand=expand, inflate=inflate,
+                      precision=precision, backend=backend)
+        cache_dir = Path(mask_cache) / mask_cache_key(src, params, mask_key)
+    else:
+        cached_mask = None
+
     # Fix lineart
     src_y = core.std.ShufflePlanes(src, planes=0, colorfamily=vs.GRAY)
-    deb = fvf.Resize(src_y, w, h, kernel=kernel, a1=b, a2=c, taps=taps, invks=True)
-    sharp = nnedi3_resample(deb, ow, oh, invks=True,invkstaps=2, kernel="bicubic",
-                            a1=0.70, a2=0, nns=4, qual=2, pscrn=4)
-    edgemask = core.std.Prewitt(sharp, planes=0)
-
-    if kernel == "bicubic" and c >= 0.7:
-        edgemask = core.std.Maximum(edgemask, planes=0)
-    sharp = core.resize.Point(sharp, format=src.format.id)
-
-    # Restore true 1080p
-    deb_upscale = fvf.Resize(deb, ow, oh, kernel=kernel, a1=b, a2=c, taps=taps)
-    diffmask = core.std.Expr([src_y, deb_upscale], 'x y - abs')
-    for _ in range(expand):
-        diffmask = core.std.Maximum(diffmask, planes=0)
-    for _ in range(inflate):
-        diffmask = core.std.Inflate(diffmask, planes=0)
-
-    mask = core.std.Expr([diffmask,edgemask], 'x {thr} >= 0 y ?'.format(thr=thr))
-    mask = mask.std.Inflate().std.Deflate()
+    deb = descale(src_y, w, h, kernel, b, c, taps)
+    sharp = sharpen(deb, ow, oh)
+
+    def _build_mask():
+        edgemask = core.std.Prewitt(sharp, planes=0)
+
+        if kernel == "bicubic" and c >= 0.7:
+            edgemask = core.std.Maximum(edgemask, planes=0)
+
+        # Restore true 1080p
+        deb_upscale = upscale(deb, ow, oh, kernel, b, c, taps)
+        diffmask = core.std.Expr([src_y, deb_upscale], 'x y - abs')
+        for _ in range(expand):
+            diffmask = core.std.Maximum(diffmask, planes=0)
+        for _ in range(inflate):
+            diffmask = core.std.Inflate(diffmask, planes=0)
+
+        mask = core.std.Expr([diffmask,edgemask], 'x {thr} >= 0 y ?'.format(thr=thr))
+        return mask.std.Inflate().std.Deflate()
+
+    mask = _build_mask() if cached_mask is None else cached_mask(cache_dir / 'mask', _build_mask)
+    sharp = _match_format(sharp, src.format)
     out_y = core.std.MaskedMerge(src, sharp, mask, planes=0)
 
 	#scale chroma
-    new_uv = nnedi3_resample(src, ow, oh, invks=True, invkstaps=2, kernel="gauss", a1=30, nns=4, qual=2, pscrn=4 ,chromak_down="gauss",
-                             chromak_down_invks=True, chromak_down_invkstaps=2, chromak_down_taps=1, chromak_down_a1=16)
-    edgemask = core.std.Prewitt(new_uv, planes=0)
-    edgemask_uv = core.std.Invert(edgemask, planes=[0])
-
-    # Restore true 1080p
-    deb_upscale = fvf.Resize(src, ow, oh, kernel=kernel, a1=b, a2=c, taps=taps)
-    diffmask = core.std.Expr([src, deb_upscale], 'x y - abs')
-    for _ in range(expand):
-        diffmask = core.std.Maximum(diffmask, planes=0)
-    for _ in range(inflate):
-        diffmask = core.std.Inflate(diffmask, planes=0)
-
-    mask_uv = core.std.Expr([diffmask,edgemask_uv], 'x {thr} >= 0 y ?'.format(thr=thr))
-    mask_uv = mask_uv.std.Inflate().std.Deflate()
+    new_uv = rescale(src, ow, oh)
+
+    def _build_mask_uv():
+        edgemask = core.std.Prewitt(new_uv, planes=0)
+        edgemask_uv = core.std.Invert(edgemask, planes=[0])
+
+        # Restore true 1080p
+        deb_upscale = upscale(src, ow, oh, kernel, b, c, taps)
+        diffmask = core.std.Expr([src, deb_upscale], 'x y - abs')
+        for _ in range(expand):
+            diffmask = core.std.Maximum(diffmask, planes=0)
+        for _ in range(inflate):
+            diffmask = core.std.Inflate(diffmask, planes=0)
+
+        mask_uv = core.std.Expr([diffmask,edgemask_uv], 'x {thr} >= 0 y ?'.format(thr=thr))
+        return mask_uv.std.Inflate().std.Deflate()
+
+    # only the chroma planes of mask_uv are merged with
+    mask_uv = _build_mask_uv() if cached_mask is None else cached_mask(cache_dir / 'mask_uv', _build_mask_uv, planes=[1, 2])
     out_uv = core.std.MaskedMerge(src, new_uv, mask_uv, planes=[1,2])
 
     out = core.std.ShufflePlanes([out_y, out_uv, out_uv], planes=[0,1,2], colorfamily=vs.YUV)
 
     if showmask:
         out = mask
+    if in_format is not None:
+        out = _to_precision(out, in_format.sample_type, in_format.bits_per_sample)
     return out
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import struct
+import threading
+import zlib
+from pathlib import Path
+from typing import *
+
+import vapoursynth as vs
+
+core = vs.core
+
+# frame, plane, offset into the data file, compressed length
+_INDEX_RECORD = struct.Struct('<IIQI')
+_COMPRESSION_LEVEL = 3
+# frames of the source hashed into a mask cache key, spread evenly from the first to the last
+KEY_SAMPLES = 32
+
+
+def _plane_array(frame, plane, write=False):
+    import numpy as np
+    if hasattr(frame, 'get_read_array'):
+        # API3
+        return np.asarray(frame.get_write_array(plane) if write else frame.get_read_array(plane))
+    return np.asarray(frame[plane])
+
+
+def _key_frames(num_frames, samples):
+    if num_frames <= samples:
+        return list(range(num_frames))
+    return sorted({round(i * (num_frames - 1) / (samples - 1)) for i in range(samples)})
+
+
+def mask_cache_key(src: vs.VideoNode, params: Dict[str, Any], key: Optional[str] = None,
+                   samples: int = KEY_SAMPLES) -> str:
+    """
+    Builds the key masks of a clip are stored under.
+
+    The key covers the clip's format, dimensions, length and framerate, the filter parameters,
+    and either the caller's key or the contents of samples frames spread evenly over the clip.
+    Hashing the frames renders them once when the filter is called. An edit that leaves every
+    sampled frame alone, such as a replaced scene shorter than num_frames / samples, keeps the key
+    and reuses the stale masks; pass a key that changes with the source to rule that out.
+
+    :param src:     Source clip
+    :type src:      VideoNode
+    :param params:  Filter parameters that affect the masks
+    :type params:   dict
+    :param key:     Identifies the source contents instead of sampled frames, defaults to None
+    :type key:      str, optional
+    :param samples: Number of frames hashed when no key is given, defaults to 32
+    :type samples:  int, optional
+
+    :return:        Hex digest
+    :rtype:         str
+    """
+    import numpy as np
+
+    digest = hashlib.sha1()
+    header = {
+        'format': src.format.name,
+        'width': src.width,
+        'height': src.height,
+        'num_frames': src.num_frames,
+        'fps': str(src.fps),
+        'params': {k: str(v) for k, v in sorted(params.items())},
+    }
+    digest.update(json.dumps(header, sort_keys=True).encode())
+    if key is not None:
+        digest.update(b'key' + key.encode())
+        return digest.hexdigest()
+    for n in _key_frames(src.num_frames, samples):
+        frame = src.get_frame(n)
+        for plane in range(src.format.num_planes):
+            digest.update(np.ascontiguousarray(_plane_array(frame, plane)).tobytes())
+    return digest.hexdigest()
+
+
+class MaskStore:
+    """
+    Lossless on-disk store for the frames of a mask clip.
+
+    Every stored plane of every frame is zlib compressed and appended to ``masks.bin``; an append-only
+    ``masks.idx`` of fixed size records maps (frame, plane) to its position. ``meta.json`` holds
+    the clip format and the stored planes, so a complete store can be served without building the
+    clip that made it.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.meta = None
+        self.index = {}
+        self._lock = threading.Lock()
+        self._data = None
+        self._index = None
+
+        meta_file = self.directory / 'meta.json'
+        if meta_file.exists():
+            self.meta = json.loads(meta_file.read_text())
+            self._load_index()
+
+    def _load_index(self):
+        index_file = self.directory / 'masks.idx'
+        if not index_file.exists():
+            return
+        raw = index_file.read_bytes()
+        # a trailing partial record means the writer was interrupted mid-append
+        usable = len(raw) - len(raw) % _INDEX_RECORD.size
+        for frame, plane, offset, length in _INDEX_RECORD.iter_unpack(raw[:usable]):
+            self.index[(frame, plane)] = (offset, length)
+
+    @property
+    def complete(self) -> bool:
+        if self.meta is None or 'planes' not in self.meta:
+            return False
+        return all((n, plane) in self.index for n in range(self.meta['num_frames']) for plane in self.meta['planes'])
+
+    def _open(self, mode):
+        if self._data is None:
+            self._data = open(self.directory / 'masks.bin', mode)
+            if mode != 'rb':
+                self._index = open(self.directory / 'masks.idx', 'ab')
+
+    def record(self, clip: vs.VideoNode, planes: Optional[List[int]] = None) -> vs.VideoNode:
+        """
+        Returns the clip unchanged, writing each frame to the store the first time it is rendered.
+        Only planes are stored, defaulting to all of them.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if planes is None:
+            planes = list(range(clip.format.num_planes))
+        meta = {
+            'format': clip.format.id,
+            'width': clip.width,
+            'height': clip.height,
+            'num_frames': clip.num_frames,
+            'planes': sorted(planes),
+            'fpsnum': clip.fps.numerator,
+            'fpsden': clip.fps.denominator,
+        }
+        if self.meta != meta:
+            # stale or foreign store, start over
+            for name in ('masks.bin', 'masks.idx'):
+                (self.directory / name).unlink(missing_ok=True)
+            self.index = {}
+            (self.directory / 'meta.json').write_text(json.dumps(meta))
+            self.meta = meta
+
+        planes = meta['planes']
+
+        def _write(n, f):
+            # an interrupted run can leave a frame with only some of its planes indexed
+            missing = [plane for plane in planes if (n, plane) not in self.index]
+            if not missing:
+                return f
+            blobs = {plane: zlib.compress(_plane_array(f, plane).tobytes(), _COMPRESSION_LEVEL) for plane in missing}
+            with self._lock:
+                missing = [plane for plane in missing if (n, plane) not in self.index]
+                if not missing:
+                    return f
+                self._open('ab')
+                for plane in missing:
+                    offset = self._data.seek(0, 2)
+                    self._data.write(blobs[plane])
+                    self.index[(n, plane)] = (offset, len(blobs[plane]))
+                self._data.flush()
+                self._index.write(b''.join(_INDEX_RECORD.pack(n, plane, *self.index[(n, plane)])
+                                           for plane in missing))
+                self._index.flush()
+            return f
+
+        return core.std.ModifyFrame(clip, clip, _write)
+
+    def source(self) -> vs.VideoNode:
+        """
+        Returns a clip serving the stored frames. The store must be complete.
+        Planes that were not stored are left black.
+        """
+        import numpy as np
+
+        if not self.complete:
+            raise ValueError(f"MaskStore: {self.directory} is incomplete and cannot be used as a source.")
+        meta = self.meta
+        blank = core.std.BlankClip(width=meta['width'], height=meta['height'], format=meta['format'],
+                                   length=meta['num_frames'], fpsnum=meta['fpsnum'], fpsden=meta['fpsden'])
+        fmt = blank.format
+        dtype = np.float32 if fmt.sample_type == vs.FLOAT else (np.uint8 if fmt.bytes_per_sample == 1 else np.uint16)
+
+        def _read(n, f):
+            fout = f.copy()
+            for plane in meta['planes']:
+                offset, length = self.index[(n, plane)]
+                with self._lock:
+                    self._open('rb')
+                    self._data.seek(offset)
+                    blob = self._data.read(length)
+                dst = _plane_array(fout, plane, write=True)
+                dst[:] = np.frombuffer(zlib.decompress(blob), dtype=dtype).reshape(dst.shape)
+            return fout
+
+        return core.std.ModifyFrame(blank, blank, _read)
+
+
+def cached_mask(directory: Union[str, Path], build: Callable[[], vs.VideoNode],
+                planes: Optional[List[int]] = None) -> vs.VideoNode:
+    """
+    Serves a mask from the store in directory if it is complete, otherwise builds it with
+    build() and records it as it renders. Only planes are stored, defaulting to all of them.
+
+    The store is not checked against the source: directory is the only key, and has to change
+    whenever the source or the mask parameters do, e.g. by naming it with mask_cache_key.
+    That key samples the source's frames, so masks of edits between samples are only rebuilt
+    when the caller gives it a key of its own.
+    """
+    store = MaskStore(directory)
+    if store.complete and (planes is None or store.meta['planes'] == sorted(planes)):
+        return store.source()
+    return store.record(build(), planes)
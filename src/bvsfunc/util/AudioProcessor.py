@@ -2,6 +2,7 @@
 
 import subprocess
 import argparse
+import json
 import os
 import shutil
 # import datetime
@@ -9,6 +10,8 @@ from fractions import Fraction
 from typing import *
 from pathlib import Path,PurePath
 
+from .records import AudioTrack, ExtractPart, SourceInfo, TrimPlan
+
 # This is due to how mediainfo reports framrates. others may need to be added
 FRAMERATE_MAP = {
     '23.976': '24000/1001',
@@ -16,6 +19,9 @@ FRAMERATE_MAP = {
     '25.000': '25/1'
 }
 
+# Seconds of audio kept either side of each trim when only the trimmed ranges are extracted.
+EXTRACT_MARGIN = 1.0
+
 ########################
 #  metadata functions  #
 ########################
@@ -26,50 +32,49 @@ def _get_metainfo(in_file, trims_framerate, frames_total):
     except ModuleNotFoundError:
         raise ModuleNotFoundError("_extract_metainfo: missing dependency'mediainfo'")
     media_info = MediaInfo.parse(in_file)
-    extracted_metainfo = {
-        "framerate": None,
-        "framenum": None,
-        "audio_tracks": []
-    }
+    framerate = None
+    framenum = None
+    duration = None
+    audio_tracks = []
     stream_id = 0
     for track in media_info.tracks:
         if track.track_type == "Video":
             if track.framerate_den is None or track.framerate_num is None:
-                extracted_metainfo["framenum"] = int(track.frame_count) if frames_total is None else frames_total
+                framenum = int(track.frame_count) if frames_total is None else frames_total
                 try:
-                    extracted_metainfo['framerate'] = FRAMERATE_MAP[track.frame_rate] if trims_framerate is None else trims_framerate
+                    framerate = FRAMERATE_MAP[track.frame_rate] if trims_framerate is None else trims_framerate
                 except KeyError:
                     raise KeyError("Your source video is not one of the supported framrates. Either supply a custom framerate with trims_framerate or, if it is a common framerate, submit an issue.")
             else:
                 framerate_num = int(track.framerate_num)
                 framerate_den = int(track.framerate_den)
-                extracted_metainfo['framerate'] = f"{framerate_num}/{framerate_den}" if trims_framerate is None else trims_framerate
-                extracted_metainfo["framenum"] = int(track.frame_count) if frames_total is None else frames_total
-            extracted_metainfo["duration"] = track.duration
+                framerate = f"{framerate_num}/{framerate_den}" if trims_framerate is None else trims_framerate
+                framenum = int(track.frame_count) if frames_total is None else frames_total
+            duration = track.duration
             stream_id += 1
         elif track.track_type == "Audio":
-            audio_track = {"stream_id": stream_id}
             if track.delay_relative_to_video is not None:
-                audio_track["offset_time"] = float(int(track.delay_relative_to_video) / 1000)
+                offset_time = float(int(track.delay_relative_to_video) / 1000)
             else:
-                audio_track["offset_time"] = float(0)
-            audio_track['format'] = track.format
-            extracted_metainfo["audio_tracks"].append(audio_track)
+                offset_time = float(0)
+            bit_depth = int(track.bit_depth) if track.bit_depth is not None else None
+            audio_tracks.append(AudioTrack(stream_id, offset_time, track.format, bit_depth,
+                                           raw_wav=None, raw_parts=(), wav=None, flac=None, aac=None))
             stream_id += 1
         else:
             stream_id += 1
             pass
-    return extracted_metainfo
+    return SourceInfo(framerate, framenum, duration, tuple(audio_tracks))
 
 def _build_extract_data(in_file, out_prefix, trims_framerate, frames_total):
     extracted_metainfo = _get_metainfo(in_file, trims_framerate, frames_total)
-    for audio_track in extracted_metainfo["audio_tracks"]:
-        codecs = ['wav','flac','aac']
-        for ext in codecs:
-            audio_track[ext] = f"{str(out_prefix)}_{audio_track['stream_id']}_cut.{ext}"
-        audio_track['raw_wav'] = f"{str(out_prefix)}_{audio_track['stream_id']}.wav"
+    return _assign_track_files(extracted_metainfo, out_prefix)
 
-    return extracted_metainfo
+def _assign_track_files(extracted_metainfo, out_prefix):
+    def _assign(audio_track):
+        files = {ext: f"{str(out_prefix)}_{audio_track.stream_id}_cut.{ext}" for ext in ['wav','flac','aac']}
+        return audio_track.replace(raw_wav=f"{str(out_prefix)}_{audio_track.stream_id}.wav", **files)
+    return extracted_metainfo.with_tracks(_assign)
 
 ##############################
 #  extract & trim functions  #
@@ -80,48 +85,98 @@ def _create_symlink_for_sane_ripping_fuck_eac3to(in_file):
     dir = file_purepath.parts[-2]
     if dir == "STREAM":
         import tempfile
-        temp = tempfile.gettempdir()
-        file_path = Path(fr"{temp}\{file_purepath.parts[-1]}")
-        # remove existing links in case a previous cut was interrupted. 
-        if (Path.is_symlink(file_path)):
-            file_path.unlink(missing_ok=False)
+        # a directory of its own per extraction, so parallel extractions of one file never share a link
+        temp = tempfile.mkdtemp(prefix="bvsfunc_")
+        file_path = Path(temp) / file_purepath.parts[-1]
         file_path.symlink_to(file_purepath)
         return file_path.absolute() 
     else:
         return Path(in_file).absolute()
 
-def _extract_tracks_as_wav(in_file, meta_info, overwrite, silent):
-    for track in meta_info['audio_tracks']:
-        extract_file = Path(track['raw_wav'])
-        if Path(in_file).suffix != ".wav":
-            if not Path(extract_file).exists() or overwrite:
-                temp_file = _create_symlink_for_sane_ripping_fuck_eac3to(in_file)
-                eac3to_cmds = ["eac3to", f"{temp_file}", "-log=NUL", f"{track['stream_id']}:", f"{extract_file}"]
-                ffmpeg_cmds = ["ffmpeg", "-i", f"{temp_file}", "-map", f"0:{track['stream_id'] - 1}", f"{extract_file}"]
-                subp_args = {}
-                subp_args |= {'args': eac3to_cmds} if track['format'] != "AAC" else {'args': ffmpeg_cmds}
-                subp_args |= {'stdout':subprocess.DEVNULL, 'creationflags':subprocess.CREATE_NO_WINDOW, 'shell':True} if silent else {'shell':True}
-                subprocess.call(**subp_args)
-                if (Path(temp_file).is_symlink()):
-                    Path(temp_file).unlink(missing_ok=False)
-            elif not silent:
-                print(f"AudioProcessor: wav file exists and overwrite not specified.")
-                print(f"AudioProcessor: {extract_file}")
+def _remove_symlink(temp_file):
+    temp_file = Path(temp_file)
+    if (temp_file.is_symlink()):
+        temp_file.unlink(missing_ok=False)
+        temp_file.parent.rmdir()
+
+def _pcm_codec(bit_depth):
+    if bit_depth is None or bit_depth <= 16:
+        return "pcm_s16le"
+    elif bit_depth <= 24:
+        return "pcm_s24le"
+    return "pcm_s32le"
+
+def _get_extract_ranges(plan, offset_time, margin):
+    ranges = []
+    for trim in sorted(_trim_times(trim, plan.framenum, offset_time, plan.spf) for trim in plan.trims):
+        start_time, end_time = max(0.0, trim[0] - margin), trim[1] + margin
+        if ranges and start_time <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end_time)
         else:
-            print(f"AudioProcessor: input is already a wav file. no extraction needed")
-            shutil.copy(Path(in_file),extract_file)
+            ranges.append([start_time, end_time])
+    return [tuple(time_range) for time_range in ranges]
+
+def _build_raw_parts(in_file, meta_info, plan, margin):
+    if Path(in_file).suffix == ".wav":
+        # a wav input is copied whole to raw_wav, so there are no parts to read the trims from
+        return meta_info
+
+    def _parts(track):
+        out_path_prefix = os.path.splitext(track.raw_wav)[0]
+        ranges = _get_extract_ranges(plan, track.offset_time, margin)
+        return track.replace(raw_parts=tuple(ExtractPart(start_time, end_time, f"{out_path_prefix}_part{index}.wav")
+                                             for index, (start_time, end_time) in enumerate(ranges, start=1)))
+    return meta_info.with_tracks(_parts)
+
+def _extract_track_ranges(in_file, track, overwrite, silent):
+    temp_file = _create_symlink_for_sane_ripping_fuck_eac3to(in_file)
+    # ffmpeg seeks relative to the start of the container, which is the video when the audio is delayed
+    seek_offset = max(track.offset_time, 0.0)
+    for start_time, end_time, part in ((part.start, part.end, part.path) for part in track.raw_parts):
+        if not Path(part).exists() or overwrite:
+            partial_file = _clear_partial(part)
+            ffmpeg_cmds = ["ffmpeg", "-y", "-ss", f"{start_time + seek_offset:.6f}", "-i", f"{temp_file}",
+                           "-t", f"{end_time - start_time:.6f}", "-map", f"0:{track.stream_id - 1}",
+                           "-c:a", _pcm_codec(track.bit_depth), f"{partial_file}"]
+            subp_args = {'args': ffmpeg_cmds}
+            subp_args |= {'stdout':subprocess.DEVNULL, 'stderr':subprocess.DEVNULL, 'creationflags':subprocess.CREATE_NO_WINDOW, 'shell':True} if silent else {'shell':True}
+            _finalize(partial_file, part, subprocess.call(**subp_args))
+        elif not silent:
+            print(f"AudioProcessor: wav part exists and overwrite not specified.")
+            print(f"AudioProcessor: {part}")
+    _remove_symlink(temp_file)
+
+def _extract_track_as_wav(in_file, track, overwrite, silent):
+    extract_file = Path(track.raw_wav)
+    if track.raw_parts and Path(in_file).suffix != ".wav":
+        _extract_track_ranges(in_file, track, overwrite, silent)
+    elif Path(in_file).suffix != ".wav":
+        if not Path(extract_file).exists() or overwrite:
+            temp_file = _create_symlink_for_sane_ripping_fuck_eac3to(in_file)
+            partial_file = _clear_partial(extract_file)
+            eac3to_cmds = ["eac3to", f"{temp_file}", "-log=NUL", f"{track.stream_id}:", f"{partial_file}"]
+            ffmpeg_cmds = ["ffmpeg", "-y", "-i", f"{temp_file}", "-map", f"0:{track.stream_id - 1}", f"{partial_file}"]
+            subp_args = {}
+            subp_args |= {'args': eac3to_cmds} if track.format != "AAC" else {'args': ffmpeg_cmds}
+            subp_args |= {'stdout':subprocess.DEVNULL, 'creationflags':subprocess.CREATE_NO_WINDOW, 'shell':True} if silent else {'shell':True}
+            _finalize(partial_file, extract_file, subprocess.call(**subp_args))
+            _remove_symlink(temp_file)
+        elif not silent:
+            print(f"AudioProcessor: wav file exists and overwrite not specified.")
             print(f"AudioProcessor: {extract_file}")
+    else:
+        print(f"AudioProcessor: input is already a wav file. no extraction needed")
+        shutil.copy(Path(in_file),_partial_path(extract_file))
+        _finalize(_partial_path(extract_file), extract_file)
+        print(f"AudioProcessor: {extract_file}")
+
+def _extract_tracks_as_wav(in_file, meta_info, overwrite, silent):
+    for track in meta_info.tracks:
+        _extract_track_as_wav(in_file, track, overwrite, silent)
     return 
 
-def _sox_trim(in_file, outfile, trim, framenum, offset_time, SPF, silent):
-    try:
-        import sox
-    except ModuleNotFoundError:
-        raise ModuleNotFoundError('AudioProcessor.VideoSource: missing sox dependency for trimming.')
-    in_file = os.path.normpath(in_file)
-    tfm = sox.Transformer()
-    if silent:
-        tfm.set_globals(verbosity=0)
+def _trim_frames(trim, framenum):
+    # python slice rules: None is an open end, negative frames count back from framenum
     startframe,endframe = trim[0],trim[1]
     if startframe is None:
         startframe = 0
@@ -131,89 +186,260 @@ def _sox_trim(in_file, outfile, trim, framenum, offset_time, SPF, silent):
         endframe = framenum
     elif endframe < 0:
         endframe = framenum + endframe
+    return startframe, endframe
+
+def _trim_times(trim, framenum, offset_time, SPF):
+    startframe,endframe = _trim_frames(trim, framenum)
     start_time = SPF * float(startframe + round(abs(offset_time) / SPF))
     end_time = SPF * float(endframe)
-    tfm.trim(start_time, end_time)
-    tfm.build(in_file,outfile)
+    return start_time, end_time
+
+def _trim_source(track, start_time, end_time):
+    """Returns the extracted file covering a trim and the source time it starts at."""
+    for part in track.raw_parts:
+        if part.start <= start_time and end_time <= part.end:
+            return part.path, part.start
+    return track.raw_wav, 0.0
 
-def _trim_tracks_as_wav(meta_info, trim_list, trims_framerate, overwrite, silent):
+def _sox_trim(track, outfile, trim, plan, silent):
     try:
         import sox
     except ModuleNotFoundError:
         raise ModuleNotFoundError('AudioProcessor.VideoSource: missing sox dependency for trimming.')
-    framerate = Fraction(trims_framerate if meta_info['framerate'] is None else meta_info['framerate'])
-    SPF = float(1.0 / framerate)
-    for track in meta_info['audio_tracks']:
-        temp_outfiles = []
-        raw_wav = track['raw_wav']
-        out_path_prefix = os.path.splitext(raw_wav)[0]
-        outfile = track['wav']
-        if not Path(outfile).exists() or overwrite:
-            if type(trim_list[0]) is list and len(trim_list) > 1:
-                for index, trim in enumerate(trim_list, start=1):
-                    temp_outfile = f"{out_path_prefix}_temp{index}.wav"
-                    temp_outfiles.append(temp_outfile)
-                    _sox_trim(raw_wav, temp_outfile, trim, meta_info['framenum'], track['offset_time'], SPF, silent)
-                cbn = sox.Combiner()
-                if silent:
-                    cbn.set_globals(verbosity=0)
-                formats = [ 'wav' for file in temp_outfiles ]
-                cbn.set_input_format(file_type=formats)
-                cbn.build(temp_outfiles, outfile, 'concatenate')
-            elif type(trim_list[0]) is int or type(trim_list[0]) is type(None):
-                _sox_trim(raw_wav, outfile, trim_list, meta_info['framenum'], track['offset_time'], SPF, silent)
-        elif not silent:
-            print(f"AudioProcessor: trimmed wav file exists and overwrite not specified.")
-            print(f"AudioProcessor: {outfile}")
+    start_time, end_time = _trim_times(trim, plan.framenum, track.offset_time, plan.spf)
+    in_file, seek = _trim_source(track, start_time, end_time)
+    in_file = os.path.normpath(in_file)
+    tfm = sox.Transformer()
+    if silent:
+        tfm.set_globals(verbosity=0)
+    tfm.trim(start_time - seek, end_time - seek)
+    tfm.build(in_file,outfile)
+
+def _get_spf(meta_info, trims_framerate):
+    framerate = Fraction(trims_framerate if meta_info.framerate is None else meta_info.framerate)
+    return float(1.0 / framerate)
+
+def _concat_wavs(in_files, outfile, silent):
+    try:
+        import sox
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError('AudioProcessor.VideoSource: missing sox dependency for concatonating.')
+    cbn = sox.Combiner()
+    if silent:
+        cbn.set_globals(verbosity=0)
+    formats = [ 'wav' for file in in_files ]
+    cbn.set_input_format(file_type=formats)
+    cbn.build(in_files, _clear_partial(outfile), 'concatenate')
+    _finalize(_partial_path(outfile), outfile)
+
+def _stream_trim(track, outfile, plan):
+    from .wavio import WavWriter, decode, read_frames, read_wav_info
+    from .audiostats import AudioStats, clip_level
+    writer = None
+    stats = None
+    try:
+        for trim in plan.trims:
+            start_time, end_time = _trim_times(trim, plan.framenum, track.offset_time, plan.spf)
+            in_file, seek = _trim_source(track, start_time, end_time)
+            info = read_wav_info(in_file)
+            if writer is None:
+                writer = WavWriter(outfile, info)
+                stats = AudioStats(info.channels, info.sample_rate, clip_level(info))
+            start = round((start_time - seek) * info.sample_rate)
+            end = round((end_time - seek) * info.sample_rate)
+            for raw in read_frames(in_file, start, end, info=info):
+                writer.write(raw)
+                stats.update(decode(raw, info))
+    finally:
+        if writer is not None:
+            writer.close()
+    return stats.result()
+
+def _trim_track_as_wav(track, plan, overwrite, silent, qc=False):
+    temp_outfiles = []
+    stats = None
+    outfile = track.wav
+    out_path_prefix = os.path.splitext(outfile)[0]
+    if not Path(outfile).exists() or overwrite:
+        if qc:
+            # trim in python so the statistics come from the same read as the cut
+            stats = _stream_trim(track, _partial_path(outfile), plan)
+            _finalize(_partial_path(outfile), outfile)
+        elif len(plan.trims) > 1:
+            for index, trim in enumerate(plan.trims, start=1):
+                temp_outfile = f"{out_path_prefix}_temp{index}.wav"
+                temp_outfiles.append(temp_outfile)
+                _sox_trim(track, temp_outfile, trim, plan, silent)
+            _concat_wavs(temp_outfiles, outfile, silent)
+        else:
+            _sox_trim(track, _clear_partial(outfile), plan.trims[0], plan, silent)
+            _finalize(_partial_path(outfile), outfile)
+    elif not silent:
+        print(f"AudioProcessor: trimmed wav file exists and overwrite not specified.")
+        print(f"AudioProcessor: {outfile}")
     _cleanup_temp_files(temp_outfiles)
-    return 
+    return stats
+
+def _trim_tracks_as_wav(meta_info, plan, overwrite, silent, qc=False):
+    if qc:
+        try:
+            import numpy
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError('AudioProcessor.VideoSource: missing numpy dependency for qc.')
+    else:
+        try:
+            import sox
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError('AudioProcessor.VideoSource: missing sox dependency for trimming.')
+    qc_stats = {}
+    for track in meta_info.tracks:
+        stats = _trim_track_as_wav(track, plan, overwrite, silent, qc)
+        if stats is not None:
+            qc_stats[track.stream_id] = stats
+    return qc_stats
 
 ########################
 #  encoding functions  #
 ########################
 
-def _encode_flac(meta_info, overwrite, silent):
+def _encode_flac_verified(wav, partial_file, silent):
+    from .wavio import read_frames, read_wav_info, wav_header
+    from .integrity import PcmHasher, flac_streaminfo
+    info = read_wav_info(wav)
+    hasher = PcmHasher(info)
+    flac_cmds = ["flac", "-", "-8", "--force", "-o", partial_file]
+    if silent:
+        flac_cmds.insert(3,'--silent')
+    subp_args = {'args': flac_cmds, 'stdin': subprocess.PIPE}
+    subp_args |= {'stdout':subprocess.DEVNULL, 'creationflags':subprocess.CREATE_NO_WINDOW, 'shell':True} if silent else {'shell':True}
+    # the wav is piped through flac and hashed on the way, rather than decoding the flac afterwards
+    proc = subprocess.Popen(**subp_args)
+    try:
+        proc.stdin.write(wav_header(info, info.data_size))
+        for raw in read_frames(wav, info=info):
+            proc.stdin.write(raw)
+            hasher.update(raw)
+        if info.data_size & 1:
+            proc.stdin.write(b'\x00')
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    if proc.wait() != 0:
+        return proc.returncode, None
+    streaminfo = flac_streaminfo(partial_file)
+    if streaminfo['md5'] != hasher.hexdigest() or streaminfo['total_samples'] != hasher.frames:
+        _cleanup_temp_files(partial_file)
+        raise RuntimeError(f"AudioProcessor: flac verification failed for {wav}: "
+                           f"encoded md5 {streaminfo['md5']} ({streaminfo['total_samples']} samples), "
+                           f"input md5 {hasher.hexdigest()} ({hasher.frames} samples).")
+    entry = {
+        'md5': hasher.hexdigest(),
+        'samples': hasher.frames,
+        'sample_rate': info.sample_rate,
+        'channels': info.channels,
+        'bits_per_sample': info.bits_per_sample,
+        'source': Path(wav).name,
+    }
+    return 0, entry
+
+def _encode_flac_track(track, overwrite, silent, verify=False):
+    wav = track.wav
+    outfile = track.flac
+    if not Path(outfile).exists() or overwrite:
+        if verify:
+            returncode, entry = _encode_flac_verified(wav, _clear_partial(outfile), silent)
+            _finalize(_partial_path(outfile), outfile, returncode)
+            if entry is not None:
+                from .integrity import record_hash
+                record_hash(outfile, entry)
+            return
+        flac_cmds = ["flac", wav, "-8", "--force", "-o", _clear_partial(outfile)]
+        if silent:
+            flac_cmds.insert(3,'--silent')
+        subp_args = {'args': flac_cmds}
+        subp_args |= {'stdout':subprocess.DEVNULL, 'creationflags':subprocess.CREATE_NO_WINDOW, 'shell':True} if silent else {'shell':True}
+        _finalize(_partial_path(outfile), outfile, subprocess.call(**subp_args))
+    elif not silent:
+        print(f"AudioProcessor: flac file exists and overwrite not specified.")
+        print(f"AudioProcessor: {outfile}")
+
+def _encode_flac(meta_info, overwrite, silent, verify=False):
     dep = shutil.which("flac")
     if dep is None:
         raise SystemExit('flac encoder was not found in your PATH.')
-    for track in meta_info['audio_tracks']:
-        wav = track['wav']
-        outfile = track['flac']
-        if not Path(outfile).exists() or overwrite:
-            flac_cmds = ["flac", wav, "-8", "--force", "-o", outfile]
-            if silent:
-                flac_cmds.insert(3,'--silent')
-            subp_args = {'args': flac_cmds}
-            subp_args |= {'stdout':subprocess.DEVNULL, 'creationflags':subprocess.CREATE_NO_WINDOW, 'shell':True} if silent else {'shell':True}
-            subprocess.call(**subp_args)
-        elif not silent:
-            print(f"AudioProcessor: flac file exists and overwrite not specified.")
-            print(f"AudioProcessor: {outfile}")
+    for track in meta_info.tracks:
+        _encode_flac_track(track, overwrite, silent, verify)
     return
 
-def _encode_aac(meta_info, overwrite, silent):
+def _pipe_processed_wav(subp_args, wav, downmix, samplerate):
+    from .wavio import wav_header
+    from .dsp import processed_wav
+    info, blocks = processed_wav(wav, downmix, samplerate)
+    proc = subprocess.Popen(**subp_args, stdin=subprocess.PIPE)
+    try:
+        proc.stdin.write(wav_header(info, info.data_size))
+        for raw in blocks:
+            proc.stdin.write(raw)
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass
+    return proc.wait()
+
+def _encode_aac_track(track, overwrite, silent, downmix=None, samplerate=None):
+    wav = track.wav
+    outfile = track.aac
+    if not Path(outfile).exists() or overwrite:
+        # downmixed or resampled audio is streamed to qaac, leaving the wav as is for flac
+        processed = downmix is not None or samplerate is not None
+        aac_cmds = ["qaac", "-" if processed else wav, "--adts", "-V 127", "--no-delay", "-o", _clear_partial(outfile)]
+        if silent:
+            aac_cmds.insert(5,'--silent')
+        subp_args = {'args': aac_cmds}
+        subp_args |= {'stdout':subprocess.DEVNULL, 'creationflags':subprocess.CREATE_NO_WINDOW, 'shell':True} if silent else {'shell':True}
+        if processed:
+            returncode = _pipe_processed_wav(subp_args, wav, downmix, samplerate)
+        else:
+            returncode = subprocess.call(**subp_args)
+        _finalize(_partial_path(outfile), outfile, returncode)
+    elif not silent:
+        print(f"AudioProcessor: aac file exists and overwrite not specified.")
+        print(f"AudioProcessor: {outfile}")
+
+def _encode_aac(meta_info, overwrite, silent, downmix=None, samplerate=None):
     dep = shutil.which("qaac")
     if dep is None:
         raise SystemExit('qaac encoder was not found in your PATH.')
-    for track in meta_info['audio_tracks']:
-        wav = track['wav']
-        outfile = track['aac']
-        if not Path(outfile).exists() or overwrite:
-            aac_cmds = ["qaac", wav, "--adts", "-V 127", "--no-delay", "-o", outfile]
-            if silent:
-                aac_cmds.insert(5,'--silent')
-            subp_args = {'args': aac_cmds}
-            subp_args |= {'stdout':subprocess.DEVNULL, 'creationflags':subprocess.CREATE_NO_WINDOW, 'shell':True} if silent else {'shell':True}
-            subprocess.call(**subp_args)
-        elif not silent:
-            print(f"AudioProcessor: aac file exists and overwrite not specified.")
-            print(f"AudioProcessor: {outfile}")
+    if downmix is not None or samplerate is not None:
+        try:
+            import numpy
+        except ModuleNotFoundError:
+            raise ModuleNotFoundError('AudioProcessor.VideoSource: missing numpy dependency for aac_downmix and aac_samplerate.')
+    for track in meta_info.tracks:
+        _encode_aac_track(track, overwrite, silent, downmix, samplerate)
     return    
 
 #######################
 #  utility functions  #
 #######################
 
+def _partial_path(outfile):
+    outfile = Path(outfile)
+    return str(outfile.with_name(f"{outfile.stem}.partial{outfile.suffix}"))
+
+def _clear_partial(outfile):
+    # a partial file left by an interrupted run would make some tools stop and ask before overwriting
+    partial_file = _partial_path(outfile)
+    _cleanup_temp_files(partial_file)
+    return partial_file
+
+def _finalize(partial_file, outfile, returncode=0):
+    # outputs are written under a partial name and moved into place once complete,
+    # so an interrupted run never leaves a truncated file under the final name
+    if returncode == 0 and Path(partial_file).exists():
+        os.replace(partial_file, outfile)
+    elif returncode != 0:
+        _cleanup_temp_files(partial_file)
+
 def _cleanup_temp_files(files):
     if type(files) is not list:
         f = Path(files)
@@ -225,6 +451,18 @@ def _cleanup_temp_files(files):
             if f.exists():
                 Path.unlink(f)
 
+def _normalize_trim_list(trim_list):
+    if trim_list is not None:
+        if type(trim_list[0]) is list and len(trim_list) == 1:
+            trim_list = trim_list[0]
+    return trim_list
+
+def _strip_cut(meta_info):
+    def _uncut(path):
+        path = Path(path)
+        return str(path.with_name(f"{path.stem[:-len('_cut')]}{path.suffix}")) if path.stem.endswith('_cut') else str(path)
+    return meta_info.with_tracks(lambda track: track.replace(wav=_uncut(track.wav), flac=_uncut(track.flac), aac=_uncut(track.aac)))
+
 def _get_out_prefix(in_file, out_file, out_dir):
     if out_file is None and out_dir is None:
         out_dir = Path.cwd()
@@ -243,25 +481,25 @@ def _write_files(meta_info, flac, aac, wav, overwrite, silent):
     missing_files_found = False
     if overwrite:
         return missing_files_found
-    for track in meta_info['audio_tracks']:
+    for track in meta_info.tracks:
         if flac:
-            if not Path(track['flac']).exists():
+            if not Path(track.flac).exists():
                 missing_files_found = True
-                if not silent: print(f"{Path(track['flac'])} does not exist")
+                if not silent: print(f"{Path(track.flac)} does not exist")
             elif not silent:
-                print(f"{Path(track['flac'])} exists")
+                print(f"{Path(track.flac)} exists")
         if aac:
-            if not Path(track['aac']).exists():
+            if not Path(track.aac).exists():
                 missing_files_found = True
-                if not silent: print(f"{Path(track['aac'])} does not exist")
+                if not silent: print(f"{Path(track.aac)} does not exist")
             elif not silent:
-                print(f"{Path(track['aac'])} exists")
+                print(f"{Path(track.aac)} exists")
         if wav:
-            if not Path(track['wav']).exists():
+            if not Path(track.wav).exists():
                 missing_files_found = True
-                if not silent: print(f"{Path(track['wav'])} does not exist")
+                if not silent: print(f"{Path(track.wav)} does not exist")
             elif not silent:
-                print(f"{Path(track['wav'])} exists")
+                print(f"{Path(track.wav)} exists")
     if not missing_files_found:
         return missing_files_found
     else:
@@ -319,7 +557,11 @@ def mpls_source(
                 aac:bool=True, 
                 wav:bool=False,
                 overwrite:bool=False,
-                silent:bool=True
+                silent:bool=True,
+                verify:bool=False,
+                aac_downmix:Optional[Union[str, List[List[float]]]]=None,
+                aac_samplerate:Optional[int]=None,
+                align:Optional[Union[bool, str, List[str]]]=None
                 ):
     """
     Processes audio from a given mpls file. Functions include trimming losslessly and encoding to flac and/or aac. 
@@ -373,12 +615,33 @@ def mpls_source(
     :type overwrite: bool, optional
     :param silent: Silence eac3to, ffmpeg, flac, and qaac, defaults to True.
     :type silent: bool, optional
+    :param verify: Verify the flac files are lossless, see video_source. Defaults to False.
+    :type verify: bool, optional
+    :param aac_downmix: Downmix for the aac files, see video_source. Defaults to None.
+    :type aac_downmix: str or list of lists, optional
+    :param aac_samplerate: Sample rate of the aac files, see video_source. Defaults to None.
+    :type aac_samplerate: int, optional
+    :param align: Align the clips' audio before concatenating, defaults to None.
+        True removes audio a clip repeats from the end of the one before it.
+        A wav file path places every clip against that continuous reference track instead, filling gaps with silence;
+        a list gives one reference per audio stream. Reference offsets with a poor match are left unapplied
+        and always printed, silent or not.
+    :type align: bool, str or list, optional
     :return: A list of filepaths to all of the final processed files.
     :rtype: list
     """
+    if align:
+        from .planner import AudioPlan
+        plan = AudioPlan(overwrite=overwrite, silent=silent)
+        plan.add_mpls_source(mpls_dict, trim_list, out_file, out_dir, trims_framerate, flac=flac, aac=aac, wav=wav,
+                             verify=verify, aac_downmix=aac_downmix, aac_samplerate=aac_samplerate, align=align)
+        return plan.run()[0]
+
     in_file = _mpls_audio(mpls_dict, wav, overwrite, silent)
 
-    outfiles = video_source(in_file, trim_list, out_file, out_dir, trims_framerate, flac, aac, wav, overwrite, silent)
+    outfiles = video_source(in_file, trim_list, out_file, out_dir, trims_framerate, flac=flac, aac=aac, wav=wav,
+                            overwrite=overwrite, silent=silent, verify=verify,
+                            aac_downmix=aac_downmix, aac_samplerate=aac_samplerate)
     
     return outfiles
 
@@ -393,7 +656,12 @@ def video_source(
                 aac:bool=True, 
                 wav:bool=False,
                 overwrite:bool=False,
-                silent:bool=True
+                silent:bool=True,
+                partial_extract:bool=False,
+                qc:bool=False,
+                verify:bool=False,
+                aac_downmix:Optional[Union[str, List[List[float]]]]=None,
+                aac_samplerate:Optional[int]=None
                 ):
     """
     Processes audio from a given video file. Functions include trimming losslessly and encoding to flac and/or aac.
@@ -446,8 +714,33 @@ def video_source(
     :type overwrite: bool, optional
     :param silent: Silence eac3to, ffmpeg, flac, and qaac, defaults to True.
     :type silent: bool, optional
+    :param partial_extract: Only extract the parts of the audio covered by trim_list (plus a second either side),
+        seeking with ffmpeg instead of extracting the whole stream. Useful when the trims are a small part of a long source.
+        Ignored for wav inputs, which are used whole. Defaults to False.
+    :type partial_extract: bool, optional
+    :param qc: Also measure per-channel peak, RMS and clipping counts, and integrated loudness (EBU R128), of each trimmed track.
+        The trim is then done in python while the samples are measured, instead of with sox, so no extra pass over the audio is needed.
+        Tracks that are not trimmed, or whose trimmed wav already exists, are measured from the wav.
+        Requires numpy, and scipy for loudness. Defaults to False.
+    :type qc: bool, optional
+    :param verify: Verify the flac files are lossless. The wav is piped to flac and hashed as it streams,
+        and the hash is checked against the MD5 flac stores in the file, so no second decode is needed.
+        The hashes are recorded in audio_manifest.json next to the flac files. Defaults to False.
+    :type verify: bool, optional
+    :param aac_downmix: Downmix the aac files, leaving flac and wav untouched. Either a preset,
+        'stereo' or 'mono' (ITU-R BS.775 coefficients, with the LFE dropped, picked by the wav's channel mask;
+        layouts the presets do not cover need a matrix), or a matrix with a row of
+        coefficients per output channel and a column per input channel. Add '_normalized' to a preset,
+        e.g. 'stereo_normalized', to scale it so the downmix cannot clip. Requires numpy. Defaults to None.
+    :type aac_downmix: str or list of lists, optional
+    :param aac_samplerate: Resample the aac files to this rate, e.g. 48000, leaving flac and wav untouched.
+        The audio is downmixed and resampled in blocks on its way to qaac, without an intermediate file.
+        Requires numpy. Defaults to None.
+    :type aac_samplerate: int, optional
+    :raises RuntimeError: A flac file failed verification. It is not kept.
     :raises SystemExit: Missing dependencies.
     :return: A list of filepaths to all of the final processed files.
+        With qc, a tuple of that list and a dict of statistics keyed by stream id, see audiostats.AudioStats.result.
     :rtype: list
     """
 
@@ -460,38 +753,50 @@ def video_source(
 
     meta_info = _build_extract_data(in_file, out_prefix, trims_framerate, frames_total)
 
-    if trim_list is None or trim_list == [None,None]:
-        for track in meta_info["audio_tracks"]:
-            for x in track:
-                if isinstance(track[x], str): 
-                    track[x] = track[x].replace('_cut','')
+    trim_list = _normalize_trim_list(trim_list)
+    plan = None
+    if trim_list is not None and trim_list != [None,None]:
+        plan = TrimPlan.from_trim_list(trim_list, meta_info.framenum, _get_spf(meta_info, trims_framerate))
+
+    if plan is None:
+        # the uncut wav is the extracted wav, so there is nothing to trim
+        meta_info = _strip_cut(meta_info)
 
+    qc_stats = {}
     check_write = _write_files(meta_info, flac, aac, wav, overwrite, silent)
     if check_write:
+        if partial_extract and plan is not None:
+            meta_info = _build_raw_parts(in_file, meta_info, plan, EXTRACT_MARGIN)
         _extract_tracks_as_wav(in_file, meta_info, overwrite, silent)
 
-        if trim_list is not None:
-            if type(trim_list[0]) is list and len(trim_list) == 1:
-                trim_list = trim_list[0]
-            _trim_tracks_as_wav(meta_info, trim_list, trims_framerate, overwrite, silent)
+        if plan is not None:
+            qc_stats = _trim_tracks_as_wav(meta_info, plan, overwrite, silent, qc)
 
     elif not silent: 
         print("AudioProcessor: All files exist and overwrite not specified.")
+    if qc:
+        from .audiostats import analyze_wav
+        for track in meta_info.tracks:
+            if track.stream_id not in qc_stats:
+                qc_stats[track.stream_id] = analyze_wav(track.wav) if Path(track.wav).exists() else None
     outfiles = []
     if flac:
-        _encode_flac(meta_info, overwrite, silent)
-        outfiles.extend([track['flac'] for track in meta_info['audio_tracks']])
+        _encode_flac(meta_info, overwrite, silent, verify)
+        outfiles.extend([track.flac for track in meta_info.tracks])
     if aac:
-        _encode_aac(meta_info, overwrite, silent)
-        outfiles.extend([track['aac'] for track in meta_info['audio_tracks']])
+        _encode_aac(meta_info, overwrite, silent, aac_downmix, aac_samplerate)
+        outfiles.extend([track.aac for track in meta_info.tracks])
     if not wav:
-        _cleanup_temp_files([track['wav'] for track in meta_info['audio_tracks']])
+        _cleanup_temp_files([track.wav for track in meta_info.tracks])
     else:
-        outfiles.extend([track['wav'] for track in meta_info['audio_tracks']])
+        outfiles.extend([track.wav for track in meta_info.tracks])
     
-    # always cleanup raw wav
-    _cleanup_temp_files([track['raw_wav'] for track in meta_info['audio_tracks']])
+    # always cleanup raw wav, unless it is the untrimmed wav output
+    _cleanup_temp_files([track.raw_wav for track in meta_info.tracks if track.raw_wav not in outfiles])
+    _cleanup_temp_files([part.path for track in meta_info.tracks for part in track.raw_parts])
 
+    if qc:
+        return outfiles, qc_stats
     return outfiles
     
 
@@ -536,6 +841,42 @@ def _main():
     parser.add_argument("--silent",
                         action="store_true", default=False,
                         help="Silence eac3to, ffmpeg, flac, and qaac. (default: %(default)s)")
+    parser.add_argument("--partial_extract",
+                        action="store_true", default=False,
+                        help="Only extract the audio covered by the trims. (default: %(default)s)")
+    parser.add_argument("--qc",
+                        action="store_true", default=False,
+                        help="Print peak, RMS, clipping and loudness statistics of each track as json. (default: %(default)s)")
+    parser.add_argument("--verify",
+                        action="store_true", default=False,
+                        help="Verify flac files against an MD5 of the wav taken while encoding, and record it in audio_manifest.json. (default: %(default)s)")
+    parser.add_argument("--aac_downmix",
+                        default = None,
+                        help="Downmix the aac files: stereo, mono, stereo_normalized, mono_normalized, or a json matrix. (default: %(default)s)",
+                        action="store")
+    parser.add_argument("--aac_samplerate",
+                        default = None, type=int,
+                        help="Resample the aac files to this rate. (default: %(default)s)")
+    parser.add_argument("--align",
+                        nargs="?", const=True, default=None,
+                        help="Align the audio of mpls clips before concatenating: alone, removes audio repeated across clip boundaries; with a wav file, places the clips against that reference track. (default: %(default)s)")
+    parser.add_argument("--batch",
+                        default = None,
+                        help="A json file with a list of requests, each an object of video_source arguments. Overrides in_file and mpls_dict.",
+                        action="store")
+    parser.add_argument("--dry_run", "--dry-run",
+                        action="store_true", default=False,
+                        help="Print the stages that would run and exit. (default: %(default)s)")
+    parser.add_argument("-j", "--jobs",
+                        default = 1, type=int,
+                        help="Number of stages to run at once. (default: %(default)s)")
+    parser.add_argument("--journal",
+                        default = None,
+                        help="A file to record finished stages in, so an interrupted run can be resumed with --resume.",
+                        action="store")
+    parser.add_argument("--resume",
+                        action="store_true", default=False,
+                        help="Skip the stages the journal verifies as finished. (default: %(default)s)")
     args = parser.parse_args()
     in_file = args.in_file
     mpls_dict = args.mpls_dict
@@ -548,12 +889,42 @@ def _main():
     wav = args.wav
     overwrite = args.overwrite
     silent = args.silent
-    if in_file and mpls_dict:
+    partial_extract = args.partial_extract
+    verify = args.verify
+    aac_downmix = args.aac_downmix
+    if aac_downmix is not None and aac_downmix.lstrip().startswith('['):
+        aac_downmix = json.loads(aac_downmix)
+    aac_samplerate = args.aac_samplerate
+    if args.batch or args.dry_run or args.jobs > 1 or args.journal:
+        from .planner import AudioPlan
+        plan = AudioPlan(overwrite=overwrite, silent=silent, journal=args.journal, resume=args.resume)
+        if args.batch:
+            with open(args.batch) as f:
+                for request in json.load(f):
+                    plan.add_video_source(**request)
+        elif in_file and mpls_dict:
+            raise SystemExit('You must spcify only one input type, in_file or mpls_dict.')
+        elif in_file:
+            plan.add_video_source(in_file, trim_list, out_file, out_dir, trims_framerate, flac=flac, aac=aac, wav=wav,
+                                  partial_extract=partial_extract, verify=verify,
+                                  aac_downmix=aac_downmix, aac_samplerate=aac_samplerate)
+        elif mpls_dict:
+            plan.add_mpls_source(mpls_dict, trim_list, out_file, out_dir, trims_framerate, flac=flac, aac=aac, wav=wav,
+                                 verify=verify, aac_downmix=aac_downmix, aac_samplerate=aac_samplerate, align=args.align)
+        print(plan.describe())
+        if not args.dry_run:
+            plan.run(jobs=args.jobs)
+    elif in_file and mpls_dict:
         raise SystemExit('You must spcify only one input type, in_file or mpls_dict.')
     elif in_file:
-        video_source(in_file, trim_list, out_file, out_dir, trims_framerate, flac, aac, wav, overwrite, silent)
+        result = video_source(in_file, trim_list, out_file, out_dir, trims_framerate, flac=flac, aac=aac, wav=wav,
+                              overwrite=overwrite, silent=silent, partial_extract=partial_extract, qc=args.qc,
+                              verify=verify, aac_downmix=aac_downmix, aac_samplerate=aac_samplerate)
+        if args.qc:
+            print(json.dumps(result[1], indent=2))
     elif mpls_dict:
-        mpls_source(mpls_dict, trim_list, out_file, out_dir, trims_framerate, flac, aac, wav, overwrite, silent)
+        mpls_source(mpls_dict, trim_list, out_file, out_dir, trims_framerate, flac, aac, wav, overwrite, silent, verify,
+                    aac_downmix, aac_samplerate, args.align)
 
 if __name__ == "__main__":
     _main()
\ No newline at end of file
@@ -1,4 +1,16 @@
 # -*- coding: utf-8 -*-
 
 from .AudioProcessor import video_source as ap_video_source
-from .AudioProcessor import mpls_source as ap_mpls_source
\ No newline at end of file
+from .AudioProcessor import mpls_source as ap_mpls_source
+from .vsaudio import audio_node_source as ap_audio_node_source
+from .vsaudio import trim_audio as ap_trim_audio
+from .audiostats import analyze_wav as ap_analyze_wav
+from .silence import suggest_trims as ap_suggest_trims
+from .silence import detect_silence as ap_detect_silence
+from .alignment import find_offset as ap_find_offset
+from .alignment import boundary_offsets as ap_boundary_offsets
+from .alignment import reference_offsets as ap_reference_offsets
+from .planner import AudioPlan as ap_AudioPlan
+from .benchmark import benchmark_filter as bench_filter
+from .benchmark import synthetic_clip as bench_synthetic_clip
+from .benchmark import compare_variants as bench_compare
\ No newline at end of file
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+from typing import *
+
+from .wavio import WavInfo, WavWriter, decode, read_frames, read_wav_info
+
+
+class Alignment(NamedTuple):
+    """
+    The offset found for one clip, in samples, and how well the audio matched, from 0 to 1.
+    """
+    offset: int
+    score: float
+
+
+def _mono(path, start, end, info):
+    import numpy as np
+    start, end = max(0, start), min(end, info.frames)
+    if end <= start:
+        return np.zeros(0)
+    return np.concatenate([decode(raw, info).mean(axis=1) for raw in read_frames(path, start, end, info=info)])
+
+
+def _envelope(samples, decimate):
+    # mean absolute level over blocks of decimate samples, without its DC so silence does not correlate
+    blocks = len(samples) // decimate
+    envelope = abs(samples[:blocks * decimate]).reshape(blocks, decimate).mean(axis=1)
+    return envelope - envelope.mean() if blocks else envelope
+
+
+def _ncc(a, b, low, high, min_overlap):
+    """
+    Normalized cross-correlation of a and b for lags low to high inclusive, where lag k pairs b[j] with a[j + k].
+    Each lag is normalized over the samples it overlaps, so partial overlaps score fairly.
+    Returns the best lag and its score.
+    """
+    import numpy as np
+    n = 1 << (len(a) + len(b)).bit_length()
+    # one FFT product gives the dot product of every lag, negative lags wrapping to the end
+    dots = np.fft.irfft(np.fft.rfft(a, n) * np.conj(np.fft.rfft(b, n)), n)
+    lags = np.arange(low, high + 1)
+    first = np.maximum(0, -lags)
+    last = np.minimum(len(b), len(a) - lags)
+    overlap = last - first
+    energy_a = np.concatenate([[0.0], np.cumsum(a * a)])
+    energy_b = np.concatenate([[0.0], np.cumsum(b * b)])
+    valid = overlap >= max(1, min_overlap)
+    first, last = np.where(valid, first, 0), np.where(valid, last, 0)
+    energy = (energy_a[np.clip(last + lags, 0, len(a))] - energy_a[np.clip(first + lags, 0, len(a))]) \
+        * (energy_b[last] - energy_b[first])
+    scores = np.where(valid & (energy > 0), dots[lags % n] / np.sqrt(np.maximum(energy, 1e-30)), -np.inf)
+    best = int(np.argmax(scores))
+    return int(lags[best]), float(scores[best]) if np.isfinite(scores[best]) else 0.0
+
+
+def _match(a, b, low, high, decimate, min_overlap, exact=False):
+    """
+    Finds the lag of b in a between low and high: coarsely on envelopes, then to the sample
+    on the waveforms around the envelope peak. With exact, the score is always the waveform's.
+    """
+    coarse, score = _ncc(_envelope(a, decimate), _envelope(b, decimate), low // decimate, -(-high // decimate),
+                         min_overlap // decimate)
+    if score <= 0:
+        return Alignment(0, 0.0)
+    lag, fine = _ncc(a, b, max(low, coarse * decimate - 2 * decimate), min(high, coarse * decimate + 2 * decimate),
+                     min_overlap)
+    # envelopes still match where waveforms do not, e.g. after lossy encoding, so keep the coarse lag then
+    if exact or fine >= score:
+        return Alignment(lag, fine)
+    return Alignment(coarse * decimate, score)
+
+
+def _check_formats(infos, paths):
+    first = infos[0]
+    for info, path in zip(infos[1:], paths[1:]):
+        if (info.sample_rate, info.channels, info.format_tag, info.bits_per_sample) != \
+                (first.sample_rate, first.channels, first.format_tag, first.bits_per_sample):
+            raise ValueError(f"alignment: {path} does not have the sample format of {paths[0]}.")
+
+
+def find_offset(wav:str, reference:str, wav_start:int=0, reference_start:int=0, window:float=10.0,
+                max_offset:float=2.0, decimate:int=48) -> Alignment:
+    """
+    Finds where the audio at wav_start of wav lies in reference, relative to reference_start.
+
+    Cross-correlates the envelopes of both with one FFT, decimated by block averaging, then refines the peak
+    to the sample on the waveforms. Both files must have the same sample rate.
+
+    Example:
+        offset, score = find_offset(r"E:\\00002_2.wav", r"E:\\reference.wav", reference_start=2158157)
+
+    :param wav: The wav file to place.
+    :type wav: str
+    :param reference: The wav file to place it in.
+    :type reference: str
+    :param wav_start: Sample of wav to place, defaults to 0.
+    :type wav_start: int, optional
+    :param reference_start: Sample of reference where wav_start is expected, defaults to 0.
+    :type reference_start: int, optional
+    :param window: Seconds of audio compared, defaults to 10.0.
+    :type window: float, optional
+    :param max_offset: Largest offset searched either way, in seconds, defaults to 2.0.
+    :type max_offset: float, optional
+    :param decimate: Samples averaged into one envelope value, defaults to 48 (1 ms at 48 kHz).
+    :type decimate: int, optional
+    :raises ValueError: The files have different sample rates.
+    :return: The offset in samples, positive if the audio lies later in reference than expected, and the match score.
+    :rtype: Alignment
+    """
+    info, reference_info = read_wav_info(wav), read_wav_info(reference)
+    if info.sample_rate != reference_info.sample_rate:
+        raise ValueError(f"find_offset: {wav} and {reference} have different sample rates.")
+    window, search = int(window * info.sample_rate), int(max_offset * info.sample_rate)
+    b = _mono(wav, wav_start, wav_start + window, info)
+    first = max(0, reference_start - search)
+    a = _mono(reference, first, reference_start + search + len(b), reference_info)
+    lag, score = _match(a, b, reference_start - search - first, reference_start + search - first, decimate,
+                        min(len(b), window // 2))
+    return Alignment(first + lag - reference_start, score)
+
+
+def boundary_offsets(in_files:List[str], window:float=10.0, max_offset:float=2.0, decimate:int=48,
+                     min_overlap:float=0.05) -> List[Alignment]:
+    """
+    Finds audio repeated across the boundaries of consecutive clips, as when each clip of a playlist
+    carries a little of the audio of the one before it.
+
+    The end of each clip is cross-correlated with the start of the next. A repeat is the same decoded audio,
+    so it is scored on the waveforms, and a boundary without one scores low. Only repeats can be found this way;
+    gaps need a reference, see reference_offsets.
+
+    :param in_files: The wav files of the clips, in playlist order.
+    :type in_files: list
+    :param window: Seconds either side of a boundary compared, defaults to 10.0.
+    :type window: float, optional
+    :param max_offset: Longest repeat searched for, in seconds, defaults to 2.0.
+    :type max_offset: float, optional
+    :param decimate: Samples averaged into one envelope value, defaults to 48.
+    :type decimate: int, optional
+    :param min_overlap: Shortest repeat searched for, in seconds, defaults to 0.05.
+    :type min_overlap: float, optional
+    :return: For every clip, the samples repeated from the clip before at its start and the match score.
+        The first clip is always Alignment(0, 1.0).
+    :rtype: list of Alignment
+    """
+    infos = [read_wav_info(path) for path in in_files]
+    _check_formats(infos, in_files)
+    rate = infos[0].sample_rate
+    window, search, min_overlap = int(window * rate), int(max_offset * rate), int(min_overlap * rate)
+    alignments = [Alignment(0, 1.0)]
+    for path, info, next_path, next_info in zip(in_files, infos, in_files[1:], infos[1:]):
+        a = _mono(path, info.frames - window, info.frames, info)
+        b = _mono(next_path, 0, window, next_info)
+        # the start of the next clip lies in the end of this one, search/min_overlap samples before it ends
+        lag, score = _match(a, b, len(a) - search, len(a) - min_overlap, decimate, min_overlap, exact=True)
+        alignments.append(Alignment(len(a) - lag, score))
+    return alignments
+
+
+def reference_offsets(in_files:List[str], reference:str, window:float=10.0, max_offset:float=2.0,
+                      decimate:int=48, min_score:float=0.5) -> List[Alignment]:
+    """
+    Places the start of each clip against a continuous reference track, such as the same program from another release.
+
+    Each clip is searched for around where the clips before it end once corrected,
+    so the offsets do not drift over a long playlist.
+
+    :param in_files: The wav files of the clips, in playlist order.
+    :type in_files: list
+    :param reference: The reference wav file, with the same sample rate.
+    :type reference: str
+    :param window: Seconds of each clip compared, defaults to 10.0.
+    :type window: float, optional
+    :param max_offset: Largest offset searched either way, in seconds, defaults to 2.0.
+    :type max_offset: float, optional
+    :param decimate: Samples averaged into one envelope value, defaults to 48.
+    :type decimate: int, optional
+    :param min_score: Offsets scoring lower are not applied to the position of the clips that follow, defaults to 0.5.
+        They are still returned as measured.
+    :type min_score: float, optional
+    :return: For every clip, the corrective offset as concat_aligned takes it and the match score.
+    :rtype: list of Alignment
+    """
+    alignments = []
+    position = 0
+    for path in in_files:
+        offset, score = find_offset(path, reference, 0, position, window, max_offset, decimate)
+        # audio found earlier than expected repeats what came before it, later leaves a gap to fill
+        alignments.append(Alignment(-offset, score))
+        position += read_wav_info(path).frames + (offset if score >= min_score else 0)
+    return alignments
+
+
+def concat_aligned(in_files:List[str], outfile:str, offsets:List[int]) -> None:
+    """
+    Concatenates wav files, dropping offsets[i] samples from the start of clip i, or inserting silence if negative.
+
+    :param in_files: The wav files, with the same sample format.
+    :type in_files: list
+    :param outfile: The wav file to write.
+    :type outfile: str
+    :param offsets: Samples to drop from the start of each clip.
+    :type offsets: list of int
+    :raises ValueError: The files have different sample formats.
+    """
+    infos = [read_wav_info(path) for path in in_files]
+    _check_formats(infos, in_files)
+    info = infos[0]
+    silence = (b'\x80' if info.sample_width == 1 and not info.is_float else b'\x00') * info.block_align
+    with WavWriter(outfile, info) as writer:
+        for path, clip_info, offset in zip(in_files, infos, offsets):
+            for start in range(0, -offset, 1 << 16):
+                writer.write(silence * min(1 << 16, -offset - start))
+            for raw in read_frames(path, max(0, offset), info=clip_info):
+                writer.write(raw)
+
+
+def _align_concat(in_files, outfile, silent, align, min_score=0.5):
+    from .AudioProcessor import _finalize, _partial_path
+    if isinstance(align, str):
+        alignments = reference_offsets(in_files, align, min_score=min_score)
+    else:
+        alignments = boundary_offsets(in_files)
+    offsets = [offset if score >= min_score else 0 for offset, score in alignments]
+    rate = read_wav_info(in_files[0]).sample_rate
+    for path, (offset, score) in zip(in_files, alignments):
+        # a boundary without a repeat is expected to score low; a clip not found in the reference is not
+        if score < min_score and not isinstance(align, str):
+            if not silent:
+                print(f"AudioProcessor: {path}: no repeated audio found (score {score:.2f})")
+        elif score < min_score:
+            # skipped offsets are always reported, as the output may need fixing by hand
+            print(f"AudioProcessor: {path}: offset {offset} samples ({1000 * offset / rate:+.1f} ms) "
+                  f"matched poorly (score {score:.2f}) and was not applied")
+        elif not silent and offset:
+            print(f"AudioProcessor: {path}: offset {offset} samples ({1000 * offset / rate:+.1f} ms), "
+                  f"score {score:.2f}, applied")
+    concat_aligned(in_files, _partial_path(outfile), offsets)
+    _finalize(_partial_path(outfile), outfile)
+    return alignments
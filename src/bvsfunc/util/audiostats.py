@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import math
+from typing import *
+
+from .wavio import decode, read_frames, read_wav_info
+
+# EBU R128 / ITU-R BS.1770 constants
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+_LOUDNESS_OFFSET = -0.691
+
+
+def _k_weighting(sample_rate):
+    """Second order sections of the BS.1770 K-weighting filter at any sample rate."""
+    # high shelf
+    f0, gain, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = math.tan(math.pi * f0 / sample_rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0,
+             1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    # high pass
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = math.tan(math.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    highpass = [1.0, -2.0, 1.0, 1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    return [shelf, highpass]
+
+
+def _channel_weights(channels):
+    # L, R, C weigh 1.0, surrounds 1.41 and the LFE is left out, assuming wav channel order
+    if channels <= 3:
+        return [1.0] * channels
+    if channels == 4:
+        return [1.0, 1.0, 1.41, 1.41]
+    if channels == 5:
+        return [1.0, 1.0, 1.0, 1.41, 1.41]
+    return [1.0, 1.0, 1.0, 0.0] + [1.41] * (channels - 4)
+
+
+class AudioStats:
+    """
+    Accumulates per-channel peak, RMS and clipping counts, and EBU R128 integrated loudness,
+    over blocks of samples as they stream past.
+
+    Loudness needs scipy for the K-weighting filter.
+
+    Example:
+        stats = AudioStats(info.channels, info.sample_rate, clip_level=clip_level(info))
+        for raw in read_frames(path, info=info):
+            stats.update(decode(raw, info))
+        stats.result()
+
+    :param channels: Number of channels.
+    :type channels: int
+    :param sample_rate: Sample rate in Hz.
+    :type sample_rate: int
+    :param clip_level: Absolute sample value counted as clipped, defaults to 1.0.
+    :type clip_level: float, optional
+    :param loudness: Measure integrated loudness, defaults to True.
+    :type loudness: bool, optional
+    """
+
+    def __init__(self, channels:int, sample_rate:int, clip_level:float=1.0, loudness:bool=True):
+        import numpy as np
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.clip_level = clip_level
+        self.samples = 0
+        self._peak = np.zeros(channels)
+        self._sum_squares = np.zeros(channels)
+        self._clipped = np.zeros(channels, dtype=np.int64)
+        self._loudness = loudness
+        if loudness:
+            try:
+                from scipy.signal import sosfilt
+            except ModuleNotFoundError:
+                raise ModuleNotFoundError("AudioStats: missing dependency 'scipy' for loudness measurement.")
+            self._sosfilt = sosfilt
+            self._sos = np.array(_k_weighting(sample_rate))
+            self._zi = np.zeros((len(self._sos), 2, channels))
+            # 400 ms gating blocks overlap by 75%, so mean squares are kept per 100 ms step
+            self._step = int(round(sample_rate * 0.1))
+            self._pending = np.zeros((0, channels))
+            self._steps = []
+
+    def update(self, samples) -> None:
+        """
+        Adds a block of samples, a float array of shape (frames, channels) scaled to [-1.0, 1.0).
+        """
+        import numpy as np
+        if not len(samples):
+            return
+        magnitude = np.abs(samples)
+        np.maximum(self._peak, magnitude.max(axis=0), out=self._peak)
+        self._sum_squares += np.einsum('ij,ij->j', samples, samples)
+        self._clipped += np.count_nonzero(magnitude >= self.clip_level, axis=0)
+        self.samples += len(samples)
+        if self._loudness:
+            weighted, self._zi = self._sosfilt(self._sos, samples, axis=0, zi=self._zi)
+            weighted = np.concatenate([self._pending, weighted]) if len(self._pending) else weighted
+            steps = len(weighted) // self._step
+            if steps:
+                squares = (weighted[:steps * self._step] ** 2).reshape(steps, self._step, self.channels)
+                self._steps.append(squares.mean(axis=1))
+            self._pending = weighted[steps * self._step:]
+
+    def integrated_loudness(self) -> Optional[float]:
+        """
+        Gated integrated loudness in LUFS, None if disabled or shorter than one 400 ms block.
+        """
+        import numpy as np
+        if not self._loudness or not self._steps:
+            return None
+        steps = np.concatenate(self._steps)
+        if len(steps) < 4:
+            return None
+        # mean square of each 400 ms block from its four 100 ms steps
+        cumulative = np.concatenate([np.zeros((1, self.channels)), np.cumsum(steps, axis=0)])
+        blocks = (cumulative[4:] - cumulative[:-4]) / 4
+        weights = np.array(_channel_weights(self.channels))
+        power = blocks @ weights
+        with np.errstate(divide='ignore'):
+            block_loudness = _LOUDNESS_OFFSET + 10 * np.log10(power)
+        gated = block_loudness > ABSOLUTE_GATE
+        if not gated.any():
+            return None
+        relative = _LOUDNESS_OFFSET + 10 * math.log10(power[gated].mean()) + RELATIVE_GATE
+        gated &= block_loudness > relative
+        return _LOUDNESS_OFFSET + 10 * math.log10(power[gated].mean())
+
+    def result(self) -> Dict[str, Any]:
+        """
+        Returns the statistics so far. Per-channel values are lists in channel order, levels are in dBFS.
+
+        :return: samples, peak, peak_db, rms, rms_db, clipped and integrated_loudness (LUFS).
+        :rtype: dict
+        """
+        import numpy as np
+        rms = np.sqrt(self._sum_squares / self.samples) if self.samples else np.zeros(self.channels)
+        with np.errstate(divide='ignore'):
+            return {
+                'samples': self.samples,
+                'peak': self._peak.tolist(),
+                'peak_db': (20 * np.log10(self._peak)).tolist(),
+                'rms': rms.tolist(),
+                'rms_db': (20 * np.log10(rms)).tolist(),
+                'clipped': self._clipped.tolist(),
+                'integrated_loudness': self.integrated_loudness(),
+            }
+
+
+def clip_level(info) -> float:
+    """
+    The largest positive sample value of a wav layout, scaled to [-1.0, 1.0); samples at or beyond it count as clipped.
+    """
+    if info.is_float:
+        return 1.0
+    full_scale = 1 << (8 * info.sample_width - 1)
+    return (full_scale - 1) / full_scale
+
+
+def analyze_wav(path:str, loudness:bool=True) -> Dict[str, Any]:
+    """
+    Reads a wav file once and returns its statistics, see AudioStats.result.
+
+    :param path: The wav file.
+    :type path: str
+    :param loudness: Measure integrated loudness, defaults to True.
+    :type loudness: bool, optional
+    :return: The statistics.
+    :rtype: dict
+    """
+    info = read_wav_info(path)
+    stats = AudioStats(info.channels, info.sample_rate, clip_level(info), loudness)
+    for raw in read_frames(path, info=info):
+        stats.update(decode(raw, info))
+    return stats.result()
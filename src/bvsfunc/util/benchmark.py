@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+
+import argparse
+import itertools
+import sys
+import threading
+import time
+from typing import *
+
+import vapoursynth as vs
+
+core = vs.core
+
+# Named formats accepted by the benchmark. Bit depth is the interesting axis,
+# so only 4:2:0 is covered.
+BENCH_FORMATS = {
+    '8': vs.YUV420P8,
+    '16': vs.YUV420P16,
+    '32': vs.YUV420PS,
+}
+
+BENCH_RESOLUTIONS = {
+    '720p': (1280, 720),
+    '1080p': (1920, 1080),
+    '2160p': (3840, 2160),
+}
+
+#######################
+#  clip construction  #
+#######################
+
+def synthetic_clip(width:int=1920, height:int=1080, format:int=vs.YUV420P16, length:int=240,
+                   noise:bool=True, fpsnum:int=24000, fpsden:int=1001) -> vs.VideoNode:
+    """
+    Builds a reproducible synthetic clip to drive filters with.
+
+    A plain BlankClip is constant and lets filters (and the frame cache) take shortcuts,
+    so by default per-frame grain is added with core.grain.Add. The grain seed is fixed,
+    so two runs with the same arguments see identical frames.
+
+    :param width: Clip width, defaults to 1920.
+    :type width: int
+    :param height: Clip height, defaults to 1080.
+    :type height: int
+    :param format: VapourSynth format id, defaults to vs.YUV420P16.
+    :type format: int
+    :param length: Number of frames, defaults to 240.
+    :type length: int
+    :param noise: Add per-frame grain, defaults to True. Requires the AddGrain plugin.
+    :type noise: bool
+    :return: The synthetic clip.
+    :rtype: VideoNode
+    """
+    clip = core.std.BlankClip(width=width, height=height, format=format, length=length,
+                              fpsnum=fpsnum, fpsden=fpsden, color=_mid_grey(format), keep=False)
+    if noise:
+        if not hasattr(core, 'grain'):
+            raise ValueError("synthetic_clip: noise requires the AddGrain plugin (core.grain). Pass noise=False to benchmark on flat clips.")
+        clip = core.grain.Add(clip, var=40.0, uvar=10.0, seed=1, constant=False)
+    return clip
+
+def _get_format(format):
+    # get_format is API3 only, get_video_format its R55+ replacement
+    return (getattr(core, 'get_video_format', None) or core.get_format)(format)
+
+def _mid_grey(format):
+    fmt = _get_format(format)
+    if fmt.sample_type == vs.FLOAT:
+        return [0.5, 0.0, 0.0]
+    mid = 1 << (fmt.bits_per_sample - 1)
+    return [mid, mid, mid]
+
+###########################
+#  measurement functions  #
+###########################
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def _current_rss():
+    try:
+        import psutil
+    except ModuleNotFoundError:
+        return None
+    return psutil.Process().memory_info().rss
+
+def _peak_rss():
+    try:
+        import resource
+    except ModuleNotFoundError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class _MemorySampler(threading.Thread):
+    """Polls the process RSS while frames are being rendered, as VapourSynth allocates outside of Python."""
+
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = _current_rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            rss = _current_rss()
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.peak
+
+def render_frames(clip:vs.VideoNode, frames:Optional[int]=None, requests:Optional[int]=None) -> Dict[str, Any]:
+    """
+    Pulls frames from a clip through get_frame_async and measures throughput.
+
+    At most `requests` frames are in flight at once. Every frame is requested exactly once,
+    in order, so the frame cache cannot serve repeats.
+
+    :param clip: Clip to render.
+    :type clip: VideoNode
+    :param frames: Number of frames to render, defaults to the whole clip.
+    :type frames: int, optional
+    :param requests: Maximum concurrent frame requests, defaults to core.num_threads.
+    :type requests: int, optional
+    :return: A dict with frames, seconds, fps, latency percentiles (ms) and peak memory (bytes, None if unknown).
+    :rtype: dict
+    """
+    frames = clip.num_frames if frames is None else min(frames, clip.num_frames)
+    requests = core.num_threads if requests is None else max(1, requests)
+
+    latencies = [None] * frames
+    errors = []
+    in_flight = threading.Semaphore(requests)
+    finished = threading.Event()
+    remaining = [frames]
+    lock = threading.Lock()
+
+    def _done(n, started, future):
+        latencies[n] = time.perf_counter() - started
+        if future.exception() is not None:
+            errors.append(future.exception())
+        in_flight.release()
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                finished.set()
+
+    sampler = _MemorySampler()
+    sampler.start()
+    start = time.perf_counter()
+    for n in range(frames):
+        in_flight.acquire()
+        if errors:
+            break
+        requested = time.perf_counter()
+        future = clip.get_frame_async(n)
+        future.add_done_callback(lambda fut, n=n, requested=requested: _done(n, requested, fut))
+    if frames and not errors:
+        finished.wait()
+    elapsed = time.perf_counter() - start
+    peak = sampler.stop()
+    if errors:
+        raise errors[0]
+
+    latencies_ms = [lat * 1000 for lat in latencies if lat is not None]
+    return {
+        'frames': frames,
+        'seconds': elapsed,
+        'fps': frames / elapsed if elapsed else None,
+        'latency_p50': _percentile(latencies_ms, 50),
+        'latency_p90': _percentile(latencies_ms, 90),
+        'latency_p99': _percentile(latencies_ms, 99),
+        'peak_memory': peak if peak is not None else _peak_rss(),
+    }
+
+def benchmark_filter(filter_func:Callable[..., vs.VideoNode],
+                     formats:Sequence[int]=(vs.YUV420P8, vs.YUV420P16, vs.YUV420PS),
+                     resolutions:Sequence[Tuple[int, int]]=((1920, 1080),),
+                     threads:Sequence[Optional[int]]=(None,),
+                     cache_sizes:Sequence[Optional[int]]=(None,),
+                     frames:int=100,
+                     requests:Optional[int]=None,
+                     noise:bool=True,
+                     warmup:int=2,
+                     **filter_args) -> List[Dict[str, Any]]:
+    """
+    Runs a filter over every combination of format, resolution, thread count and cache size.
+
+    core.num_threads and core.max_cache_size are restored after the run.
+
+    Example:
+        results = benchmark_filter(bvs.mods.DescaleAAMod, formats=[vs.YUV420P16], h=720, frames=200)
+
+    :param filter_func: Callable taking a clip as its first argument and returning a clip.
+    :type filter_func: callable
+    :param formats: Format ids to test, defaults to 8-bit, 16-bit and float 4:2:0.
+    :type formats: list
+    :param resolutions: (width, height) pairs to test, defaults to 1080p.
+    :type resolutions: list
+    :param threads: core.num_threads values, None keeps the current setting.
+    :type threads: list
+    :param cache_sizes: core.max_cache_size values in MB, None keeps the current setting.
+    :type cache_sizes: list
+    :param frames: Frames to render per run, defaults to 100.
+    :type frames: int
+    :param requests: Maximum concurrent frame requests, defaults to the thread count.
+    :type requests: int, optional
+    :param noise: Use grained clips instead of flat ones, defaults to True.
+    :type noise: bool
+    :param warmup: Frames rendered (and discarded) before timing, defaults to 2.
+    :type warmup: int
+    :param filter_args: Passed to filter_func.
+    :return: One result dict per combination, see render_frames.
+    :rtype: list
+    """
+    old_threads = core.num_threads
+    old_cache = core.max_cache_size
+    results = []
+    try:
+        for format, (width, height), num_threads, cache_size in itertools.product(formats, resolutions, threads, cache_sizes):
+            core.num_threads = old_threads if num_threads is None else num_threads
+            core.max_cache_size = old_cache if cache_size is None else cache_size
+            src = synthetic_clip(width, height, format, length=frames + warmup, noise=noise)
+            clip = filter_func(src, **filter_args)
+            for n in range(min(warmup, clip.num_frames)):
+                clip.get_frame(clip.num_frames - 1 - n)
+            result = render_frames(clip, frames, requests)
+            result.update({
+                'format': _get_format(format).name,
+                'width': width,
+                'height': height,
+                'threads': core.num_threads,
+                'max_cache_size': core.max_cache_size,
+            })
+            results.append(result)
+    finally:
+        core.num_threads = old_threads
+        core.max_cache_size = old_cache
+    return results
+
+def luma_psnr(clip:vs.VideoNode, reference:vs.VideoNode, frames:Optional[int]=None) -> float:
+    """
+    Mean luma PSNR of a clip against a reference, in dB. Both are compared as 32-bit float.
+
+    :param clip: Clip to measure.
+    :type clip: VideoNode
+    :param reference: Reference clip with the same dimensions.
+    :type reference: VideoNode
+    :param frames: Number of frames to compare, defaults to the whole clip.
+    :type frames: int, optional
+    :return: The PSNR, inf for identical clips.
+    :rtype: float
+    """
+    import math
+    frames = clip.num_frames if frames is None else min(frames, clip.num_frames)
+    a = core.resize.Point(core.std.ShufflePlanes(clip, 0, vs.GRAY), format=vs.GRAYS)
+    b = core.resize.Point(core.std.ShufflePlanes(reference, 0, vs.GRAY), format=vs.GRAYS)
+    sqdiff = core.std.PlaneStats(core.std.Expr([a, b], 'x y - dup *'))
+    mse = sum(sqdiff.get_frame(n).props['PlaneStatsAverage'] for n in range(frames)) / frames
+    return math.inf if mse == 0 else 10 * math.log10(1 / mse)
+
+def compare_variants(filter_func:Callable[..., vs.VideoNode],
+                     variants:Dict[str, Dict[str, Any]],
+                     reference:Optional[str]=None,
+                     format:int=vs.YUV420P16,
+                     resolution:Tuple[int, int]=(1920, 1080),
+                     frames:int=100,
+                     quality_frames:int=10,
+                     requests:Optional[int]=None,
+                     noise:bool=True,
+                     **filter_args) -> List[Dict[str, Any]]:
+    """
+    Benchmarks several argument sets of one filter on the same clip and measures their
+    luma PSNR against a reference variant.
+
+    Example:
+        compare_variants(bvs.mods.DescaleAAMod,
+                         {'default': {}, 'int16': {'precision': 'int16'}, 'float': {'precision': 'float'}},
+                         reference='float', h=720)
+
+    :param filter_func: Callable taking a clip as its first argument and returning a clip.
+    :type filter_func: callable
+    :param variants: Variant name to keyword arguments, applied on top of filter_args.
+    :type variants: dict
+    :param reference: Variant the others are compared against, defaults to the first one.
+    :type reference: str, optional
+    :param format: Format id of the test clip, defaults to vs.YUV420P16.
+    :type format: int
+    :param resolution: (width, height) of the test clip, defaults to 1080p.
+    :type resolution: tuple
+    :param frames: Frames to render for timing, defaults to 100.
+    :type frames: int
+    :param quality_frames: Frames to compare for PSNR, defaults to 10.
+    :type quality_frames: int
+    :return: One result dict per variant, see render_frames, with 'variant' and 'psnr' added.
+    :rtype: list
+    """
+    reference = next(iter(variants)) if reference is None else reference
+    src = synthetic_clip(*resolution, format, length=frames, noise=noise)
+    clips = {name: filter_func(src, **{**filter_args, **args}) for name, args in variants.items()}
+    results = []
+    for name, clip in clips.items():
+        result = render_frames(clip, frames, requests)
+        result.update({
+            'variant': name,
+            'format': src.format.name,
+            'width': src.width,
+            'height': src.height,
+            'threads': core.num_threads,
+            'max_cache_size': core.max_cache_size,
+            'psnr': luma_psnr(clip, clips[reference], quality_frames),
+        })
+        results.append(result)
+    return results
+
+######################
+#  output functions  #
+######################
+
+_COLUMNS = [
+    ('variant', '{}'),
+    ('format', '{}'),
+    ('width', '{}'),
+    ('height', '{}'),
+    ('threads', '{}'),
+    ('max_cache_size', '{}'),
+    ('fps', '{:.2f}'),
+    ('latency_p50', '{:.1f}'),
+    ('latency_p90', '{:.1f}'),
+    ('latency_p99', '{:.1f}'),
+    ('peak_memory', '{}'),
+    ('psnr', '{:.2f}'),
+]
+
+def format_results(results:List[Dict[str, Any]]) -> str:
+    """
+    Formats benchmark results as a plain text table. Latencies are in ms, memory in MiB, PSNR in dB.
+
+    :param results: Output of benchmark_filter or compare_variants.
+    :type results: list
+    :return: The table.
+    :rtype: str
+    """
+    columns = [(name, fmt) for name, fmt in _COLUMNS if any(name in result for result in results)]
+    rows = [[name for name, _ in columns]]
+    for result in results:
+        row = []
+        for name, fmt in columns:
+            value = result.get(name)
+            if value is None:
+                row.append('-')
+            elif name == 'peak_memory':
+                row.append(str(value // (1024 * 1024)))
+            else:
+                row.append(fmt.format(value))
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return '\n'.join('  '.join(cell.rjust(widths[i]) for i, cell in enumerate(row)) for row in rows)
+
+def _parse_value(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    if value in ('True', 'False', 'None'):
+        return {'True': True, 'False': False, 'None': None}[value]
+    return value
+
+def _parse_filter_args(pairs):
+    filter_args = {}
+    for pair in pairs or []:
+        key, sep, value = pair.partition('=')
+        if not sep:
+            raise SystemExit(f"filter arguments must be key=value, got '{pair}'")
+        filter_args[key] = _parse_value(value)
+    return filter_args
+
+def _main():
+    parser = argparse.ArgumentParser(description="Benchmark a bvsfunc.mods filter on synthetic clips.")
+    parser.add_argument("-f", "--filter",
+                        default="DescaleAAMod",
+                        help="Name of the filter in bvsfunc.mods (default: %(default)s)",
+                        action="store")
+    parser.add_argument("-a", "--arg",
+                        default=None, dest="filter_args",
+                        help="Filter argument as key=value, can be repeated",
+                        action="append")
+    parser.add_argument("-b", "--bits",
+                        default=list(BENCH_FORMATS), nargs="+", choices=list(BENCH_FORMATS),
+                        help="Bit depths to test (default: %(default)s)")
+    parser.add_argument("-r", "--resolution",
+                        default=['1080p'], nargs="+", choices=list(BENCH_RESOLUTIONS),
+                        help="Resolutions to test (default: %(default)s)")
+    parser.add_argument("-t", "--threads",
+                        default=[None], nargs="+", type=int,
+                        help="core.num_threads values to test (default: current)")
+    parser.add_argument("-c", "--cache",
+                        default=[None], nargs="+", type=int,
+                        help="core.max_cache_size values in MB to test (default: current)")
+    parser.add_argument("-n", "--frames",
+                        default=100, type=int,
+                        help="Frames to render per run (default: %(default)s)")
+    parser.add_argument("--requests",
+                        default=None, type=int,
+                        help="Maximum concurrent frame requests (default: thread count)")
+    parser.add_argument("--compare",
+                        default=None, metavar="KEY=V1,V2,...",
+                        help="Compare values of one filter argument on the first bit depth and resolution, "
+                             "with PSNR against the last value (ie. precision=None,int16,float)",
+                        action="store")
+    parser.add_argument("--no-noise",
+                        action="store_true", default=False,
+                        help="Benchmark on flat BlankClips instead of grained ones")
+    args = parser.parse_args()
+
+    from .. import mods
+    filter_func = getattr(mods, args.filter, None)
+    if filter_func is None:
+        raise SystemExit(f"bvsfunc.mods has no filter named '{args.filter}'")
+
+    if args.compare:
+        key, _, values = args.compare.partition('=')
+        variants = {value: {key: _parse_value(value)} for value in values.split(',')}
+        results = compare_variants(filter_func, variants,
+                                   reference=list(variants)[-1],
+                                   format=BENCH_FORMATS[args.bits[0]],
+                                   resolution=BENCH_RESOLUTIONS[args.resolution[0]],
+                                   frames=args.frames,
+                                   requests=args.requests,
+                                   noise=not args.no_noise,
+                                   **_parse_filter_args(args.filter_args))
+        print(format_results(results))
+        return
+
+    results = benchmark_filter(filter_func,
+                               formats=[BENCH_FORMATS[bits] for bits in args.bits],
+                               resolutions=[BENCH_RESOLUTIONS[res] for res in args.resolution],
+                               threads=args.threads,
+                               cache_sizes=args.cache,
+                               frames=args.frames,
+                               requests=args.requests,
+                               noise=not args.no_noise,
+                               **_parse_filter_args(args.filter_args))
+    print(format_results(results))
+
+if __name__ == "__main__":
+    _main()
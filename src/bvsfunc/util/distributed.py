@@ -0,0 +1,491 @@
+#!/usr/bin/env python
+
+import argparse
+import hmac
+import ipaddress
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import *
+
+# header carrying the shared token, and the environment variable the commandline reads it from
+TOKEN_HEADER = 'X-AudioProcessor-Token'
+TOKEN_ENV = 'AUDIOPROCESSOR_TOKEN'
+
+# task states
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _is_loopback(host):
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(address.split('%')[0]).is_loopback for address in addresses)
+
+
+class _Task:
+    def __init__(self, task_id, request):
+        self.task_id = task_id
+        self.request = request
+        self.state = PENDING
+        self.worker = None
+        self.expires = None
+        self.attempts = []
+        self.outputs = None
+
+    def status(self):
+        return {
+            'task_id': self.task_id,
+            'state': self.state,
+            'worker': self.worker,
+            'attempts': self.attempts,
+            'outputs': self.outputs,
+        }
+
+
+class Coordinator:
+    """
+    Hands the requests of an AudioProcessor batch out to workers over HTTP.
+
+    Workers lease one request at a time and must report back, or renew the lease, before it expires.
+    A failed or expired attempt puts the request back in the queue, where it goes to a worker that has not
+    tried it yet if one asks, until it has failed max_attempts times.
+
+    Inputs and outputs are not transferred: every machine must see the files under the paths in the requests,
+    e.g. through a network share.
+
+    Workers run whatever requests they are handed, so only the local machine can reach a coordinator by default.
+    Listening on any other address requires a token, which every request must then carry in the
+    X-AudioProcessor-Token header. Requests without it are refused with 401.
+
+    Endpoints, all json:
+        POST /lease       {worker} -> {task_id, request}, or {task_id: null, finished}
+        POST /renew       {worker, task_id}
+        POST /complete    {worker, task_id, outputs, seconds}
+        POST /fail        {worker, task_id, error, seconds}
+        GET  /status      -> {tasks, counts}
+
+    :param requests: The batch, a list of video_source arguments as for AudioProcessor --batch.
+        A request with an mpls_dict key is run as mpls_source.
+    :type requests: list of dicts
+    :param host: Address to listen on, defaults to '127.0.0.1'. Use '0.0.0.0' and a token to serve other machines.
+    :type host: str, optional
+    :param port: Port to listen on, defaults to 8765. 0 picks a free port.
+    :type port: int, optional
+    :param lease_timeout: Seconds a worker may hold a request without renewing its lease, defaults to 300.
+    :type lease_timeout: float, optional
+    :param max_attempts: Attempts before a request is given up on, defaults to 3.
+    :type max_attempts: int, optional
+    :param token: Secret shared with the workers. Required unless host is a loopback address, defaults to None.
+    :type token: str, optional
+    """
+
+    def __init__(self, requests:List[Dict[str, Any]], host:str='127.0.0.1', port:int=8765,
+                 lease_timeout:float=300.0, max_attempts:int=3, token:Optional[str]=None):
+        if not token and not _is_loopback(host):
+            raise ValueError(f"Coordinator: listening on '{host}' lets other machines hand out requests; "
+                             f"set a token (or {TOKEN_ENV} on the commandline) to require it from workers.")
+        self.token = token or None
+        self.tasks = [_Task(task_id, request) for task_id, request in enumerate(requests)]
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._server.server_address[:2]
+
+    @property
+    def url(self) -> str:
+        host, port = self.address
+        if host in ('0.0.0.0', ''):
+            host = socket.gethostname()
+        return f"http://{host}:{port}"
+
+    ######################
+    #  task functions    #
+    ######################
+
+    def _expire(self, now):
+        for task in self.tasks:
+            if task.state == LEASED and task.expires < now:
+                task.attempts[-1] |= {'result': 'expired'}
+                self._requeue(task)
+
+    def _requeue(self, task):
+        failures = sum(1 for attempt in task.attempts if attempt['result'] != 'done')
+        task.state = FAILED if failures >= self.max_attempts else PENDING
+        task.worker = None
+        task.expires = None
+        self._changed.notify_all()
+
+    def _finished(self):
+        return all(task.state in (DONE, FAILED) for task in self.tasks)
+
+    def lease(self, worker:str) -> Dict[str, Any]:
+        with self._lock:
+            now = time.time()
+            self._expire(now)
+            pending = [task for task in self.tasks if task.state == PENDING]
+            if not pending:
+                return {'task_id': None, 'finished': self._finished()}
+            # retries go to a worker that has not tried the request yet, if possible
+            fresh = [task for task in pending if worker not in {attempt['worker'] for attempt in task.attempts}]
+            task = (fresh or pending)[0]
+            task.state = LEASED
+            task.worker = worker
+            task.expires = now + self.lease_timeout
+            task.attempts.append({'worker': worker, 'started': now, 'result': 'running'})
+            return {'task_id': task.task_id, 'request': task.request, 'lease_timeout': self.lease_timeout}
+
+    def _attempt(self, worker, task_id):
+        if not isinstance(task_id, int) or not 0 <= task_id < len(self.tasks):
+            return None, None
+        task = self.tasks[task_id]
+        if task.state != LEASED or task.worker != worker:
+            # the lease expired and the request moved on; the report is stale
+            return task, None
+        return task, task.attempts[-1]
+
+    def renew(self, worker:str, task_id:int) -> Dict[str, Any]:
+        with self._lock:
+            task, attempt = self._attempt(worker, task_id)
+            if attempt is None:
+                return {'ok': False}
+            task.expires = time.time() + self.lease_timeout
+            return {'ok': True}
+
+    def complete(self, worker:str, task_id:int, outputs:List[str], seconds:float) -> Dict[str, Any]:
+        with self._lock:
+            task, attempt = self._attempt(worker, task_id)
+            if attempt is None:
+                return {'ok': False}
+            attempt |= {'result': 'done', 'seconds': seconds}
+            task.state = DONE
+            task.outputs = outputs
+            task.expires = None
+            self._changed.notify_all()
+            return {'ok': True}
+
+    def fail(self, worker:str, task_id:int, error:str, seconds:float) -> Dict[str, Any]:
+        with self._lock:
+            task, attempt = self._attempt(worker, task_id)
+            if attempt is None:
+                return {'ok': False}
+            attempt |= {'result': 'failed', 'error': error, 'seconds': seconds}
+            self._requeue(task)
+            return {'ok': True}
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            self._expire(time.time())
+            counts = {state: 0 for state in (PENDING, LEASED, DONE, FAILED)}
+            for task in self.tasks:
+                counts[task.state] += 1
+            return {'tasks': [task.status() for task in self.tasks], 'counts': counts}
+
+    ######################
+    #  server functions  #
+    ######################
+
+    def _handler(self):
+        coordinator = self
+        routes = {
+            '/lease': lambda body: coordinator.lease(body['worker']),
+            '/renew': lambda body: coordinator.renew(body['worker'], body['task_id']),
+            '/complete': lambda body: coordinator.complete(body['worker'], body['task_id'],
+                                                           body.get('outputs'), body.get('seconds')),
+            '/fail': lambda body: coordinator.fail(body['worker'], body['task_id'],
+                                                   body.get('error'), body.get('seconds')),
+        }
+
+        class _Handler(BaseHTTPRequestHandler):
+            def _authorized(self):
+                if coordinator.token is None:
+                    return True
+                if hmac.compare_digest(self.headers.get(TOKEN_HEADER, '').encode(), coordinator.token.encode()):
+                    return True
+                self._reply(401, {'error': f"missing or wrong {TOKEN_HEADER}"})
+                return False
+
+            def _reply(self, code, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if not self._authorized():
+                    return
+                if self.path == '/status':
+                    self._reply(200, coordinator.status())
+                else:
+                    self._reply(404, {'error': f"unknown endpoint {self.path}"})
+
+            def do_POST(self):
+                if not self._authorized():
+                    return
+                if self.path not in routes:
+                    self._reply(404, {'error': f"unknown endpoint {self.path}"})
+                    return
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                    self._reply(200, routes[self.path](body))
+                except (KeyError, TypeError, json.JSONDecodeError) as e:
+                    self._reply(400, {'error': repr(e)})
+
+            def log_message(self, format, *args):
+                pass
+
+        return _Handler
+
+    def start(self) -> None:
+        """Starts serving in a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout:Optional[float]=None, poll:float=1.0) -> bool:
+        """
+        Blocks until every request is done or has failed max_attempts times.
+
+        :return: True if finished, False on timeout.
+        :rtype: bool
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while not self._finished():
+                # expired leases need a clock, not a notification
+                self._expire(time.time())
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(poll if remaining is None else min(poll, remaining))
+        return True
+
+    def stop(self) -> None:
+        # shutdown waits for serve_forever to return, so it would block forever if serving never started
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+        self._server.server_close()
+
+
+def _headers(token):
+    return {TOKEN_HEADER: token} if token else {}
+
+
+def _post(url, endpoint, payload, token=None, timeout=30):
+    request = urllib.request.Request(url.rstrip('/') + endpoint, data=json.dumps(payload).encode(),
+                                     headers={'Content-Type': 'application/json', **_headers(token)}, method='POST')
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def _get(url, endpoint, token=None, timeout=30):
+    request = urllib.request.Request(url.rstrip('/') + endpoint, headers=_headers(token))
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def run_request(request:Dict[str, Any], overwrite:bool=False, silent:bool=True, jobs:int=1) -> List[str]:
+    """
+    Runs one batch request through an AudioPlan, the way AudioProcessor --batch does.
+
+    :return: The filepaths of the request's final processed files.
+    :rtype: list
+    """
+    from .planner import AudioPlan
+    plan = AudioPlan(overwrite=overwrite, silent=silent)
+    request = dict(request)
+    if 'mpls_dict' in request:
+        mpls_dict = request.pop('mpls_dict')
+        if 'clip' in mpls_dict:
+            mpls_dict = dict(mpls_dict, clip=[clip.encode() if isinstance(clip, str) else clip for clip in mpls_dict['clip']])
+        plan.add_mpls_source(mpls_dict, **request)
+    else:
+        plan.add_video_source(**request)
+    return plan.run(jobs=jobs)[0]
+
+
+class Worker:
+    """
+    Leases requests from a Coordinator and runs them until the batch is finished.
+
+    :param url: The coordinator, e.g. 'http://render01:8765'.
+    :type url: str
+    :param name: Name reported to the coordinator, defaults to host name and process id.
+    :type name: str, optional
+    :param run: Runs one request and returns its output files, defaults to run_request.
+    :type run: callable, optional
+    :param poll: Seconds to wait before asking again when every request is leased, defaults to 5.
+    :type poll: float, optional
+    :param retries: Consecutive failed attempts to reach the coordinator before giving up, defaults to 12.
+    :type retries: int, optional
+    :param token: The coordinator's token, sent with every request, defaults to None.
+    :type token: str, optional
+    """
+
+    def __init__(self, url:str, name:Optional[str]=None, run:Optional[Callable[[Dict[str, Any]], List[str]]]=None,
+                 poll:float=5.0, retries:int=12, token:Optional[str]=None):
+        self.url = url
+        self.token = token
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.run_task = run or run_request
+        self.poll = poll
+        self.retries = retries
+        self.completed = 0
+        self.failed = 0
+
+    def _renew(self, task_id, interval, stop):
+        while not stop.wait(interval):
+            try:
+                _post(self.url, '/renew', {'worker': self.name, 'task_id': task_id}, self.token)
+            except (urllib.error.URLError, OSError):
+                pass
+
+    def run_one(self) -> Optional[bool]:
+        """
+        Leases and runs one request.
+
+        :return: True if a request was run, False if none was free, None once the batch is finished.
+        :rtype: bool or None
+        """
+        lease = _post(self.url, '/lease', {'worker': self.name}, self.token)
+        if lease['task_id'] is None:
+            return None if lease['finished'] else False
+        task_id = lease['task_id']
+        stop = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(task_id, lease['lease_timeout'] / 3, stop), daemon=True)
+        renewer.start()
+        started = time.perf_counter()
+        try:
+            outputs = self.run_task(lease['request'])
+        except BaseException as e:
+            stop.set()
+            error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+            _post(self.url, '/fail', {'worker': self.name, 'task_id': task_id, 'error': error,
+                                      'seconds': time.perf_counter() - started}, self.token)
+            self.failed += 1
+            if isinstance(e, KeyboardInterrupt):
+                raise
+            return True
+        stop.set()
+        _post(self.url, '/complete', {'worker': self.name, 'task_id': task_id, 'outputs': outputs,
+                                      'seconds': time.perf_counter() - started}, self.token)
+        self.completed += 1
+        return True
+
+    def run(self) -> bool:
+        """
+        Runs requests until the coordinator reports the batch finished.
+
+        :return: True if the batch finished, False if the coordinator could not be reached.
+        :rtype: bool
+        :raises urllib.error.HTTPError: The coordinator refused the token.
+        """
+        unreachable = 0
+        while True:
+            try:
+                result = self.run_one()
+            except (urllib.error.URLError, OSError) as e:
+                # a refused token is refused again on every retry
+                if isinstance(e, urllib.error.HTTPError) and e.code == 401:
+                    raise
+                unreachable += 1
+                if unreachable >= self.retries:
+                    return False
+                time.sleep(self.poll)
+                continue
+            unreachable = 0
+            if result is None:
+                return True
+            if result is False:
+                time.sleep(self.poll)
+
+
+def format_status(status:Dict[str, Any]) -> str:
+    """
+    Formats Coordinator.status as a table, one row per request with its attempts and their timings.
+    """
+    lines = [f"{'task':>4}  {'state':<8} {'attempts':>8}  {'seconds':>8}  worker / error"]
+    for task in status['tasks']:
+        last = task['attempts'][-1] if task['attempts'] else {}
+        seconds = f"{last['seconds']:.1f}" if last.get('seconds') is not None else '-'
+        detail = last.get('error') or last.get('worker') or ''
+        lines.append(f"{task['task_id']:>4}  {task['state']:<8} {len(task['attempts']):>8}  {seconds:>8}  {detail}")
+    counts = status['counts']
+    lines.append(', '.join(f"{count} {state}" for state, count in counts.items()))
+    return '\n'.join(lines)
+
+
+def _main():
+    parser = argparse.ArgumentParser(
+        description="Runs AudioProcessor batches across several machines. Every machine must see the same file paths.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    coordinate = subparsers.add_parser('coordinator', help="Serve a batch to workers and wait for it to finish.")
+    coordinate.add_argument("batch",
+                            help="A json file with a list of requests, each an object of video_source arguments.")
+    coordinate.add_argument("--host", default='127.0.0.1',
+                            help="Address to listen on. Any but a loopback address needs a token. (default: %(default)s)")
+    coordinate.add_argument("--port", default=8765, type=int, help="Port to listen on. (default: %(default)s)")
+    coordinate.add_argument("--lease_timeout", "--lease-timeout", default=300.0, type=float,
+                            help="Seconds before an unrenewed lease expires and its request is retried. (default: %(default)s)")
+    coordinate.add_argument("--max_attempts", "--max-attempts", default=3, type=int,
+                            help="Attempts before a request is given up on. (default: %(default)s)")
+    work = subparsers.add_parser('worker', help="Run requests from a coordinator.")
+    work.add_argument("url", help="The coordinator, e.g. http://render01:8765")
+    work.add_argument("--name", default=None, help="Name reported to the coordinator. (default: host:pid)")
+    work.add_argument("-j", "--jobs", default=1, type=int, help="Number of stages to run at once. (default: %(default)s)")
+    work.add_argument("--overwrite", action="store_true", default=False,
+                      help="Overwrite existing files. (default: %(default)s)")
+    work.add_argument("--silent", action="store_true", default=False,
+                      help="Silence eac3to, ffmpeg, flac, and qaac. (default: %(default)s)")
+    status = subparsers.add_parser('status', help="Print the progress of a coordinator.")
+    status.add_argument("url", help="The coordinator, e.g. http://render01:8765")
+    for subparser in (coordinate, work, status):
+        subparser.add_argument("--token", default=os.environ.get(TOKEN_ENV),
+                               help=f"Secret shared by the coordinator and its workers. (default: ${TOKEN_ENV})")
+    args = parser.parse_args()
+
+    if args.command == 'coordinator':
+        with open(args.batch) as f:
+            requests = json.load(f)
+        coordinator = Coordinator(requests, args.host, args.port, args.lease_timeout, args.max_attempts, args.token)
+        coordinator.start()
+        print(f"AudioProcessor: serving {len(requests)} requests at {coordinator.url}")
+        try:
+            coordinator.wait()
+            # idle workers are polling; give them time to hear the batch is finished
+            time.sleep(10)
+        finally:
+            print(format_status(coordinator.status()))
+            coordinator.stop()
+        if coordinator.status()['counts'][FAILED]:
+            raise SystemExit(1)
+    elif args.command == 'worker':
+        run = lambda request: run_request(request, args.overwrite, args.silent, args.jobs)
+        worker = Worker(args.url, args.name, run, token=args.token)
+        finished = worker.run()
+        print(f"AudioProcessor: {worker.name} {'finished' if finished else 'lost the coordinator'}, "
+              f"{worker.completed} completed, {worker.failed} failed")
+    else:
+        print(format_status(_get(args.url, '/status', args.token)))
+
+if __name__ == "__main__":
+    _main()
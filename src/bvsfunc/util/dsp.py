@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+import math
+from typing import *
+
+from . import wavio
+from .wavio import WAVE_FORMAT_IEEE_FLOAT, WavInfo, decode, encode, read_frames, read_wav_info
+
+_C = 1 / math.sqrt(2)
+
+# WAVE_FORMAT_EXTENSIBLE speaker bits, in the order the channels are stored
+SPEAKERS = {
+    'FL': 0x1, 'FR': 0x2, 'FC': 0x4, 'LFE': 0x8, 'BL': 0x10, 'BR': 0x20,
+    'FLC': 0x40, 'FRC': 0x80, 'BC': 0x100, 'SL': 0x200, 'SR': 0x400,
+}
+
+# ITU-R BS.775 downmix coefficients of each speaker, one per output channel; the LFE is dropped.
+# The matrix of a source is built from its channel mask, so quad (FL FR BL BR) and 4.0 (FL FR FC LFE)
+# sources with the same channel count get their own mix.
+DOWNMIX_PRESETS = {
+    'stereo': {
+        'FL': (1, 0), 'FR': (0, 1), 'FC': (_C, _C), 'LFE': (0, 0), 'BL': (_C, 0), 'BR': (0, _C),
+        'FLC': (_C, 0), 'FRC': (0, _C), 'BC': (0.5, 0.5), 'SL': (_C, 0), 'SR': (0, _C),
+    },
+    'mono': {
+        'FL': (0.5,), 'FR': (0.5,), 'FC': (_C,), 'LFE': (0,), 'BL': (0.5,), 'BR': (0.5,),
+        'FLC': (0.5,), 'FRC': (0.5,), 'BC': (_C,), 'SL': (0.5,), 'SR': (0.5,),
+    },
+}
+
+_CHANNEL_MASKS = {1: 0x4, 2: 0x3}
+
+
+def _preset_matrix(name, channels, channel_mask):
+    if not channel_mask:
+        # wav files without a mask get wavio's default layout for their channel count
+        channel_mask = wavio._CHANNEL_MASKS.get(channels, 0)
+    speakers = [speaker for speaker, bit in SPEAKERS.items() if channel_mask & bit]
+    if len(speakers) != channels or channel_mask & ~sum(SPEAKERS.values()):
+        raise ValueError(f"downmix_matrix: no '{name}' preset for {channels} channels with channel mask "
+                         f"{channel_mask:#x}, pass a matrix instead.")
+    if name == 'mono' and speakers == ['FC']:
+        # a mono source is already mono
+        return [[1]]
+    return [list(gains) for gains in zip(*(DOWNMIX_PRESETS[name][speaker] for speaker in speakers))]
+
+
+def downmix_matrix(channels:int, downmix:Union[str, Sequence[Sequence[float]]], channel_mask:int=0):
+    """
+    Builds a downmix matrix of shape (output channels, channels).
+
+    :param channels: Number of input channels.
+    :type channels: int
+    :param downmix: A matrix, or the name of a preset in DOWNMIX_PRESETS.
+        A preset name ending in '_normalized' scales the matrix so no output channel can exceed full scale.
+    :type downmix: str or list of lists
+    :param channel_mask: WAVE_FORMAT_EXTENSIBLE channel mask of the input, which a preset is built from.
+        Defaults to 0 for the usual layout of the channel count.
+    :type channel_mask: int, optional
+    :raises ValueError: Unknown preset, a channel layout the preset has no coefficients for,
+        or a matrix that does not match the channel count.
+    :return: The matrix.
+    :rtype: numpy.ndarray
+    """
+    import numpy as np
+    normalize = False
+    if isinstance(downmix, str):
+        name = downmix
+        if name.endswith('_normalized'):
+            name, normalize = name[:-len('_normalized')], True
+        if name not in DOWNMIX_PRESETS:
+            raise ValueError(f"downmix_matrix: no '{downmix}' preset.")
+        downmix = _preset_matrix(name, channels, channel_mask)
+    matrix = np.asarray(downmix, dtype=np.float64)
+    if matrix.ndim != 2 or matrix.shape[1] != channels:
+        raise ValueError(f"downmix_matrix: a downmix of {channels} channels needs {channels} columns, got shape {matrix.shape}.")
+    if normalize:
+        matrix /= max(1.0, np.abs(matrix).sum(axis=1).max())
+    return matrix
+
+
+class Resampler:
+    """
+    Streaming polyphase resampler with a Kaiser windowed sinc filter.
+
+    Blocks of any size can be fed in; the filter history is carried between them,
+    so the output is the same as resampling the whole signal at once.
+    The output is ceil(input frames * out_rate / in_rate) frames long, aligned with the input.
+
+    Example:
+        resampler = Resampler(96000, 48000, 2)
+        for block in blocks:
+            out = resampler.process(block)
+        out = resampler.flush()
+
+    :param in_rate: Input sample rate in Hz.
+    :type in_rate: int
+    :param out_rate: Output sample rate in Hz.
+    :type out_rate: int
+    :param channels: Number of channels.
+    :type channels: int
+    :param zero_crossings: Zero crossings of the sinc either side of its centre, defaults to 32.
+    :type zero_crossings: int, optional
+    :param rolloff: Cutoff as a fraction of the lower Nyquist frequency, defaults to 0.95.
+    :type rolloff: float, optional
+    :param beta: Kaiser window beta, defaults to 9.0.
+    :type beta: float, optional
+    """
+
+    def __init__(self, in_rate:int, out_rate:int, channels:int, zero_crossings:int=32, rolloff:float=0.95, beta:float=9.0):
+        import numpy as np
+        g = math.gcd(in_rate, out_rate)
+        self.up, self.down = out_rate // g, in_rate // g
+        self.channels = channels
+        cutoff = min(1.0, self.up / self.down) * rolloff
+        self.half = int(math.ceil(zero_crossings / cutoff))
+        # one row of taps per output phase; tap k of phase p weighs the input sample half-1-k before it
+        offsets = np.arange(self.up)[:, None] / self.up + self.half - 1 - np.arange(2 * self.half)[None, :]
+        window = np.i0(beta * np.sqrt(np.clip(1 - (offsets / self.half) ** 2, 0, None))) / np.i0(beta)
+        self._taps = cutoff * np.sinc(cutoff * offsets) * window
+        # the input is padded with silence before its start, so the first outputs have a full history
+        self._buffer = np.zeros((self.half, channels))
+        self._buffer_start = -self.half
+        self._next = 0
+        self._received = 0
+
+    def _emit(self, end):
+        import numpy as np
+        outputs = []
+        available = self._buffer_start + len(self._buffer)
+        # output n needs input up to floor(n * down / up) + half
+        last = min(end, -(-(available - self.half) * self.up // self.down))
+        if last > self._next:
+            windows = np.lib.stride_tricks.sliding_window_view(self._buffer, 2 * self.half, axis=0)
+        for start in range(self._next, last, 4096):
+            n = np.arange(start, min(start + 4096, last))
+            first = n * self.down // self.up - self.half + 1 - self._buffer_start
+            phases = n * self.down % self.up
+            out = np.empty((len(n), self.channels))
+            # outputs sharing a phase share their taps, so each phase is one matrix product
+            for offset in range(min(self.up, len(n))):
+                rows = slice(offset, None, self.up)
+                out[rows] = windows[first[rows]] @ self._taps[phases[offset]]
+            outputs.append(out)
+        if last > self._next:
+            self._next = last
+            drop = self._next * self.down // self.up - self.half + 1 - self._buffer_start
+            if drop > 0:
+                self._buffer = self._buffer[drop:]
+                self._buffer_start += drop
+        return np.concatenate(outputs) if outputs else np.zeros((0, self.channels))
+
+    def output_frames(self, input_frames:int) -> int:
+        """Length of the output for an input of input_frames."""
+        return -(-input_frames * self.up // self.down)
+
+    def process(self, samples):
+        """
+        Resamples a block of shape (frames, channels), returning the output frames it completes.
+        """
+        import numpy as np
+        self._buffer = np.concatenate([self._buffer, samples])
+        self._received += len(samples)
+        return self._emit(self.output_frames(self._received))
+
+    def flush(self):
+        """
+        Returns the remaining output frames once all input has been processed.
+        """
+        import numpy as np
+        self._buffer = np.concatenate([self._buffer, np.zeros((self.half, self.channels))])
+        return self._emit(self.output_frames(self._received))
+
+
+class BlockProcessor:
+    """
+    Downmixes and resamples raw wav sample data block by block, producing 32-bit float sample data.
+
+    :param info: Layout of the input.
+    :type info: WavInfo
+    :param frames: Length of the input in frames, for the output's data_size.
+    :type frames: int
+    :param downmix: A matrix or preset for downmix_matrix, defaults to None for no downmix.
+    :type downmix: str or list of lists, optional
+    :param sample_rate: Output sample rate, defaults to None to keep the input rate.
+    :type sample_rate: int, optional
+    """
+
+    def __init__(self, info:WavInfo, frames:int, downmix:Optional[Union[str, Sequence[Sequence[float]]]]=None,
+                 sample_rate:Optional[int]=None):
+        self.info = info
+        self._matrix = downmix_matrix(info.channels, downmix, info.channel_mask) if downmix is not None else None
+        channels = len(self._matrix) if self._matrix is not None else info.channels
+        rate = sample_rate or info.sample_rate
+        self._resampler = Resampler(info.sample_rate, rate, channels) if rate != info.sample_rate else None
+        frames = self._resampler.output_frames(frames) if self._resampler is not None else frames
+        channel_mask = info.channel_mask if self._matrix is None else _CHANNEL_MASKS.get(channels, 0)
+        self.out_info = WavInfo(WAVE_FORMAT_IEEE_FLOAT, channels, rate, 32, 4 * channels, channel_mask, 0,
+                                frames * 4 * channels)
+
+    def process(self, raw:bytes) -> bytes:
+        samples = decode(raw, self.info)
+        if self._matrix is not None:
+            samples = samples @ self._matrix.T
+        if self._resampler is not None:
+            samples = self._resampler.process(samples)
+        return encode(samples, self.out_info)
+
+    def flush(self) -> bytes:
+        if self._resampler is None:
+            return b''
+        return encode(self._resampler.flush(), self.out_info)
+
+
+def processed_wav(path:str, downmix:Optional[Union[str, Sequence[Sequence[float]]]]=None,
+                  sample_rate:Optional[int]=None, block_frames:int=1 << 16) -> Tuple[WavInfo, Iterator[bytes]]:
+    """
+    Streams a wav file through a downmix and resampler, as 32-bit float samples.
+
+    :param path: The wav file.
+    :type path: str
+    :param downmix: A matrix or preset for downmix_matrix, defaults to None for no downmix.
+    :type downmix: str or list of lists, optional
+    :param sample_rate: Output sample rate, defaults to None to keep the input rate.
+    :type sample_rate: int, optional
+    :param block_frames: Input frames per block, defaults to 65536.
+    :type block_frames: int, optional
+    :return: The layout of the output, with data_size set, and its raw sample data block by block.
+    :rtype: tuple
+    """
+    info = read_wav_info(path)
+    processor = BlockProcessor(info, info.frames, downmix, sample_rate)
+
+    def _blocks():
+        for raw in read_frames(path, block_frames=block_frames, info=info):
+            out = processor.process(raw)
+            if out:
+                yield out
+        tail = processor.flush()
+        if tail:
+            yield tail
+
+    return processor.out_info, _blocks()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import *
+
+from .wavio import WavInfo
+
+MANIFEST_NAME = 'audio_manifest.json'
+
+# FLAC hashes 8-bit samples as signed, wav stores them unsigned
+_SIGNED_8BIT = bytes((value + 128) & 0xFF for value in range(256))
+
+_manifest_lock = threading.Lock()
+
+
+class PcmHasher:
+    """
+    MD5 of audio samples as FLAC computes it for its STREAMINFO block:
+    interleaved, little endian, signed, in whole bytes per sample.
+
+    Raw wav sample data is fed in as it streams, so the hash costs no extra pass over the audio.
+
+    :param info: Layout of the wav data.
+    :type info: WavInfo
+    :raises ValueError: Float samples, or samples not filling whole bytes, which FLAC does not hash the way wav stores them.
+    """
+
+    def __init__(self, info:WavInfo):
+        if info.is_float:
+            raise ValueError("PcmHasher: FLAC cannot encode float samples.")
+        if info.bits_per_sample != 8 * info.sample_width:
+            raise ValueError(f"PcmHasher: {info.bits_per_sample}-bit samples in {8 * info.sample_width}-bit containers are not supported.")
+        self.info = info
+        self.frames = 0
+        self._md5 = hashlib.md5()
+
+    def update(self, raw:bytes) -> None:
+        if self.info.sample_width == 1:
+            raw = raw.translate(_SIGNED_8BIT)
+        self._md5.update(raw)
+        self.frames += len(raw) // self.info.block_align
+
+    def hexdigest(self) -> str:
+        return self._md5.hexdigest()
+
+
+def flac_streaminfo(path:str) -> Dict[str, Any]:
+    """
+    Reads the STREAMINFO block of a FLAC file.
+
+    :param path: The FLAC file.
+    :type path: str
+    :raises ValueError: Not a FLAC file.
+    :return: sample_rate, channels, bits_per_sample, total_samples and md5 (hex, all zeros if the encoder did not compute it).
+    :rtype: dict
+    """
+    with open(path, 'rb') as f:
+        header = f.read(42)
+    # 'fLaC', then STREAMINFO is always the first metadata block, 34 bytes long
+    if len(header) < 42 or header[:4] != b'fLaC' or header[4] & 0x7F != 0:
+        raise ValueError(f"flac_streaminfo: {path} is not a flac file")
+    info = header[8:42]
+    packed = struct.unpack('>Q', info[10:18])[0]
+    return {
+        'sample_rate': packed >> 44,
+        'channels': ((packed >> 41) & 0x7) + 1,
+        'bits_per_sample': ((packed >> 36) & 0x1F) + 1,
+        'total_samples': packed & 0xFFFFFFFFF,
+        'md5': info[18:34].hex(),
+    }
+
+
+def manifest_path(outfile:str) -> str:
+    """The manifest recording the hashes of the outputs in outfile's directory."""
+    return str(Path(outfile).with_name(MANIFEST_NAME))
+
+
+def record_hash(outfile:str, entry:Dict[str, Any]) -> None:
+    """
+    Records the hash entry of outfile in the manifest of its directory, keyed by file name.
+    The manifest is rewritten under a temporary name and moved into place, so it is never left half written.
+    """
+    manifest = Path(manifest_path(outfile))
+    with _manifest_lock:
+        entries = {}
+        if manifest.exists():
+            try:
+                entries = json.loads(manifest.read_text())
+            except json.JSONDecodeError:
+                entries = {}
+        entries[Path(outfile).name] = dict(entry, time=time.time())
+        temp = manifest.with_name(f"{manifest.stem}.partial{manifest.suffix}")
+        temp.write_text(json.dumps(entries, indent=2, sort_keys=True))
+        os.replace(temp, manifest)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import *
+
+
+def file_checksum(path:str, chunk_size:int=1 << 20) -> str:
+    """
+    Returns the sha256 of a file, read in chunks.
+
+    :param path: File to hash.
+    :type path: str
+    :return: Hex digest.
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class JobJournal:
+    """
+    Append-only record of finished AudioPlan stages.
+
+    Every finished stage appends one json line with the size, modification time and sha256
+    of each of its outputs, and is flushed to disk before the next stage is recorded.
+    A line cut short by a crash is ignored when the journal is read back.
+
+    :param path: The journal file. Created if missing.
+    :type path: str
+    :param resume: Keep the stages recorded by earlier runs, defaults to True.
+        Otherwise the journal is emptied.
+    :type resume: bool, optional
+    :param strict: Re-hash outputs when verifying a stage instead of trusting an unchanged size and modification time,
+        defaults to False.
+    :type strict: bool, optional
+    """
+
+    def __init__(self, path:str, resume:bool=True, strict:bool=False):
+        self.path = Path(path)
+        self.strict = strict
+        self.entries = {}
+        self._lock = threading.Lock()
+        if resume and self.path.exists():
+            self._load()
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text('')
+
+    @staticmethod
+    def stage_id(key:tuple) -> str:
+        return repr(key)
+
+    def _load(self):
+        raw = self.path.read_bytes()
+        complete = raw[:raw.rfind(b'\n') + 1]
+        if len(complete) != len(raw):
+            # drop a line cut short by a crash, so the next record does not get appended to it
+            with open(self.path, 'r+b') as f:
+                f.truncate(len(complete))
+        for line in complete.decode('utf-8', errors='replace').splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(entry, dict) and 'stage' in entry:
+                self.entries[entry['stage']] = entry
+
+    def record(self, key:tuple, outputs:List[str]) -> None:
+        """
+        Records a finished stage. Its outputs must exist.
+        """
+        files = []
+        for output in outputs:
+            stat = os.stat(output)
+            files.append({
+                'path': str(output),
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'sha256': file_checksum(output),
+            })
+        entry = {'stage': self.stage_id(key), 'time': time.time(), 'outputs': files}
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.entries[entry['stage']] = entry
+
+    def verified(self, key:tuple, outputs:List[str]) -> bool:
+        """
+        True if the stage was recorded with the same outputs and they are unchanged on disk.
+        """
+        entry = self.entries.get(self.stage_id(key))
+        if entry is None or [f['path'] for f in entry['outputs']] != [str(output) for output in outputs]:
+            return False
+        for recorded in entry['outputs']:
+            try:
+                stat = os.stat(recorded['path'])
+            except FileNotFoundError:
+                return False
+            if stat.st_size != recorded['size']:
+                return False
+            if self.strict or stat.st_mtime_ns != recorded['mtime_ns']:
+                if file_checksum(recorded['path']) != recorded['sha256']:
+                    return False
+        return True
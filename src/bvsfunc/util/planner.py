@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fractions import Fraction
+from pathlib import Path
+from typing import *
+
+from . import AudioProcessor as ap
+from .alignment import _align_concat
+from .journal import JobJournal
+from .records import TrimPlan
+
+# Stages that only produce intermediate files, removed once every request is done with them.
+INTERMEDIATE_KINDS = ('extract', 'concat', 'trim')
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _copy_wav(in_file, outfile):
+    shutil.copyfile(in_file, ap._partial_path(outfile))
+    ap._finalize(ap._partial_path(outfile), outfile)
+
+
+class PlanNode:
+    """
+    One stage of an AudioPlan: probe, extract, concat, trim, flac, aac or wav.
+
+    The key identifies the work from its inputs, so two requests asking for the same work share one node.
+    A node without a func (probes) has already run while the plan was built.
+    """
+
+    def __init__(self, kind, key, func, args, deps, outputs, label):
+        self.kind = kind
+        self.key = key
+        self.func = func
+        self.args = args
+        self.deps = deps
+        self.outputs = outputs
+        self.label = label
+
+    def run(self):
+        self.func(*self.args)
+        missing = [output for output in self.outputs if not Path(output).exists()]
+        if missing:
+            raise RuntimeError(f"AudioPlan: {self.kind} stage for {self.label} did not produce {', '.join(missing)}")
+
+
+class AudioPlan:
+    """
+    Builds one or many AudioProcessor requests into a graph of
+    probe -> extract -> concat -> trim -> encode stages, then runs it.
+
+    Identical stages across requests, such as extracting the same stream of the same file, are only run once.
+    Stages run in parallel wherever their dependencies allow.
+
+    Example:
+        plan = AudioPlan()
+        plan.add_video_source(r"E:\\00001.m2ts", [[None,500],[1000,2000]], out_file="ep01")
+        plan.add_video_source(r"E:\\00001.m2ts", [24,-24], out_file="ep01_nc")
+        print(plan.describe())
+        files = plan.run(jobs=4)
+
+    :param overwrite: Overwrite existing files and force every stage to run, defaults to False.
+    :type overwrite: bool, optional
+    :param silent: Silence eac3to, ffmpeg, flac, and qaac, defaults to True.
+    :type silent: bool, optional
+    :param journal: A file to record finished stages in, defaults to None.
+        With a journal, a stage is only skipped if the journal holds it and its outputs are unchanged,
+        so a killed run can be restarted and only redoes the stages that were in flight.
+    :type journal: str, optional
+    :param resume: Skip the stages an existing journal verifies, defaults to True.
+        Otherwise the journal is started over.
+    :type resume: bool, optional
+    """
+
+    def __init__(self, overwrite:bool=False, silent:bool=True, journal:Optional[str]=None, resume:bool=True):
+        self.overwrite = overwrite
+        self.silent = silent
+        self.journal = JobJournal(journal, resume=resume and not overwrite) if journal is not None else None
+        self.nodes = {}
+        self.requests = []
+        self.shared = 0
+        self._probes = {}
+
+    ######################
+    #  graph functions   #
+    ######################
+
+    def _add(self, kind, key, func, args, deps, outputs, label):
+        if key in self.nodes:
+            self.shared += 1
+            return self.nodes[key]
+        node = PlanNode(kind, key, func, args, deps, outputs, label)
+        # nodes are only ever added after their dependencies, so insertion order is a topological order
+        self.nodes[key] = node
+        return node
+
+    def _probe(self, in_file, trims_framerate, frames_total):
+        key = ('probe', in_file, str(trims_framerate), frames_total)
+        if key not in self._probes:
+            self._probes[key] = ap._get_metainfo(in_file, trims_framerate, frames_total)
+        node = self._add('probe', key, None, (), [], [], in_file)
+        # records are immutable, so requests can share the probe result
+        return node, self._probes[key]
+
+    @staticmethod
+    def _trim_plan(trim_list, meta_info, framenum, trims_framerate):
+        trim_list = ap._normalize_trim_list(trim_list)
+        if trim_list is None or trim_list == [None,None]:
+            return None
+        return TrimPlan.from_trim_list(trim_list, framenum, ap._get_spf(meta_info, trims_framerate))
+
+    # stages are always called with overwrite, as they only run once the plan has decided they must
+
+    def _add_extract(self, in_file, track, probe):
+        key = ('extract', in_file, track.stream_id, tuple((part.start, part.end) for part in track.raw_parts))
+        node = self._add('extract', key, ap._extract_track_as_wav, (in_file, track, True, self.silent),
+                         [probe], [track.raw_wav] + [part.path for part in track.raw_parts],
+                         f"{in_file} stream {track.stream_id}")
+        # an identical extraction from an earlier request already names the files
+        shared_track = node.args[1]
+        return node, track.replace(raw_wav=shared_track.raw_wav, raw_parts=shared_track.raw_parts)
+
+    def _add_track_stages(self, track, source, plan, flac, aac, wav, verify, aac_options, outputs):
+        if plan is None:
+            wav_node = source
+        else:
+            key = ('trim', source.key, plan, track.offset_time)
+            wav_node = self._add('trim', key, ap._trim_track_as_wav,
+                                 (track, plan, True, self.silent),
+                                 [source], [track.wav], f"{[list(trim) for trim in plan.trims]}")
+        request_wav = track.wav
+        track = track.replace(wav=wav_node.outputs[0])
+        # only extract, concat and trim stages are shared; every request encodes to its own output paths
+        if flac:
+            node = self._add('flac', ('flac', wav_node.key, track.flac), ap._encode_flac_track,
+                             (track, True, self.silent, verify), [wav_node], [track.flac], track.wav)
+            if verify and not node.args[3]:
+                # a shared encode verifies if any request sharing it asks to
+                node.args = node.args[:3] + (True,)
+            outputs['flac'].append(node.outputs[0])
+        if aac:
+            node = self._add('aac', ('aac', wav_node.key, _freeze(aac_options), track.aac), ap._encode_aac_track,
+                             (track, True, self.silent) + aac_options, [wav_node], [track.aac], track.wav)
+            outputs['aac'].append(node.outputs[0])
+        if wav:
+            if request_wav != track.wav:
+                # the shared stage wrote the wav under another request's name
+                node = self._add('wav', ('wav', wav_node.key, request_wav), _copy_wav,
+                                 (track.wav, request_wav), [wav_node], [request_wav], track.wav)
+                outputs['wav'].append(node.outputs[0])
+            else:
+                outputs['wav'].append(track.wav)
+
+    def _add_request(self, outputs):
+        self.requests.append(outputs['flac'] + outputs['aac'] + outputs['wav'])
+        return len(self.requests) - 1
+
+    def add_video_source(self,
+                         in_file:str,
+                         trim_list:Union[List[Optional[int]], List[List[Optional[int]]]]=None,
+                         out_file:Optional[str]=None,
+                         out_dir:Optional[str]=None,
+                         trims_framerate:Optional[Fraction]=None,
+                         frames_total:Optional[int]=None,
+                         flac:bool=True,
+                         aac:bool=True,
+                         wav:bool=False,
+                         partial_extract:bool=False,
+                         verify:bool=False,
+                         aac_downmix:Optional[Union[str, List[List[float]]]]=None,
+                         aac_samplerate:Optional[int]=None
+                         ) -> int:
+        """
+        Adds a request taking the same arguments as video_source. The source is probed straight away.
+
+        :return: The request index, for the list returned by run.
+        :rtype: int
+        """
+        in_file = str(os.path.abspath(in_file))
+        out_prefix = ap._get_out_prefix(in_file, out_file, out_dir)
+        probe, meta_info = self._probe(in_file, trims_framerate, frames_total)
+        meta_info = ap._assign_track_files(meta_info, out_prefix)
+
+        plan = self._trim_plan(trim_list, meta_info, meta_info.framenum, trims_framerate)
+        if plan is None:
+            meta_info = ap._strip_cut(meta_info)
+        elif partial_extract:
+            meta_info = ap._build_raw_parts(in_file, meta_info, plan, ap.EXTRACT_MARGIN)
+
+        outputs = {'flac': [], 'aac': [], 'wav': []}
+        for track in meta_info.tracks:
+            extract, track = self._add_extract(in_file, track, probe)
+            self._add_track_stages(track, extract, plan, flac, aac, wav, verify,
+                                   (aac_downmix, aac_samplerate), outputs)
+        return self._add_request(outputs)
+
+    def add_mpls_source(self,
+                        mpls_dict:dict,
+                        trim_list:Union[List[Optional[int]], List[List[Optional[int]]]]=None,
+                        out_file:Optional[str]=None,
+                        out_dir:Optional[str]=None,
+                        trims_framerate:Optional[Fraction]=None,
+                        flac:bool=True,
+                        aac:bool=True,
+                        wav:bool=False,
+                        verify:bool=False,
+                        aac_downmix:Optional[Union[str, List[List[float]]]]=None,
+                        aac_samplerate:Optional[int]=None,
+                        align:Optional[Union[bool, str, List[str]]]=None
+                        ) -> int:
+        """
+        Adds a request taking the same arguments as mpls_source. Every clip is extracted once,
+        the streams are concatenated in playlist order, and the result is trimmed and encoded.
+        With align, the streams are aligned across the clip boundaries as they are concatenated.
+
+        :return: The request index, for the list returned by run.
+        :rtype: int
+        """
+        clips = [os.path.normpath(str(clip, 'utf-8')) for clip in mpls_dict['clip'] if clip]
+        if len(clips) == 1:
+            return self.add_video_source(clips[0], trim_list, out_file, out_dir, trims_framerate,
+                                         flac=flac, aac=aac, wav=wav, verify=verify,
+                                         aac_downmix=aac_downmix, aac_samplerate=aac_samplerate)
+
+        out_prefix = ap._get_out_prefix(clips[0], out_file, out_dir)
+        metas, extracts = [], []
+        for clip in clips:
+            clip = str(os.path.abspath(clip))
+            probe, meta_info = self._probe(clip, trims_framerate, None)
+            meta_info = ap._assign_track_files(meta_info, ap._get_out_prefix(clip, None, out_dir))
+            metas.append(meta_info)
+            extracts.append([self._add_extract(clip, track, probe)[0] for track in meta_info.tracks])
+
+        meta_info = ap._assign_track_files(metas[0], out_prefix)
+        plan = self._trim_plan(trim_list, meta_info, sum(meta.framenum for meta in metas), trims_framerate)
+        if plan is None:
+            meta_info = ap._strip_cut(meta_info)
+        outputs = {'flac': [], 'aac': [], 'wav': []}
+        for index, track in enumerate(meta_info.tracks):
+            sources = [clip_extracts[index] for clip_extracts in extracts]
+            concat_file = f"{out_prefix}_{track.stream_id}_concat.wav"
+            in_files = [source.outputs[0] for source in sources]
+            if align:
+                # a reference is given per stream, or one for all of them
+                reference = align[index] if isinstance(align, (list, tuple)) else align
+                concat = self._add('concat', ('concat', reference) + tuple(source.key for source in sources),
+                                   _align_concat, (in_files, concat_file, self.silent, reference),
+                                   sources, [concat_file], f"{len(sources)} clips stream {track.stream_id} aligned")
+            else:
+                concat = self._add('concat', ('concat',) + tuple(source.key for source in sources), ap._concat_wavs,
+                                   (in_files, concat_file, self.silent),
+                                   sources, [concat_file], f"{len(sources)} clips stream {track.stream_id}")
+            track = track.replace(raw_wav=concat.outputs[0], raw_parts=())
+            self._add_track_stages(track, concat, plan, flac, aac, wav, verify,
+                                   (aac_downmix, aac_samplerate), outputs)
+        return self._add_request(outputs)
+
+    ######################
+    #  run functions     #
+    ######################
+
+    def _is_done(self, node):
+        if node.func is None:
+            return True
+        if self.overwrite:
+            return False
+        if self.journal is not None:
+            return self.journal.verified(node.key, node.outputs)
+        return all(Path(output).exists() for output in node.outputs)
+
+    def _needed(self):
+        wanted = {output for outputs in self.requests for output in outputs}
+        required = {node.key for node in self.nodes.values() if wanted.intersection(node.outputs)}
+        needed = set()
+        for node in reversed(list(self.nodes.values())):
+            if node.key in required and not self._is_done(node):
+                needed.add(node.key)
+                required.update(dep.key for dep in node.deps)
+        return needed
+
+    def describe(self) -> str:
+        """
+        Returns the plan as text, one stage per line, in the order stages can run.
+        Stages whose outputs already exist, or that the journal verifies, are marked as skipped.
+
+        :return: The plan.
+        :rtype: str
+        """
+        needed = self._needed()
+        index = {key: i for i, key in enumerate(self.nodes)}
+        lines = []
+        for i, node in enumerate(self.nodes.values()):
+            status = 'run ' if node.key in needed else 'skip'
+            deps = ','.join(str(index[dep.key]) for dep in node.deps) or '-'
+            line = f"{i:>4} {status} {node.kind:<7} <- {deps:<8} {node.label}"
+            if node.outputs:
+                line += f" -> {', '.join(str(output) for output in node.outputs)}"
+            lines.append(line)
+        lines.append(f"{len(self.nodes)} stages, {len(needed)} to run, {self.shared} shared between requests, "
+                     f"{len(self.requests)} requests")
+        return '\n'.join(lines)
+
+    def _check_dependencies(self, needed):
+        kinds = {self.nodes[key].kind for key in needed}
+        if 'flac' in kinds and shutil.which("flac") is None:
+            raise SystemExit('flac encoder was not found in your PATH.')
+        if 'aac' in kinds and shutil.which("qaac") is None:
+            raise SystemExit('qaac encoder was not found in your PATH.')
+
+    def _cleanup(self):
+        keep = {output for outputs in self.requests for output in outputs}
+        intermediates = [output for node in self.nodes.values() if node.kind in INTERMEDIATE_KINDS
+                         for output in node.outputs if output not in keep]
+        ap._cleanup_temp_files(intermediates)
+
+    def _run_node(self, node):
+        node.run()
+        if self.journal is not None:
+            self.journal.record(node.key, node.outputs)
+
+    def run(self, jobs:int=1) -> List[List[str]]:
+        """
+        Runs every stage that is needed for the requested outputs, up to jobs stages at a time.
+        Intermediate files are removed afterwards.
+
+        :param jobs: Maximum number of stages to run at once, defaults to 1.
+        :type jobs: int, optional
+        :return: For each request, a list of filepaths to its final processed files, as video_source returns.
+        :rtype: list
+        """
+        needed = self._needed()
+        self._check_dependencies(needed)
+        pending = [node for node in self.nodes.values() if node.key in needed]
+        finished = {key for key in self.nodes if key not in needed}
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            running = {}
+            while pending or running:
+                if not errors:
+                    for node in [node for node in pending if all(dep.key in finished for dep in node.deps)]:
+                        pending.remove(node)
+                        running[executor.submit(self._run_node, node)] = node
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    node = running.pop(future)
+                    if future.exception() is not None:
+                        errors.append(future.exception())
+                    else:
+                        finished.add(node.key)
+        if errors:
+            raise errors[0]
+        self._cleanup()
+        return [list(outputs) for outputs in self.requests]
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import dataclasses
+import hashlib
+from dataclasses import dataclass
+from fractions import Fraction
+from typing import *
+
+
+class _Record:
+    """
+    Base of the AudioProcessor records: frozen, slotted, and pickled as their field values,
+    so they can be dict keys and cost little to send to other processes.
+    """
+    __slots__ = ()
+
+    def __reduce__(self):
+        # frozen slotted instances cannot be restored attribute by attribute, so rebuild through __init__
+        return (type(self), tuple(getattr(self, field.name) for field in dataclasses.fields(self)))
+
+    @property
+    def digest(self) -> str:
+        """sha1 of the record's contents. Unlike hash(), the same in every process and run."""
+        return hashlib.sha1(repr(self).encode()).hexdigest()
+
+    def replace(self, **changes):
+        """Returns a copy with the given fields changed."""
+        return dataclasses.replace(self, **changes)
+
+
+@dataclass(frozen=True)
+class ExtractPart(_Record):
+    """A range of a source's audio, in seconds, extracted to its own wav file."""
+    __slots__ = ('start', 'end', 'path')
+    start: float
+    end: float
+    path: str
+
+
+@dataclass(frozen=True)
+class AudioTrack(_Record):
+    """
+    An audio stream of a source and the files made from it.
+
+    raw_wav is the whole stream extracted to wav, or raw_parts the trimmed ranges of it.
+    wav is the trimmed wav, flac and aac its encodes. File paths are None until assigned.
+    """
+    __slots__ = ('stream_id', 'offset_time', 'format', 'bit_depth', 'raw_wav', 'raw_parts', 'wav', 'flac', 'aac')
+    stream_id: int
+    offset_time: float
+    format: Optional[str]
+    bit_depth: Optional[int]
+    raw_wav: Optional[str]
+    raw_parts: Tuple[ExtractPart, ...]
+    wav: Optional[str]
+    flac: Optional[str]
+    aac: Optional[str]
+
+
+@dataclass(frozen=True)
+class SourceInfo(_Record):
+    """
+    What AudioProcessor needs to know about a source: its video framerate and length, and its audio tracks.
+    framerate is None when the source has no video.
+    """
+    __slots__ = ('framerate', 'framenum', 'duration', 'tracks')
+    framerate: Optional[Union[str, Fraction]]
+    framenum: Optional[int]
+    duration: Optional[float]
+    tracks: Tuple[AudioTrack, ...]
+
+    def with_tracks(self, update:Callable[[AudioTrack], AudioTrack]) -> 'SourceInfo':
+        """Returns a copy with update applied to every track."""
+        return self.replace(tracks=tuple(update(track) for track in self.tracks))
+
+
+@dataclass(frozen=True)
+class TrimPlan(_Record):
+    """
+    Frame trims of a source and what is needed to turn them into times.
+
+    trims holds (start, end) pairs following python slice syntax, None for an open end.
+    """
+    __slots__ = ('trims', 'framenum', 'spf')
+    trims: Tuple[Tuple[Optional[int], Optional[int]], ...]
+    framenum: int
+    spf: float
+
+    @classmethod
+    def from_trim_list(cls, trim_list:Union[List[Optional[int]], List[List[Optional[int]]], None],
+                       framenum:int, spf:float) -> Optional['TrimPlan']:
+        """
+        Builds a plan from a video_source trim_list, or returns None if it does not trim anything.
+        """
+        if trim_list is None or trim_list == [None,None] or trim_list == [[None,None]]:
+            return None
+        trims = trim_list if type(trim_list[0]) is list else [trim_list]
+        return cls(tuple((start, end) for start, end in trims), framenum, spf)
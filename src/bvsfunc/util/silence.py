@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+from typing import *
+
+from . import AudioProcessor as ap
+from .wavio import read_wav_info
+
+# samples read per chunk, across all channels
+_CHUNK_SAMPLES = 1 << 22
+# samples summed together before frames are formed
+_BLOCK = 16
+
+
+def _wav_memmap(path, info):
+    import numpy as np
+    if info.sample_width == 3:
+        # no numpy dtype for 24-bit; read each sample as the top 3 bytes of an int32 that starts one byte early,
+        # overlapping the sample before it (or the data chunk header), so the samples are a strided int32 view
+        raw = np.memmap(path, dtype=np.uint8, mode='r', offset=info.data_offset - 1,
+                        shape=(info.frames * info.block_align + 1,))
+        return np.ndarray((info.frames, info.channels), dtype='<i4', buffer=raw, strides=(info.block_align, 3))
+    return np.memmap(path, dtype=info.dtype, mode='r', offset=info.data_offset, shape=(info.frames, info.channels))
+
+
+def _to_float(chunk, info):
+    import numpy as np
+    if info.sample_width == 3:
+        # clear the low byte borrowed from the sample before, leaving the sample scaled by 256
+        return (chunk & np.int32(-256)).astype(np.float32) / np.float32(1 << 31)
+    if info.is_float:
+        return chunk.astype(np.float32)
+    if info.sample_width == 1:
+        return (chunk.astype(np.float32) - 128) / 128
+    return chunk.astype(np.float32) / np.float32(1 << (8 * info.sample_width - 1))
+
+
+def _framerate(in_file, trims_framerate):
+    if in_file is not None:
+        meta_info = ap._get_metainfo(in_file, trims_framerate, None)
+        return meta_info, 1 / ap._get_spf(meta_info, trims_framerate)
+    if trims_framerate is None:
+        raise ValueError("silence: a framerate needs trims_framerate or an in_file to probe.")
+    return None, Fraction(trims_framerate)
+
+
+def frame_levels(wav:str, framerate:Union[Fraction, str, float], offset_time:float=0.0):
+    """
+    Measures the level of a wav file over each video frame.
+
+    The file is memory mapped and read in chunks. Squares are summed over 16 sample blocks with one einsum
+    and the blocks into frames with one np.add.reduceat, so no python code runs per sample or per frame.
+
+    :param wav: The wav file, e.g. an extracted raw_wav.
+    :type wav: str
+    :param framerate: Video framerate.
+    :type framerate: Fraction, str or float
+    :param offset_time: Audio delay relative to the video in seconds, as in _get_metainfo, defaults to 0.0.
+        Frame n is measured from n / framerate + offset_time seconds into the wav.
+    :type offset_time: float, optional
+    :return: Level of each whole frame covered by the wav in dBFS, the loudest channel's RMS. -inf for digital silence.
+    :rtype: numpy.ndarray
+    """
+    import numpy as np
+    info = read_wav_info(wav)
+    samples = _wav_memmap(wav, info)
+    framerate = Fraction(framerate)
+    # first sample of every frame, exact for fractional samples per frame such as 1601.6 at 29.97 fps
+    first_frame = max(0, -int(offset_time * framerate))
+    count = int((Fraction(info.frames, info.sample_rate) - Fraction(offset_time)) * framerate) - first_frame
+    if count <= 0:
+        return np.zeros(0)
+    frames = np.arange(first_frame, first_frame + count + 1, dtype=np.int64)
+    starts = np.round((frames * framerate.denominator / framerate.numerator + offset_time) * info.sample_rate).astype(np.int64)
+    starts = np.clip(starts, 0, info.frames)
+
+    # squares are first summed over short blocks, so frame edges land on block edges, 1/3 ms at 48 kHz
+    bounds_all = np.round(starts / _BLOCK).astype(np.int64)
+    levels = np.empty((count, info.channels))
+    chunk_frames = max(1, _CHUNK_SAMPLES // max(1, int(starts[1] - starts[0])) // info.channels)
+
+    def _chunk_levels(first):
+        last = min(count, first + chunk_frames)
+        bounds = bounds_all[first:last + 1]
+        chunk = samples[bounds[0] * _BLOCK:min(bounds[-1] * _BLOCK, info.frames)]
+        blocks = bounds[-1] - bounds[0]
+        if len(chunk) < blocks * _BLOCK:
+            # pad the last block with silence, which is 128 for unsigned 8-bit
+            pad = np.full((blocks * _BLOCK - len(chunk),) + chunk.shape[1:], 128 if info.sample_width == 1 else 0, chunk.dtype)
+            chunk = np.concatenate([chunk, pad])
+        chunk = _to_float(chunk, info).reshape(blocks, _BLOCK, info.channels)
+        squares = np.einsum('ijk,ijk->ik', chunk, chunk)
+        lengths = np.diff(bounds)
+        sums = np.add.reduceat(squares, np.minimum(bounds[:-1] - bounds[0], max(0, blocks - 1)), axis=0, dtype=np.float64)
+        # reduceat returns the element itself for empty ranges; those frames hold no samples
+        sums[lengths == 0] = 0
+        levels[first:last] = sums / (np.maximum(lengths, 1) * _BLOCK)[:, None]
+
+    # numpy releases the GIL, so chunks are measured on every core
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+        list(executor.map(_chunk_levels, range(0, count, chunk_frames)))
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(levels.max(axis=1))
+
+
+def _runs(mask):
+    import numpy as np
+    # (start, end) of every run of True, end exclusive
+    edges = np.diff(np.concatenate([[False], mask, [False]]).astype(np.int8))
+    return list(zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()))
+
+
+def detect_silence(wav:str, trims_framerate:Optional[Union[Fraction, str]]=None, in_file:Optional[str]=None,
+                   threshold_db:float=-60.0, min_duration:float=0.5, offset_time:Optional[float]=None,
+                   stream_id:Optional[int]=None) -> List[Tuple[int, int]]:
+    """
+    Finds the silent stretches of a wav file, in video frames.
+
+    The framerate comes from trims_framerate, or from probing in_file the same way video_source does.
+    When in_file is probed its audio delay is used as well, from the track stream_id or the first audio track.
+
+    :param wav: The wav file, e.g. an extracted raw_wav.
+    :type wav: str
+    :param trims_framerate: Video framerate. Overrides the framerate probed from in_file. Defaults to None.
+    :type trims_framerate: Fraction, optional
+    :param in_file: The source the wav was extracted from, probed for its framerate and delay. Defaults to None.
+    :type in_file: str, optional
+    :param threshold_db: Frames whose loudest channel is below this RMS level in dBFS are silent, defaults to -60.0.
+    :type threshold_db: float, optional
+    :param min_duration: Shortest silence reported, in seconds, defaults to 0.5.
+    :type min_duration: float, optional
+    :param offset_time: Audio delay relative to the video in seconds. Overrides the probed delay, defaults to None.
+        Like the probed delay it is rounded to whole frames, as video_source trims with it.
+    :type offset_time: float, optional
+    :param stream_id: Stream of in_file the wav holds, for its delay. Defaults to None for the first audio track.
+    :type stream_id: int, optional
+    :return: (first silent frame, frame after the silence) of each silence.
+    :rtype: list of tuples
+    """
+    levels, framerate, _ = _levels(wav, trims_framerate, in_file, offset_time, stream_id)
+    min_frames = max(1, int(round(min_duration * framerate)))
+    return [(start, end) for start, end in _runs(levels < threshold_db) if end - start >= min_frames]
+
+
+def _levels(wav, trims_framerate, in_file, offset_time, stream_id):
+    meta_info, framerate = _framerate(in_file, trims_framerate)
+    if offset_time is None:
+        offset_time = 0.0
+        if meta_info is not None and meta_info.tracks:
+            tracks = [track for track in meta_info.tracks if stream_id is None or track.stream_id == stream_id]
+            offset_time = tracks[0].offset_time if tracks else 0.0
+    # trims are cut with the delay rounded to whole frames, see _trim_times
+    offset_time = float(round(abs(offset_time) * framerate) / framerate)
+    return frame_levels(wav, framerate, offset_time), framerate, offset_time
+
+
+def suggest_trims(wav:str, trims_framerate:Optional[Union[Fraction, str]]=None, in_file:Optional[str]=None,
+                  threshold_db:float=-60.0, min_duration:float=0.5, head_window:float=60.0, tail_window:float=60.0,
+                  offset_time:Optional[float]=None, stream_id:Optional[int]=None) -> List[Optional[int]]:
+    """
+    Suggests a trim_list that starts at the program audio and ends before trailing silence.
+
+    The start is the end of the last silence beginning within head_window seconds of the start, such as the gap
+    after a studio logo, and the end is the start of the first silence within tail_window seconds of the end.
+    An end with no silence nearby is left open as None. Check the suggestion before using it.
+
+    Example:
+        trims = bvs.util.ap_suggest_trims(r"E:\\0000_2.wav", in_file=r"E:\\0000.m2ts")
+        files = bvs.util.ap_video_source(in_file=r"E:\\0000.m2ts", trim_list=trims)
+
+    :param wav: The wav file, e.g. an extracted raw_wav.
+    :type wav: str
+    :param trims_framerate: Video framerate, see detect_silence. Defaults to None.
+    :type trims_framerate: Fraction, optional
+    :param in_file: The source the wav was extracted from, see detect_silence. Defaults to None.
+    :type in_file: str, optional
+    :param threshold_db: Silence threshold in dBFS, defaults to -60.0.
+    :type threshold_db: float, optional
+    :param min_duration: Shortest silence considered, in seconds, defaults to 0.5.
+    :type min_duration: float, optional
+    :param head_window: Seconds from the start to search for the program start, defaults to 60.0.
+    :type head_window: float, optional
+    :param tail_window: Seconds before the end to search for the program end, defaults to 60.0.
+    :type tail_window: float, optional
+    :param offset_time: Audio delay relative to the video in seconds, see detect_silence. Defaults to None.
+    :type offset_time: float, optional
+    :param stream_id: Stream of in_file the wav holds, see detect_silence. Defaults to None.
+    :type stream_id: int, optional
+    :return: [start, end] in video frames, as trim_list takes it.
+    :rtype: list
+    """
+    import numpy as np
+    levels, framerate, offset_time = _levels(wav, trims_framerate, in_file, offset_time, stream_id)
+    min_frames = max(1, int(round(min_duration * framerate)))
+    silent = levels < threshold_db
+    runs = [(start, end) for start, end in _runs(silent) if end - start >= min_frames]
+    # a leading silence of any length still ends before the program
+    if silent.any() and silent[0]:
+        runs = [(0, int(np.argmin(silent)) if not silent.all() else len(silent))] + [run for run in runs if run[0] > 0]
+    head = int(head_window * framerate)
+    tail = len(levels) - int(tail_window * framerate)
+    start = None
+    for run_start, run_end in runs:
+        if run_start <= head and run_end < len(levels):
+            start = run_end
+    end = None
+    for run_start, run_end in runs:
+        if run_start >= max(tail, (start or 0) + 1):
+            # _trim_times delays the start of a trim by the audio delay but not its end,
+            # so the end frame has to carry the delay to cut where the silence starts
+            end = run_start + int(round(abs(offset_time) * framerate))
+            break
+    return [start, end]
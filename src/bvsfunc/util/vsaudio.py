@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+import collections
+import shutil
+import subprocess
+from fractions import Fraction
+from pathlib import Path
+from typing import *
+
+import vapoursynth as vs
+
+from . import AudioProcessor as ap
+from .records import TrimPlan
+from .wavio import WAVE_FORMAT_IEEE_FLOAT, WAVE_FORMAT_PCM, WavInfo, WavWriter, wav_header
+
+core = vs.core
+
+# every audio frame but the last holds this many samples
+AUDIO_FRAME_SAMPLES = 3072
+
+#########################
+#  frame to sample map  #
+#########################
+
+def _frame_times(clip, frames, requests):
+    # VFR clips carry each frame's duration in its properties; only the frames up to the last trim are read
+    times = [Fraction(0)]
+    for frame in _ordered_frames(clip, frames, requests):
+        times.append(times[-1] + Fraction(frame.props['_DurationNum'], frame.props['_DurationDen']))
+    return times
+
+def _normalize_trims(trim_list, num_frames):
+    # the same trim_list and frame rules as video_source, clamped to the clip
+    plan = TrimPlan.from_trim_list(ap._normalize_trim_list(trim_list), num_frames, 0.0)
+    ranges = []
+    for trim in ((None, None),) if plan is None else plan.trims:
+        start, end = ap._trim_frames(trim, num_frames)
+        ranges.append((max(0, start), min(num_frames, end)))
+    return ranges
+
+def frame_sample_ranges(clip:vs.VideoNode, audio:vs.AudioNode,
+                        trim_list:Union[List[Optional[int]], List[List[Optional[int]]]]=None,
+                        requests:Optional[int]=None) -> List[Tuple[int, int]]:
+    """
+    Maps frame trims of a clip to the audio samples they cover.
+
+    A CFR clip maps through its framerate. A VFR clip (fps 0) maps through the _DurationNum/_DurationDen
+    properties of its frames, so the frames up to the end of the last trim are requested once.
+
+    :param clip: The untrimmed clip the trims refer to, ideally straight from the source filter.
+    :type clip: VideoNode
+    :param audio: The audio of the clip, starting at its first frame.
+    :type audio: AudioNode
+    :param trim_list: A list or a list of lists of trims following python slice syntax, as for video_source.
+        Defaults to None for the whole clip.
+    :type trim_list: list, optional
+    :param requests: Maximum concurrent frame requests for VFR clips, defaults to core.num_threads.
+    :type requests: int, optional
+    :return: (first sample, sample to stop before) of each trim, clamped to the audio.
+    :rtype: list of tuples
+    """
+    trims = _normalize_trims(trim_list, clip.num_frames)
+    if clip.fps != 0:
+        times = lambda n: Fraction(n) / Fraction(clip.fps)
+    else:
+        frame_times = _frame_times(clip, max(end for _, end in trims), requests)
+        times = lambda n: frame_times[n]
+    ranges = []
+    for start, end in trims:
+        first = min(audio.num_samples, round(times(start) * audio.sample_rate))
+        last = min(audio.num_samples, round(times(end) * audio.sample_rate))
+        ranges.append((first, max(first, last)))
+    return ranges
+
+def trim_audio(clip:vs.VideoNode, audio:vs.AudioNode,
+               trim_list:Union[List[Optional[int]], List[List[Optional[int]]]]=None) -> vs.AudioNode:
+    """
+    Cuts and splices an AudioNode with the same frame trims as its clip, so the script can keep
+    video and audio in step, e.g. for previewing or piping both out of vspipe.
+
+    Example:
+        src = core.lsmas.LWLibavSource(filepath)
+        audio = core.bs.AudioSource(filepath)
+        trims = [[None,500],[1000,2000]]
+        audio = bvs.util.ap_trim_audio(src, audio, trims)
+        src = src[:500] + src[1000:2000]
+
+    :param clip: The untrimmed clip the trims refer to.
+    :type clip: VideoNode
+    :param audio: The audio of the clip.
+    :type audio: AudioNode
+    :param trim_list: Trims as for video_source, defaults to None.
+    :type trim_list: list, optional
+    :return: The trimmed audio.
+    :rtype: AudioNode
+    """
+    parts = [audio[first:last] for first, last in frame_sample_ranges(clip, audio, trim_list) if last > first]
+    if not parts:
+        raise ValueError("trim_audio: the trims do not cover any audio.")
+    return core.std.AudioSplice(parts) if len(parts) > 1 else parts[0]
+
+#######################
+#  streamed encoding  #
+#######################
+
+def _ordered_frames(node, end, requests, start=0):
+    # keeps `requests` frames in flight and hands them back in order
+    requests = core.num_threads if requests is None else max(1, requests)
+    pending = collections.deque()
+    next_frame = start
+    while pending or next_frame < end:
+        while next_frame < end and len(pending) < requests:
+            pending.append(node.get_frame_async(next_frame))
+            next_frame += 1
+        yield pending.popleft().result()
+
+def _audio_wav_info(audio):
+    width = (audio.bits_per_sample + 7) // 8
+    format_tag = WAVE_FORMAT_IEEE_FLOAT if audio.sample_type == vs.FLOAT else WAVE_FORMAT_PCM
+    return WavInfo(format_tag, audio.num_channels, audio.sample_rate, 8 * width,
+                   width * audio.num_channels, audio.channel_layout, 0, 0)
+
+def _interleave(frame, info, first, last):
+    import numpy as np
+    # planar per channel in the frame, interleaved in the wav; channel order is the same in both.
+    # integer samples sit in the low bits of their int16/int32, so 24-bit keeps the low three bytes
+    samples = np.stack([np.asarray(frame[channel])[first:last] for channel in range(info.channels)], axis=1)
+    if info.is_float:
+        return samples.astype('<f4').tobytes()
+    if info.sample_width == 3:
+        return samples.astype('<i4').reshape(-1, 1).view(np.uint8)[:, :3].tobytes()
+    return samples.astype('<i2' if info.sample_width == 2 else '<i4').tobytes()
+
+def _audio_blocks(audio, ranges, info, requests):
+    for first, last in ranges:
+        start_frame = first // AUDIO_FRAME_SAMPLES
+        end_frame = -(-last // AUDIO_FRAME_SAMPLES)
+        for n, frame in enumerate(_ordered_frames(audio, end_frame, requests, start_frame), start_frame):
+            offset = n * AUDIO_FRAME_SAMPLES
+            yield _interleave(frame, info, max(first - offset, 0), min(last - offset, frame.num_samples))
+
+class _PipeSink:
+    def __init__(self, args, silent):
+        subp_args = {'args': args, 'stdin': subprocess.PIPE}
+        subp_args |= {'stdout':subprocess.DEVNULL, 'creationflags':subprocess.CREATE_NO_WINDOW, 'shell':True} if silent else {'shell':True}
+        self._proc = subprocess.Popen(**subp_args)
+
+    def write(self, raw):
+        try:
+            self._proc.stdin.write(raw)
+        except BrokenPipeError:
+            pass
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        return self._proc.wait()
+
+    def abort(self):
+        # the end of input lets the encoder exit on its own; kill it if it does not
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self._proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+
+class _ProcessedSink:
+    # downmixes and resamples blocks on their way to another sink
+    def __init__(self, sink, info, frames, downmix, samplerate):
+        from .dsp import BlockProcessor
+        self._sink = sink
+        self._processor = BlockProcessor(info, frames, downmix, samplerate)
+        out_info = self._processor.out_info
+        sink.write(wav_header(out_info, out_info.data_size))
+
+    def write(self, raw):
+        out = self._processor.process(raw)
+        if out:
+            self._sink.write(out)
+
+    def close(self):
+        tail = self._processor.flush()
+        if tail:
+            self._sink.write(tail)
+        return self._sink.close()
+
+    def abort(self):
+        self._sink.abort()
+
+class _HashSink:
+    def __init__(self, sink, info):
+        from .integrity import PcmHasher
+        self._sink = sink
+        self.hasher = PcmHasher(info)
+
+    def write(self, raw):
+        self.hasher.update(raw)
+        self._sink.write(raw)
+
+    def close(self):
+        return self._sink.close()
+
+    def abort(self):
+        self._sink.abort()
+
+def audio_node_source(
+                audio:vs.AudioNode,
+                clip:Optional[vs.VideoNode]=None,
+                trim_list:Union[List[Optional[int]], List[List[Optional[int]]]]=None,
+                out_file:Optional[str]=None,
+                out_dir:Optional[str]=None,
+                flac:bool=True,
+                aac:bool=True,
+                wav:bool=False,
+                overwrite:bool=False,
+                silent:bool=True,
+                verify:bool=False,
+                aac_downmix:Optional[Union[str, List[List[float]]]]=None,
+                aac_samplerate:Optional[int]=None,
+                requests:Optional[int]=None
+                ):
+    """
+    Encodes a VapourSynth AudioNode, e.g. from core.bs.AudioSource, cut with the frame trims of its clip.
+
+    The audio frames are requested in parallel, in order, and streamed to flac, qaac and the wav file at once,
+    so there is no extraction to wav and no trim pass. The trims are given once, as frames of the clip,
+    and mapped to samples with its framerate, or with its frame durations for VFR clips.
+
+    Example:
+        src = core.lsmas.LWLibavSource(filepath)
+        audio = core.bs.AudioSource(filepath)
+        trims = [[None,500],[1000,2000]]
+        files = bvs.util.ap_audio_node_source(audio, src, trims, out_file='ep01')
+        src = src[:500] + src[1000:2000]
+
+    :param audio: The audio to encode.
+    :type audio: AudioNode
+    :param clip: The untrimmed clip the trims refer to. Only needed with trim_list.
+    :type clip: VideoNode, optional
+    :param trim_list: A list or a list of lists of trims following python slice syntax, as for video_source.
+        Defaults to None to encode all of the audio.
+    :type trim_list: list, optional
+    :param out_file: A string prefix to name the output files with, defaults to 'audio'.
+    :type out_file: str, optional
+    :param out_dir: A string path for the file output directory, defaults to the working directory.
+    :type out_dir: str, optional
+    :param flac: Enable FLAC encoding, defaults to True.
+    :type flac: bool, optional
+    :param aac: Enable AAC encoding, defaults to True.
+    :type aac: bool, optional
+    :param wav: Write the trimmed audio to a wav file, defaults to False.
+    :type wav: bool, optional
+    :param overwrite: Overwrite existing files, defaults to False.
+    :type overwrite: bool, optional
+    :param silent: Silence flac and qaac, defaults to True.
+    :type silent: bool, optional
+    :param verify: Verify the flac file is lossless, see video_source. Defaults to False.
+    :type verify: bool, optional
+    :param aac_downmix: Downmix for the aac file, see video_source. Defaults to None.
+    :type aac_downmix: str or list of lists, optional
+    :param aac_samplerate: Sample rate of the aac file, see video_source. Defaults to None.
+    :type aac_samplerate: int, optional
+    :param requests: Maximum concurrent audio frame requests, defaults to core.num_threads.
+    :type requests: int, optional
+    :raises SystemExit: Missing encoders.
+    :raises ValueError: trim_list without clip, or flac with float audio.
+    :raises RuntimeError: The flac file failed verification. It is not kept.
+    :return: A list of filepaths to all of the final processed files.
+    :rtype: list
+    """
+    if trim_list is not None and clip is None:
+        raise ValueError("audio_node_source: trim_list needs the clip the trims refer to.")
+    try:
+        import numpy
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError('AudioProcessor.AudioNodeSource: missing numpy dependency.')
+    info = _audio_wav_info(audio)
+    if flac and info.is_float:
+        raise ValueError("audio_node_source: flac cannot encode float audio.")
+    if flac and shutil.which("flac") is None:
+        raise SystemExit('flac encoder was not found in your PATH.')
+    if aac and shutil.which("qaac") is None:
+        raise SystemExit('qaac encoder was not found in your PATH.')
+
+    ranges = frame_sample_ranges(clip, audio, trim_list, requests) if trim_list is not None else [(0, audio.num_samples)]
+    frames = sum(last - first for first, last in ranges)
+    info = info._replace(data_size=frames * info.block_align)
+    out_prefix = ap._get_out_prefix('audio', out_file, out_dir)
+    finals = [f"{out_prefix}_cut.{ext}" for ext, enabled in (('flac', flac), ('aac', aac), ('wav', wav)) if enabled]
+    outfiles = {Path(outfile).suffix[1:]: outfile for outfile in finals if overwrite or not Path(outfile).exists()}
+    if not outfiles:
+        if not silent:
+            print("AudioProcessor: All files exist and overwrite not specified.")
+        return finals
+
+    sinks = {}
+    try:
+        if 'flac' in outfiles:
+            flac_cmds = ["flac", "-", "-8", "--force", "-o", ap._clear_partial(outfiles['flac'])]
+            if silent:
+                flac_cmds.insert(3,'--silent')
+            sinks['flac'] = _PipeSink(flac_cmds, silent)
+            sinks['flac'].write(wav_header(info, info.data_size))
+            if verify:
+                sinks['flac'] = _HashSink(sinks['flac'], info)
+        if 'aac' in outfiles:
+            aac_cmds = ["qaac", "-", "--adts", "-V 127", "--no-delay", "-o", ap._clear_partial(outfiles['aac'])]
+            if silent:
+                aac_cmds.insert(5,'--silent')
+            sinks['aac'] = _PipeSink(aac_cmds, silent)
+            if aac_downmix is not None or aac_samplerate is not None:
+                sinks['aac'] = _ProcessedSink(sinks['aac'], info, frames, aac_downmix, aac_samplerate)
+            else:
+                sinks['aac'].write(wav_header(info, info.data_size))
+        if 'wav' in outfiles:
+            sinks['wav'] = WavWriter(ap._clear_partial(outfiles['wav']), info)
+
+        for raw in _audio_blocks(audio, ranges, info, requests):
+            for sink in sinks.values():
+                sink.write(raw)
+
+        for ext in list(sinks):
+            returncode = sinks[ext].close() or 0
+            sink = sinks.pop(ext)
+            if ext == 'flac' and verify and returncode == 0:
+                from .integrity import flac_streaminfo, record_hash
+                streaminfo = flac_streaminfo(ap._partial_path(outfiles['flac']))
+                if streaminfo['md5'] != sink.hasher.hexdigest() or streaminfo['total_samples'] != sink.hasher.frames:
+                    raise RuntimeError(f"AudioProcessor: flac verification failed for {outfiles['flac']}.")
+                record_hash(outfiles['flac'], {
+                    'md5': sink.hasher.hexdigest(),
+                    'samples': sink.hasher.frames,
+                    'sample_rate': info.sample_rate,
+                    'channels': info.channels,
+                    'bits_per_sample': info.bits_per_sample,
+                    'source': 'AudioNode',
+                })
+            ap._finalize(ap._partial_path(outfiles[ext]), outfiles[ext], returncode)
+    finally:
+        # sinks are only left open when something failed: stop the encoders and drop every unfinished output
+        for sink in sinks.values():
+            sink.close() if isinstance(sink, WavWriter) else sink.abort()
+        ap._cleanup_temp_files([ap._partial_path(outfile) for outfile in outfiles.values()])
+
+    return finals
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+import os
+import struct
+from typing import *
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# tail of the KSDATAFORMAT_SUBTYPE guids, after the 2 byte format tag
+_SUBTYPE_TAIL = b'\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71'
+
+# default speaker masks by channel count, as eac3to and ffmpeg write them
+_CHANNEL_MASKS = {1: 0x4, 2: 0x3, 3: 0x7, 4: 0x33, 5: 0x37, 6: 0x3F, 7: 0x13F, 8: 0x63F}
+
+
+class WavInfo(NamedTuple):
+    """Layout of a wav file: its sample format and where the sample data lives."""
+    format_tag: int
+    channels: int
+    sample_rate: int
+    bits_per_sample: int
+    block_align: int
+    channel_mask: int
+    data_offset: int
+    data_size: int
+
+    @property
+    def is_float(self) -> bool:
+        return self.format_tag == WAVE_FORMAT_IEEE_FLOAT
+
+    @property
+    def sample_width(self) -> int:
+        return self.block_align // self.channels
+
+    @property
+    def frames(self) -> int:
+        return self.data_size // self.block_align
+
+    @property
+    def dtype(self) -> str:
+        """numpy dtype of one sample, None for 24-bit which has no numpy equivalent."""
+        if self.is_float:
+            return '<f4' if self.sample_width == 4 else '<f8'
+        return {1: 'u1', 2: '<i2', 3: None, 4: '<i4'}[self.sample_width]
+
+
+def read_wav_info(path:str) -> WavInfo:
+    """
+    Reads the header of a RIFF, RF64 or BW64 wav file.
+
+    A data chunk whose size is unset or runs past the end of the file, as written by tools piping
+    their output, is taken to extend to the end of the file.
+
+    :param path: The wav file.
+    :type path: str
+    :raises ValueError: Not a wav file, or no fmt or data chunk.
+    :return: The layout of the file.
+    :rtype: WavInfo
+    """
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] not in (b'RIFF', b'RF64', b'BW64') or header[8:12] != b'WAVE':
+            raise ValueError(f"read_wav_info: {path} is not a wav file")
+        ds64_data_size = None
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                break
+            chunk_id, size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+            if chunk_id == b'ds64':
+                body = f.read(size)
+                ds64_data_size = struct.unpack('<Q', body[8:16])[0]
+            elif chunk_id == b'fmt ':
+                body = f.read(size)
+                format_tag, channels, sample_rate, _, block_align, bits = struct.unpack('<HHIIHH', body[:16])
+                channel_mask = _CHANNEL_MASKS.get(channels, 0)
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and size >= 40:
+                    channel_mask = struct.unpack('<I', body[20:24])[0]
+                    format_tag = struct.unpack('<H', body[24:26])[0]
+                fmt = (format_tag, channels, sample_rate, bits, block_align, channel_mask)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    break
+                data_offset = f.tell()
+                if size == 0xFFFFFFFF and ds64_data_size is not None:
+                    size = ds64_data_size
+                if size == 0 or size > file_size - data_offset:
+                    size = file_size - data_offset
+                size -= size % fmt[4]
+                return WavInfo(*fmt, data_offset, size)
+            else:
+                f.seek(size, 1)
+            if size & 1:
+                f.seek(1, 1)
+    raise ValueError(f"read_wav_info: {path} has no fmt or data chunk")
+
+
+def read_frames(path:str, start:int=0, end:Optional[int]=None, block_frames:int=1 << 16,
+                info:Optional[WavInfo]=None) -> Iterator[bytes]:
+    """
+    Reads the raw sample data of frames [start, end) in blocks of at most block_frames.
+
+    :param path: The wav file.
+    :type path: str
+    :param start: First frame, defaults to 0.
+    :type start: int, optional
+    :param end: Frame to stop before, defaults to the end of the file.
+    :type end: int, optional
+    :param block_frames: Frames per block, defaults to 65536.
+    :type block_frames: int, optional
+    :param info: The file's header, read if not given.
+    :type info: WavInfo, optional
+    :return: Raw interleaved sample data, block by block.
+    :rtype: iterator of bytes
+    """
+    info = read_wav_info(path) if info is None else info
+    start = max(0, min(start, info.frames))
+    end = info.frames if end is None else max(start, min(end, info.frames))
+    with open(path, 'rb') as f:
+        f.seek(info.data_offset + start * info.block_align)
+        remaining = end - start
+        while remaining > 0:
+            frames = min(remaining, block_frames)
+            raw = f.read(frames * info.block_align)
+            if not raw:
+                break
+            remaining -= len(raw) // info.block_align
+            yield raw
+
+
+def decode(raw:bytes, info:WavInfo):
+    """
+    Converts raw sample data to a float64 numpy array of shape (frames, channels),
+    with integer samples scaled to [-1.0, 1.0).
+
+    :param raw: Raw interleaved sample data, a whole number of frames.
+    :type raw: bytes
+    :param info: Layout of the data.
+    :type info: WavInfo
+    :return: The samples.
+    :rtype: numpy.ndarray
+    """
+    import numpy as np
+    width = info.sample_width
+    if info.is_float:
+        samples = np.frombuffer(raw, dtype=info.dtype).astype(np.float64)
+    elif width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float64) - 128.0) / 128.0
+    elif width == 3:
+        b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        # assemble little endian 24-bit, then sign extend through the top byte of an int32
+        samples = ((b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)) << 8 >> 8) / float(1 << 23)
+    else:
+        samples = np.frombuffer(raw, dtype=info.dtype) / float(1 << (8 * width - 1))
+    return samples.reshape(-1, info.channels)
+
+
+def encode(samples, info:WavInfo) -> bytes:
+    """
+    Converts a float numpy array of shape (frames, channels) back to raw sample data in the layout of info.
+    Integer output is rounded and clipped to its range.
+
+    :param samples: The samples, scaled to [-1.0, 1.0).
+    :type samples: numpy.ndarray
+    :param info: Layout of the data to produce.
+    :type info: WavInfo
+    :return: Raw interleaved sample data.
+    :rtype: bytes
+    """
+    import numpy as np
+    width = info.sample_width
+    if info.is_float:
+        return np.ascontiguousarray(samples, dtype=info.dtype).tobytes()
+    scale = float(1 << (8 * width - 1))
+    ints = np.clip(np.rint(samples * scale), -scale, scale - 1).astype(np.int32)
+    if width == 1:
+        return (ints + 128).astype(np.uint8).tobytes()
+    if width == 3:
+        return ints.astype('<i4').reshape(-1, 1).view(np.uint8)[:, :3].tobytes()
+    return ints.astype(info.dtype).tobytes()
+
+
+def wav_header(info:WavInfo, data_size:int) -> bytes:
+    """
+    Builds the header of a wav file holding data_size bytes of sample data in the layout of info,
+    up to and including the data chunk header. The header has the same length whatever the size:
+    room for the RF64 ds64 chunk is reserved as a JUNK chunk, and used once the data outgrows 4 GiB.
+
+    :param info: Sample format of the data. Its data_offset and data_size are ignored.
+    :type info: WavInfo
+    :param data_size: Length of the sample data in bytes.
+    :type data_size: int
+    :return: The header.
+    :rtype: bytes
+    """
+    extensible = info.channels > 2 or info.bits_per_sample > 16
+    if extensible:
+        fmt = struct.pack('<HHIIHHHHI', WAVE_FORMAT_EXTENSIBLE, info.channels, info.sample_rate,
+                          info.sample_rate * info.block_align, info.block_align, info.bits_per_sample,
+                          22, info.bits_per_sample, info.channel_mask)
+        fmt += struct.pack('<H', info.format_tag) + _SUBTYPE_TAIL
+    else:
+        fmt = struct.pack('<HHIIHH', info.format_tag, info.channels, info.sample_rate,
+                          info.sample_rate * info.block_align, info.block_align, info.bits_per_sample)
+    fmt_chunk = b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+    riff_size = 4 + 36 + len(fmt_chunk) + 8 + data_size + (data_size & 1)
+    if riff_size <= 0xFFFFFFFF:
+        return (b'RIFF' + struct.pack('<I', riff_size) + b'WAVE' + b'JUNK' + struct.pack('<I', 28) + bytes(28)
+                + fmt_chunk + b'data' + struct.pack('<I', data_size))
+    return (b'RF64' + struct.pack('<I', 0xFFFFFFFF) + b'WAVE'
+            + b'ds64' + struct.pack('<IQQQI', 28, riff_size, data_size, data_size // info.block_align, 0)
+            + fmt_chunk + b'data' + struct.pack('<I', 0xFFFFFFFF))
+
+
+class WavWriter:
+    """
+    Writes a wav file from raw sample data, switching to RF64 if the data outgrows 4 GiB.
+
+    Files that stay small are plain RIFF wav files any tool can read, see wav_header.
+
+    Example:
+        with WavWriter(outfile, info) as writer:
+            for raw in read_frames(infile, 48000, 96000, info=info):
+                writer.write(raw)
+
+    :param path: The file to write.
+    :type path: str
+    :param info: Sample format of the data. Its data_offset and data_size are ignored.
+    :type info: WavInfo
+    """
+
+    def __init__(self, path:str, info:WavInfo):
+        self.path = path
+        self.info = info
+        self.data_size = 0
+        self._file = open(path, 'wb')
+        self._file.write(wav_header(info, 0))
+
+    def write(self, raw:bytes) -> None:
+        self._file.write(raw)
+        self.data_size += len(raw)
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        if self.data_size & 1:
+            self._file.write(b'\x00')
+        self._file.seek(0)
+        self._file.write(wav_header(self.info, self.data_size))
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -7,4 +7,38 @@
     https://pytest.org/latest/plugins.html
 """
 
-# import pytest
+from pathlib import Path
+
+import pytest
+
+from bvsfunc.util import AudioProcessor as ap
+from bvsfunc.util.records import AudioTrack, SourceInfo
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    """Replaces the probe and the tools with stand-ins that write placeholder files and log what ran."""
+    ran = []
+
+    def probe(in_file, trims_framerate, frames_total):
+        track = AudioTrack(2, 0.0, 'PCM', 24, None, (), None, None, None)
+        return SourceInfo('24000/1001', 1000, None, (track,))
+
+    def extract(in_file, track, overwrite, silent):
+        ran.append(('extract', track.raw_wav))
+        Path(track.raw_wav).write_bytes(b'raw')
+
+    def trim(track, plan, overwrite, silent, qc=False):
+        ran.append(('trim', track.wav))
+        Path(track.wav).write_bytes(b'trimmed')
+
+    def flac(track, overwrite, silent, verify=False):
+        ran.append(('flac', track.flac, verify))
+        Path(track.flac).write_bytes(Path(track.wav).read_bytes())
+
+    monkeypatch.setattr(ap, '_get_metainfo', probe)
+    monkeypatch.setattr(ap, '_extract_track_as_wav', extract)
+    monkeypatch.setattr(ap, '_trim_track_as_wav', trim)
+    monkeypatch.setattr(ap, '_encode_flac_track', flac)
+    monkeypatch.setattr('shutil.which', lambda name: name)
+    return ran
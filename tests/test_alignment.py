@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+
+import pytest
+
+from bvsfunc.util.alignment import _align_concat, boundary_offsets, reference_offsets
+from bvsfunc.util.wavio import WavInfo, WavWriter, decode, encode, read_frames, read_wav_info
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+np = pytest.importorskip("numpy")
+
+RATE = 48000
+INFO = WavInfo(1, 2, RATE, 24, 6, 0x3, 0, 0)
+
+
+def _program(seconds, seed):
+    """Noise with a slowly varying level, so envelopes have something to correlate."""
+    rng = np.random.default_rng(seed)
+    level = np.repeat(np.abs(rng.standard_normal(seconds * 20)), RATE // 20)
+    return rng.standard_normal((seconds * RATE, 2)) * 0.1 * level[:, None]
+
+
+def _write(path, samples):
+    with WavWriter(str(path), INFO) as writer:
+        writer.write(encode(samples, INFO))
+    return str(path)
+
+
+@pytest.fixture
+def clips(tmp_path):
+    program = _program(60, 1)
+    reference = _write(tmp_path / "reference.wav", program)
+    # the second clip repeats 0.25 s of the first, the third starts 777 samples after the second ends
+    paths = [_write(tmp_path / "c0.wav", program[:20 * RATE + 12000]),
+             _write(tmp_path / "c1.wav", program[20 * RATE:40 * RATE]),
+             _write(tmp_path / "c2.wav", program[40 * RATE + 777:])]
+    return program, reference, paths
+
+
+def test_boundary_offsets_find_repeats(clips):
+    program, reference, paths = clips
+    offsets = boundary_offsets(paths)
+
+    assert offsets[1].offset == 12000 and offsets[1].score > 0.99
+    # a gap is not a repeat
+    assert offsets[2].score < 0.5
+
+
+def test_reference_alignment_restores_program(clips, tmp_path):
+    program, reference, paths = clips
+    outfile = str(tmp_path / "aligned.wav")
+    alignments = _align_concat(paths, outfile, True, reference)
+
+    assert [offset for offset, score in alignments] == [0, 12000, -777]
+    aligned = decode(b''.join(read_frames(outfile)), read_wav_info(outfile))
+    expected = decode(encode(program, INFO), INFO)
+    expected[40 * RATE:40 * RATE + 777] = 0.0
+    assert np.array_equal(aligned, expected)
+
+
+def test_poor_reference_match_is_reported_not_applied(clips, tmp_path, capsys):
+    program, reference, paths = clips
+    paths[1] = _write(tmp_path / "other.wav", _program(20, 2))
+    outfile = str(tmp_path / "aligned.wav")
+    alignments = _align_concat(paths, outfile, True, reference)
+
+    # the measured offset is kept, and reported even though silent is set
+    assert alignments[1].score < 0.5 and alignments[2].score > 0.99
+    assert f"{alignments[1].offset} samples" in capsys.readouterr().out
+    assert read_wav_info(outfile).frames == sum(read_wav_info(path).frames for path in paths) - alignments[2].offset
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from bvsfunc.util.audiostats import AudioStats, analyze_wav, clip_level
+from bvsfunc.util.wavio import WAVE_FORMAT_IEEE_FLOAT, WAVE_FORMAT_PCM, WavInfo, WavWriter, encode
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("scipy")
+
+
+def _sine(rate, seconds, amplitude=1.0, frequency=997):
+    return amplitude * np.sin(2 * np.pi * frequency * np.arange(int(rate * seconds)) / rate)
+
+
+@pytest.mark.parametrize("rate, tolerance", [
+    (48000, 0.01),
+    (44100, 0.01),
+    # BS.1770 gives the filter at 48 kHz; redesigned for 96 kHz it reads 0.02 dB lower at 997 Hz, as libebur128 does
+    (96000, 0.03),
+])
+def test_full_scale_997hz_sine_reads_minus_3_01_lufs(rate, tolerance):
+    # BS.1770: a 0 dBFS 997 Hz sine in one front channel measures -3.01 LKFS
+    stats = AudioStats(1, rate)
+    samples = _sine(rate, 5)[:, None]
+    for start in range(0, len(samples), 12345):
+        stats.update(samples[start:start + 12345])
+    assert stats.integrated_loudness() == pytest.approx(-3.01, abs=tolerance)
+
+
+def test_loudness_of_left_only_stereo_and_gating():
+    rate = 48000
+    samples = np.zeros((rate * 5, 2))
+    samples[:, 0] = _sine(rate, 5)
+    stats = AudioStats(2, rate)
+    stats.update(samples)
+    assert stats.integrated_loudness() == pytest.approx(-3.01, abs=0.01)
+    # -20 dB is 20 LU quieter
+    stats = AudioStats(2, rate)
+    stats.update(samples * 0.1)
+    assert stats.integrated_loudness() == pytest.approx(-23.01, abs=0.01)
+    # silence is below the absolute gate: only the three blocks straddling the edge count,
+    # where ungated the level would halve to -6.02
+    stats = AudioStats(2, rate)
+    stats.update(np.concatenate([samples, np.zeros((rate * 5, 2))]))
+    assert stats.integrated_loudness() == pytest.approx(-3.01, abs=0.15)
+
+
+def test_peak_rms_and_clipping(tmp_path):
+    info = WavInfo(WAVE_FORMAT_PCM, 2, 48000, 16, 4, 0x3, 0, 0)
+    samples = np.stack([_sine(48000, 1, 0.5), _sine(48000, 1, 1.0)], axis=1)
+    path = str(tmp_path / "sine.wav")
+    with WavWriter(path, info) as writer:
+        writer.write(encode(samples, info))
+    result = analyze_wav(path)
+
+    assert result['samples'] == 48000
+    assert result['peak'] == pytest.approx([0.5, clip_level(info)], abs=1e-4)
+    assert result['rms_db'] == pytest.approx([20 * np.log10(0.5 / np.sqrt(2)), -3.01], abs=0.01)
+    # the full scale channel is clipped to the largest 16-bit value at each crest
+    assert result['clipped'][0] == 0 and result['clipped'][1] > 0
+    assert result['integrated_loudness'] is not None
+
+
+def test_clip_level():
+    assert clip_level(WavInfo(WAVE_FORMAT_PCM, 2, 48000, 16, 4, 0x3, 0, 0)) == 32767 / 32768
+    assert clip_level(WavInfo(WAVE_FORMAT_IEEE_FLOAT, 2, 48000, 32, 8, 0x3, 0, 0)) == 1.0
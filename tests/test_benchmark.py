@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import math
+import threading
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+
+from bvsfunc import mods
+from bvsfunc.util import benchmark
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+np = pytest.importorskip("numpy")
+
+
+class _Clip:
+    """A clip of float luma planes, with the frame requests it has seen."""
+
+    def __init__(self, planes, props=None):
+        self.planes = planes
+        self.props = props or [{} for _ in planes]
+        self.num_frames = len(planes)
+        self.height, self.width = planes[0].shape
+        self.format = SimpleNamespace(name='GRAYS')
+        self.requested = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def get_frame(self, n):
+        return SimpleNamespace(props=self.props[n], plane=self.planes[n])
+
+    def get_frame_async(self, n):
+        with self._lock:
+            self.requested.append(n)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        future = Future()
+
+        def _render():
+            with self._lock:
+                self.in_flight -= 1
+            future.set_result(self.get_frame(n))
+        threading.Timer(0.001, _render).start()
+        return future
+
+    def map(self, func):
+        return _Clip([func(plane) for plane in self.planes])
+
+
+def _expr(clips, expr):
+    assert expr == 'x y - dup *'
+    return _Clip([(a - b) ** 2 for a, b in zip(clips[0].planes, clips[1].planes)])
+
+
+@pytest.fixture
+def core(monkeypatch):
+    core = SimpleNamespace(
+        num_threads=2,
+        max_cache_size=1024,
+        std=SimpleNamespace(
+            BlankClip=lambda width, height, format, length, color, **kwargs:
+                _Clip([np.full((height, width), color[0], dtype=np.float64) for _ in range(length)]),
+            ShufflePlanes=lambda clip, planes, colorfamily: clip,
+            Expr=_expr,
+            PlaneStats=lambda clip: _Clip(clip.planes, [{'PlaneStatsAverage': plane.mean()} for plane in clip.planes]),
+        ),
+        resize=SimpleNamespace(Point=lambda clip, format: clip),
+        get_video_format=lambda format: SimpleNamespace(name=str(format), sample_type=1, bits_per_sample=32),
+    )
+    monkeypatch.setattr(benchmark, 'core', core)
+    monkeypatch.setattr(benchmark, 'vs', SimpleNamespace(FLOAT=1, GRAY='GRAY', GRAYS='GRAYS'))
+    return core
+
+
+def _ramp(frames=4, offset=0.0):
+    return _Clip([np.linspace(0, 1, 64).reshape(8, 8) + offset for _ in range(frames)])
+
+
+def test_luma_psnr_of_identical_clips_is_inf(core):
+    assert benchmark.luma_psnr(_ramp(), _ramp()) == math.inf
+
+
+def test_luma_psnr_of_known_mse(core):
+    # an error of 0.1 everywhere is an MSE of 0.01, 20 dB below the peak of 1.0
+    assert benchmark.luma_psnr(_ramp(offset=0.1), _ramp()) == pytest.approx(20.0)
+    # the MSE is averaged over frames before it is turned into dB: (0.01 + 0.04) / 2
+    clip = _Clip([plane + error for plane, error in zip(_ramp(2).planes, (0.1, 0.2))])
+    assert benchmark.luma_psnr(clip, _ramp(2)) == pytest.approx(10 * math.log10(1 / 0.025))
+    # only the first frame
+    assert benchmark.luma_psnr(clip, _ramp(2), frames=1) == pytest.approx(20.0)
+
+
+def test_render_frames_requests_each_frame_once(core):
+    clip = _ramp(20)
+    result = benchmark.render_frames(clip, frames=15, requests=3)
+
+    assert result['frames'] == 15
+    assert sorted(clip.requested) == list(range(15))
+    assert clip.max_in_flight <= 3
+    assert result['fps'] > 0
+    assert result['latency_p50'] <= result['latency_p90'] <= result['latency_p99']
+
+
+def test_render_frames_raises_frame_errors(core):
+    clip = _ramp(5)
+
+    def get_frame_async(n):
+        future = Future()
+        future.set_exception(RuntimeError(f"frame {n} failed"))
+        return future
+
+    clip.get_frame_async = get_frame_async
+    with pytest.raises(RuntimeError, match="frame 0 failed"):
+        benchmark.render_frames(clip, requests=2)
+
+
+def _offset_filter(clip, offset=0.0):
+    return clip.map(lambda plane: plane + offset)
+
+
+def test_compare_variants_measures_psnr_against_reference(core, monkeypatch):
+    monkeypatch.setattr(benchmark, 'synthetic_clip', lambda width, height, format, length, noise: _ramp(length))
+    results = benchmark.compare_variants(_offset_filter, {'off': {'offset': 0.1}, 'ref': {}}, reference='ref',
+                                         resolution=(8, 8), frames=6, quality_frames=3)
+
+    assert [result['variant'] for result in results] == ['off', 'ref']
+    assert [result['psnr'] for result in results] == [pytest.approx(20.0), math.inf]
+    assert all(result['frames'] == 6 for result in results)
+
+
+def test_bvsbench_compare_prints_table(core, monkeypatch, capsys):
+    monkeypatch.setattr(benchmark, 'synthetic_clip', lambda width, height, format, length, noise: _ramp(length))
+    monkeypatch.setattr(mods, 'OffsetFilter', _offset_filter, raising=False)
+    monkeypatch.setattr('sys.argv', ['bvsbench', '-f', 'OffsetFilter', '-n', '4', '--compare', 'offset=0.1,0.0'])
+    benchmark._main()
+
+    header, *rows = capsys.readouterr().out.splitlines()
+    assert header.split()[0] == 'variant' and header.split()[-1] == 'psnr'
+    assert [(row.split()[0], row.split()[-1]) for row in rows] == [('0.1', '20.00'), ('0.0', 'inf')]
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import weakref
+from functools import partial
+from types import SimpleNamespace
+from typing import NamedTuple
+
+import numpy as np
+import pytest
+
+from bvsfunc.mods import descaleaamod
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+
+def _double_field0(row):
+    """1-D model of nnedi3(field=0, dh=True): source sample k goes to 2k+1, the rest is interpolated."""
+    doubled = np.empty(2 * len(row))
+    doubled[1::2] = row
+    doubled[0::2] = np.concatenate([[row[0]], (row[:-1] + row[1:]) / 2])
+    return doubled
+
+
+def _resample(row, size, shift):
+    """1-D model of fmtc.resample with sx=shift and a linear kernel: output pixel i reads the source at
+    shift + (i + 0.5) * len(row) / size - 0.5."""
+    positions = shift + (np.arange(size) + 0.5) * len(row) / size - 0.5
+    return np.interp(positions, np.arange(len(row)), row)
+
+
+@pytest.mark.parametrize("size", [64, 96, 128])
+def test_nnedi3_shift_centres_the_doubled_image(size):
+    # a ramp is reproduced exactly by linear interpolation, so any misplacement shows as an offset
+    row = np.arange(64, dtype=np.float64)
+    out = _resample(_double_field0(row), size, descaleaamod._NNEDI3_SHIFT)
+    expected = (np.arange(size) + 0.5) * len(row) / size - 0.5
+    # the edges are clamped, the rest must land on the source grid
+    np.testing.assert_allclose(out[2:-2], expected[2:-2], atol=1e-9)
+
+
+def _backends_available():
+    vs = pytest.importorskip('vapoursynth')
+    core = getattr(vs, 'core', None)
+    if core is None or not all(hasattr(core, ns) for ns in ('descale', 'fmtc', 'resize')) \
+            or not (hasattr(core, 'znedi3') or hasattr(core, 'nnedi3')):
+        pytest.skip("needs VapourSynth with descale, fmtc and znedi3 or nnedi3")
+    pytest.importorskip('fvsfunc')
+    pytest.importorskip('nnedi3_resample')
+    return vs, core
+
+
+def test_native_backend_matches_wrappers():
+    vs, core = _backends_available()
+    from bvsfunc.util.benchmark import luma_psnr
+
+    # smooth lineart-free content upscaled from 720p, so descaling has something to undo
+    small = core.std.BlankClip(width=1280, height=720, format=vs.YUV444PS, length=3)
+    small = core.std.Expr(small, ['X 0.05 * sin Y 0.07 * cos * 0.4 * 0.5 +', '0', '0'])
+    src = core.resize.Bicubic(small, 1920, 1080, format=vs.YUV420P16, filter_param_a=0, filter_param_b=0.5)
+
+    wrappers = descaleaamod.DescaleAAMod(src, backend='wrappers')
+    native = descaleaamod.DescaleAAMod(src, backend='native')
+    # the backends round and convert differently, so they only have to agree closely
+    assert luma_psnr(native, wrappers) >= 40
+
+
+class _Format(NamedTuple):
+    color_family: str
+    sample_type: str
+    bits_per_sample: int
+    subsampling_w: int
+    subsampling_h: int
+
+    @property
+    def id(self):
+        return self
+
+    @property
+    def num_planes(self):
+        return 1 if self.color_family == 'GRAY' else 3
+
+
+class _Node:
+    """Stands in for a VideoNode, recording only what DescaleAAMod reads."""
+
+    def __init__(self, core, width, height, format):
+        self._core, self.width, self.height, self.format = core, width, height, format
+        self.num_frames = 10
+
+    def __getattr__(self, namespace):
+        # clip.std.Inflate() style calls
+        return SimpleNamespace(**{name: partial(getattr(getattr(self._core, namespace), name), self)
+                                  for name in vars(getattr(self._core, namespace))})
+
+    def __getitem__(self, index):
+        # a trim is a new node, as in VapourSynth
+        return self.like()
+
+    def like(self, width=None, height=None, format=None):
+        return _Node(self._core, width or self.width, height or self.height, format or self.format)
+
+
+class _Core:
+    """Records every resize/convert node DescaleAAMod creates."""
+
+    def __init__(self):
+        self.conversions = []
+        same = lambda clip, *args, **kwargs: (clip[0] if isinstance(clip, list) else clip).like()
+        self.std = SimpleNamespace(ShufflePlanes=self._shuffle, Expr=same, Prewitt=same, Maximum=same,
+                                   Inflate=same, Deflate=same, Invert=same, MaskedMerge=same)
+        self.resize = SimpleNamespace(Point=self._point)
+
+    def query_video_format(self, *args):
+        return _Format(*args)
+
+    def _shuffle(self, clips, planes, colorfamily):
+        clip = clips[0] if isinstance(clips, list) else clips
+        subsampling = (0, 0) if colorfamily == 'GRAY' else clip.format[3:]
+        return clip.like(format=_Format(colorfamily, clip.format.sample_type, clip.format.bits_per_sample,
+                                        *subsampling))
+
+    def _point(self, clip, format):
+        self.conversions.append((clip.format, format))
+        return clip.like(format=format)
+
+
+@pytest.fixture
+def graph(monkeypatch):
+    core = _Core()
+    wrapper_formats = []
+
+    def resize(clip, w, h, **kwargs):
+        # fvf.Resize keeps the bit depth of its input
+        return clip.like(w, h)
+
+    def nnedi3_resample(clip, w, h, csp=None, **kwargs):
+        wrapper_formats.append((clip.format, csp))
+        return clip.like(w, h, csp)
+
+    monkeypatch.setattr(descaleaamod, 'core', core)
+    monkeypatch.setattr(descaleaamod, 'vs', SimpleNamespace(GRAY='GRAY', YUV='YUV', INTEGER='INTEGER', FLOAT='FLOAT'))
+    monkeypatch.setattr(descaleaamod, 'PRECISIONS', {'int16': ('INTEGER', 16), 'float': ('FLOAT', 32)})
+    monkeypatch.setattr(descaleaamod, '_import_wrappers',
+                        lambda: (SimpleNamespace(Resize=resize), nnedi3_resample))
+    core.wrapper_formats = wrapper_formats
+    return core
+
+
+@pytest.mark.parametrize("bits, precision, conversions", [
+    # the luma of sharp back to the source format, as before precision existed
+    (8, None, 1),
+    # plus the source in and the result out
+    (8, 'int16', 3),
+    (8, 'float', 3),
+    # a source already in the working format is not converted
+    (16, 'int16', 1),
+])
+def test_wrappers_backend_converts_once_in_and_out(graph, bits, precision, conversions):
+    src = _Node(graph, 1920, 1080, _Format('YUV', 'INTEGER', bits, 1, 1))
+    out = descaleaamod.DescaleAAMod(src, w=1280, h=720, precision=precision)
+
+    assert len(graph.conversions) == conversions
+    assert out.format == src.format
+    # nnedi3_resample outputs the working format it is given
+    assert all(csp == fmt for fmt, csp in graph.wrapper_formats)
+
+
+def test_memoize_hits_only_the_same_node(graph):
+    src = _Node(graph, 1920, 1080, _Format('YUV', 'INTEGER', 16, 1, 1))
+    try:
+        out = descaleaamod.DescaleAAMod(src, memoize=True)
+        built = len(graph.conversions)
+
+        assert descaleaamod.DescaleAAMod(src, memoize=True) is out
+        assert len(graph.conversions) == built
+        # other parameters, a trim of src, or an identical looking node are all different keys
+        assert descaleaamod.DescaleAAMod(src, h=810, memoize=True) is not out
+        trimmed = descaleaamod.DescaleAAMod(src[100:500], memoize=True)
+        assert descaleaamod.DescaleAAMod(src[100:500], memoize=True) is not trimmed
+        assert descaleaamod.DescaleAAMod(src.like(), memoize=True) is not out
+    finally:
+        descaleaamod.clear_memo()
+
+
+def test_memoize_holds_src_until_cleared(graph):
+    src = _Node(graph, 1920, 1080, _Format('YUV', 'INTEGER', 16, 1, 1))
+    alive = weakref.ref(src)
+    descaleaamod.DescaleAAMod(src, memoize=True)
+    del src
+    gc.collect()
+    # while memoized, no new node can take the id of src
+    assert alive() is not None
+
+    descaleaamod.clear_memo()
+    gc.collect()
+    assert alive() is None
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import ipaddress
+import multiprocessing
+import os
+import urllib.error
+from pathlib import Path
+
+import pytest
+
+from bvsfunc.util.distributed import Coordinator, Worker, _get, _post
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+
+def _stub_job(request):
+    """Stands in for run_request: fails the first attempt of a request marked fail_once, else returns its outputs."""
+    if request.get('fail_once'):
+        try:
+            # the marker is created by whichever attempt comes first, on any worker
+            os.close(os.open(request['fail_once'], os.O_CREAT | os.O_EXCL))
+            raise RuntimeError("first attempt fails")
+        except FileExistsError:
+            pass
+    return [f"{request['in_file']}.flac"]
+
+
+def _run_worker(url, name):
+    Worker(url, name, run=_stub_job, poll=0.05, retries=20).run()
+
+
+def test_workers_run_batch_and_retry_failed_request(tmp_path):
+    requests = [{'in_file': f"ep{index:02}.m2ts"} for index in range(6)]
+    requests[2]['fail_once'] = str(tmp_path / "ep02.failed")
+    coordinator = Coordinator(requests, host='127.0.0.1', port=0, lease_timeout=10.0, max_attempts=3)
+    coordinator.start()
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=_run_worker, args=(f"http://127.0.0.1:{coordinator.address[1]}", f"w{index}"))
+               for index in range(2)]
+    try:
+        for worker in workers:
+            worker.start()
+        assert coordinator.wait(timeout=60, poll=0.1)
+        for worker in workers:
+            worker.join(timeout=30)
+            assert worker.exitcode == 0
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.kill()
+        coordinator.stop()
+
+    status = coordinator.status()
+    assert status['counts']['done'] == 6
+    assert [task['outputs'] for task in status['tasks']] == [[f"ep{index:02}.m2ts.flac"] for index in range(6)]
+    assert [attempt['result'] for attempt in status['tasks'][2]['attempts']] == ['failed', 'done']
+    assert Path(requests[2]['fail_once']).exists()
+
+
+def test_failed_request_goes_to_another_worker():
+    coordinator = Coordinator([{'in_file': "ep01.m2ts"}, {'in_file': "ep02.m2ts"}], host='127.0.0.1', port=0)
+    first = coordinator.lease('w0')
+    coordinator.fail('w0', first['task_id'], "RuntimeError", 1.0)
+    # w0 is given the request it has not tried, w1 the one w0 failed
+    assert coordinator.lease('w0')['task_id'] != first['task_id']
+    assert coordinator.lease('w1')['task_id'] == first['task_id']
+    coordinator.stop()
+
+
+def _request(coordinator, endpoint, token=None):
+    url = f"http://127.0.0.1:{coordinator.address[1]}"
+    try:
+        if endpoint == '/status':
+            return _get(url, endpoint, token)
+        return _post(url, endpoint, {'worker': 'w0'}, token)
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_coordinator_listens_on_loopback_by_default():
+    coordinator = Coordinator([], port=0)
+    assert ipaddress.ip_address(coordinator.address[0]).is_loopback
+    coordinator.stop()
+    with pytest.raises(ValueError, match="token"):
+        Coordinator([], host='0.0.0.0', port=0)
+
+
+def test_coordinator_refuses_requests_without_token():
+    coordinator = Coordinator([{'in_file': "ep01.m2ts"}], host='0.0.0.0', port=0, token="s3cret")
+    coordinator.start()
+    try:
+        for endpoint in ('/status', '/lease'):
+            assert _request(coordinator, endpoint) == 401
+            assert _request(coordinator, endpoint, "wrong") == 401
+        assert coordinator.status()['counts']['leased'] == 0
+        assert _request(coordinator, '/lease', "s3cret")['task_id'] == 0
+
+        # a worker with the wrong token stops at once instead of retrying
+        with pytest.raises(urllib.error.HTTPError):
+            Worker(f"http://127.0.0.1:{coordinator.address[1]}", "w1", run=_stub_job, retries=1000,
+                   token="wrong").run()
+        worker = Worker(f"http://127.0.0.1:{coordinator.address[1]}", "w0", run=_stub_job, poll=0.05, token="s3cret")
+        coordinator.fail('w0', 0, "RuntimeError", 1.0)
+        assert worker.run()
+    finally:
+        coordinator.stop()
+    assert coordinator.status()['tasks'][0]['outputs'] == ["ep01.m2ts.flac"]
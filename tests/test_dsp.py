@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+import pytest
+
+from bvsfunc.util.dsp import BlockProcessor, Resampler, downmix_matrix
+from bvsfunc.util.wavio import WavInfo, decode, encode
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+np = pytest.importorskip("numpy")
+
+C = 1 / math.sqrt(2)
+
+
+@pytest.mark.parametrize("channel_mask, stereo", [
+    # 4.0 with an LFE: the centre goes to both sides, the LFE is dropped
+    (0x0F, [[1, 0, C, 0], [0, 1, C, 0]]),
+    # quad: the rears go to their own side
+    (0x33, [[1, 0, C, 0], [0, 1, 0, C]]),
+    # 5.1 with back and with side surrounds mix the same
+    (0x3F, [[1, 0, C, 0, C, 0], [0, 1, C, 0, 0, C]]),
+    (0x60F, [[1, 0, C, 0, C, 0], [0, 1, C, 0, 0, C]]),
+])
+def test_downmix_follows_channel_mask(channel_mask, stereo):
+    channels = bin(channel_mask).count('1')
+    np.testing.assert_allclose(downmix_matrix(channels, 'stereo', channel_mask), stereo)
+
+
+def test_downmix_gains():
+    # without a mask, 6 channels are 5.1
+    np.testing.assert_allclose(downmix_matrix(6, 'mono'), [[0.5, 0.5, C, 0, 0.5, 0.5]])
+    np.testing.assert_allclose(downmix_matrix(1, 'mono'), [[1]])
+    np.testing.assert_allclose(downmix_matrix(1, 'stereo'), [[C], [C]])
+    # normalized rows sum to at most full scale
+    np.testing.assert_allclose(np.abs(downmix_matrix(6, 'stereo_normalized', 0x3F)).sum(axis=1), [1, 1])
+
+    # a full scale centre reaches both sides at -3 dB, the LFE not at all
+    info = WavInfo(3, 6, 48000, 32, 24, 0x3F, 0, 0)
+    samples = np.zeros((4, 6))
+    samples[:, 2] = 1.0
+    samples[:, 3] = 1.0
+    out = BlockProcessor(info, 4, 'stereo').process(encode(samples, info))
+    np.testing.assert_allclose(decode(out, info._replace(channels=2, block_align=8)), C, rtol=1e-6)
+
+
+@pytest.mark.parametrize("channels, channel_mask", [
+    # top speakers have no preset coefficients
+    (3, 0x803),
+    # a mask that does not match the channel count
+    (4, 0x3F),
+])
+def test_downmix_rejects_unknown_layouts(channels, channel_mask):
+    with pytest.raises(ValueError):
+        downmix_matrix(channels, 'stereo', channel_mask)
+
+
+def _resample(samples, in_rate, out_rate, blocks):
+    resampler = Resampler(in_rate, out_rate, samples.shape[1])
+    edges = np.cumsum([0] + blocks)
+    out = [resampler.process(samples[first:last]) for first, last in zip(edges, edges[1:])]
+    return np.concatenate(out + [resampler.flush()])
+
+
+@pytest.mark.parametrize("in_rate, out_rate", [(44100, 48000), (96000, 48000)])
+def test_resampler_is_block_invariant(in_rate, out_rate):
+    samples = np.random.default_rng(1).uniform(-1, 1, (20000, 2))
+    whole = _resample(samples, in_rate, out_rate, [20000])
+    pieces = _resample(samples, in_rate, out_rate, [1, 999, 4096, 7, 12000, 2897])
+
+    assert len(whole) == -(-20000 * out_rate // in_rate)
+    np.testing.assert_allclose(pieces, whole, atol=1e-12)
+
+
+def _level(in_rate, out_rate, frequency):
+    samples = np.sin(2 * np.pi * frequency * np.arange(in_rate) / in_rate)[:, None]
+    out = _resample(samples, in_rate, out_rate, [in_rate])[2000:-2000, 0]
+    return out, 20 * np.log10(np.sqrt(2 * np.mean(out ** 2)))
+
+
+@pytest.mark.parametrize("in_rate, out_rate", [(44100, 48000), (48000, 44100), (96000, 48000)])
+def test_resampler_passband(in_rate, out_rate):
+    for frequency in (1000, 18000):
+        assert abs(_level(in_rate, out_rate, frequency)[1]) < 0.05
+    # aligned with the input: a 1 kHz sine comes out at the output sample times
+    out, _ = _level(in_rate, out_rate, 1000)
+    expected = np.sin(2 * np.pi * 1000 * (np.arange(len(out)) + 2000) / out_rate)
+    np.testing.assert_allclose(out, expected, atol=1e-3)
+
+
+@pytest.mark.parametrize("in_rate, out_rate, frequency", [(96000, 48000, 26000), (96000, 48000, 30000),
+                                                          (48000, 44100, 23000)])
+def test_resampler_stopband(in_rate, out_rate, frequency):
+    # above the output Nyquist the tone would alias back into the passband
+    assert _level(in_rate, out_rate, frequency)[1] < -90
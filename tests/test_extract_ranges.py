@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+
+import pytest
+
+from bvsfunc.util import AudioProcessor as ap
+from bvsfunc.util.records import AudioTrack, ExtractPart, SourceInfo, TrimPlan
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+# 25 fps keeps the frame times exact
+SPF = 0.04
+
+
+def _plan(*trims, framenum=1000):
+    return TrimPlan(tuple(trims), framenum, SPF)
+
+
+def _track(raw_wav, offset_time=0.0, raw_parts=()):
+    return AudioTrack(2, offset_time, 'PCM', 24, raw_wav, raw_parts, None, None, None)
+
+
+@pytest.mark.parametrize("trims, expected", [
+    # 0-4 s and 6-12 s meet once widened by a second
+    (((0, 100), (150, 300)), [(0.0, 13.0)]),
+    # 0-4 s and 8-12 s stay apart
+    (((0, 100), (200, 300)), [(0.0, 5.0), (7.0, 13.0)]),
+    # overlapping trims, given out of order
+    (((200, 300), (0, 250)), [(0.0, 13.0)]),
+    # the margin never starts before the audio
+    (((10, 100),), [(0.0, 5.0)]),
+    # None and negative frames count from the ends of the source
+    (((None, -100),), [(0.0, 37.0)]),
+    (((500, None),), [(19.0, 41.0)]),
+])
+def test_extract_ranges_merge_with_margin(trims, expected):
+    ranges = ap._get_extract_ranges(_plan(*trims), 0.0, 1.0)
+    assert ranges == pytest.approx(expected)
+
+
+def test_extract_ranges_follow_trim_times_for_delayed_audio():
+    # a 0.2 s delay moves the start by 5 frames, as _trim_times does when trimming
+    assert ap._get_extract_ranges(_plan((100, 200)), 0.2, 1.0) == pytest.approx([(3.2, 9.0)])
+
+
+@pytest.mark.parametrize("offset_time, seek", [(0.5, 0.5), (-0.5, 0.0), (0.0, 0.0)])
+def test_range_extraction_seeks_past_audio_delay(tmp_path, monkeypatch, offset_time, seek):
+    calls = []
+
+    def call(args, **kwargs):
+        calls.append(args)
+        Path(args[-1]).write_bytes(b'part')
+        return 0
+
+    monkeypatch.setattr('subprocess.call', call)
+    parts = (ExtractPart(3.0, 9.0, str(tmp_path / "ep01_2_part1.wav")),
+             ExtractPart(20.0, 30.0, str(tmp_path / "ep01_2_part2.wav")))
+    track = _track(str(tmp_path / "ep01_2.wav"), offset_time, parts)
+    ap._extract_track_ranges(str(tmp_path / "ep01.m2ts"), track, overwrite=False, silent=False)
+
+    assert [float(args[args.index('-ss') + 1]) for args in calls] == pytest.approx([3.0 + seek, 20.0 + seek])
+    assert [float(args[args.index('-t') + 1]) for args in calls] == pytest.approx([6.0, 10.0])
+    assert all(Path(part.path).read_bytes() == b'part' for part in parts)
+
+
+def test_wav_input_is_not_split_into_parts(tmp_path):
+    meta_info = SourceInfo('25/1', 1000, None, (_track(str(tmp_path / "ep01_2.wav")),))
+    assert ap._build_raw_parts(str(tmp_path / "ep01.wav"), meta_info, _plan((100, 200)), 1.0) == meta_info
+    parts = ap._build_raw_parts(str(tmp_path / "ep01.m2ts"), meta_info, _plan((100, 200)), 1.0).tracks[0].raw_parts
+    assert parts == (ExtractPart(3.0, 9.0, str(tmp_path / "ep01_2_part1.wav")),)
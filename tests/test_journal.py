@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import os
+from pathlib import Path
+
+from bvsfunc.util.journal import JobJournal
+from bvsfunc.util.planner import AudioPlan
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+
+def _touch(path, content):
+    Path(path).write_bytes(content)
+    return str(path)
+
+
+def test_changed_output_fails_verification(tmp_path):
+    output = _touch(tmp_path / "ep01.flac", b'flac')
+    journal = JobJournal(tmp_path / "journal.jsonl")
+    journal.record(('flac', 'ep01'), [output])
+    assert journal.verified(('flac', 'ep01'), [output])
+    assert not journal.verified(('flac', 'ep02'), [output])
+
+    # same size and content, new mtime: re-hashed and still verified
+    os.utime(output, ns=(1, 1))
+    assert JobJournal(tmp_path / "journal.jsonl").verified(('flac', 'ep01'), [output])
+    # same size, different content
+    _touch(output, b'FLAC')
+    os.utime(output, ns=(1, 1))
+    assert not JobJournal(tmp_path / "journal.jsonl").verified(('flac', 'ep01'), [output])
+
+
+def test_strict_rehashes_unchanged_mtime(tmp_path):
+    output = _touch(tmp_path / "ep01.flac", b'flac')
+    JobJournal(tmp_path / "journal.jsonl").record(('flac', 'ep01'), [output])
+    stat = os.stat(output)
+    # rewritten in place with the modification time put back, as some copy tools do
+    _touch(output, b'FLAC')
+    os.utime(output, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    assert JobJournal(tmp_path / "journal.jsonl").verified(('flac', 'ep01'), [output])
+    assert not JobJournal(tmp_path / "journal.jsonl", strict=True).verified(('flac', 'ep01'), [output])
+
+
+def test_truncated_last_record_is_ignored(tmp_path):
+    journal_file = tmp_path / "journal.jsonl"
+    first = _touch(tmp_path / "ep01.flac", b'1')
+    second = _touch(tmp_path / "ep02.flac", b'2')
+    journal = JobJournal(journal_file)
+    journal.record(('flac', 'ep01'), [first])
+    journal.record(('flac', 'ep02'), [second])
+    # a crash in the middle of writing the second record
+    journal_file.write_bytes(journal_file.read_bytes()[:-20])
+
+    journal = JobJournal(journal_file)
+    assert journal.verified(('flac', 'ep01'), [first])
+    assert not journal.verified(('flac', 'ep02'), [second])
+    # the stage is recorded again and survives the next load
+    journal.record(('flac', 'ep02'), [second])
+    assert JobJournal(journal_file).verified(('flac', 'ep02'), [second])
+
+
+def test_resume_reruns_stage_with_changed_output(tmp_path, stages):
+    source = str(tmp_path / "00001.m2ts")
+    journal_file = str(tmp_path / "journal.jsonl")
+
+    def run():
+        plan = AudioPlan(journal=journal_file)
+        plan.add_video_source(source, [24, -24], out_file="ep01", out_dir=str(tmp_path), aac=False)
+        return plan.run()[0]
+
+    flac = run()[0]
+    assert [stage[0] for stage in stages] == ['extract', 'trim', 'flac']
+    # nothing changed: nothing runs
+    stages.clear()
+    run()
+    assert stages == []
+
+    # the flac was damaged since, so it is encoded again from a fresh extract and trim
+    _touch(flac, b'damaged')
+    # and the journal's last record was cut short
+    Path(journal_file).write_bytes(Path(journal_file).read_bytes()[:-5])
+    run()
+    assert [stage[0] for stage in stages] == ['extract', 'trim', 'flac']
+    assert Path(flac).read_bytes() == b'trimmed'
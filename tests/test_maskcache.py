@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+from fractions import Fraction
+from types import SimpleNamespace
+
+import numpy as np
+
+from bvsfunc.mods import maskcache
+from bvsfunc.mods.maskcache import MaskStore, _INDEX_RECORD, mask_cache_key
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+
+class _Frame(list):
+    """API4-style frame: indexing gives a plane's array."""
+    format = SimpleNamespace(num_planes=3)
+
+
+def _record(monkeypatch, store, planes=None, num_frames=2):
+    """Records a fake clip and returns the per-frame callback ModifyFrame was given."""
+    callbacks = []
+    monkeypatch.setattr(maskcache, 'core', SimpleNamespace(std=SimpleNamespace(
+        ModifyFrame=lambda clip, clips, selector: callbacks.append(selector))))
+    clip = SimpleNamespace(format=SimpleNamespace(id=1, num_planes=3), width=4, height=2, num_frames=num_frames,
+                           fps=Fraction(24000, 1001))
+    store.record(clip, planes)
+    return callbacks[0]
+
+
+def _frame(n):
+    return _Frame(np.full((2, 4), 10 * n + plane, dtype=np.uint8) for plane in range(3))
+
+
+def test_interrupted_frame_is_completed(tmp_path, monkeypatch):
+    write = _record(monkeypatch, MaskStore(tmp_path))
+    write(0, _frame(0))
+    write(1, _frame(1))
+    # drop the last two index records, as if the run stopped after frame 1's first plane
+    index_file = tmp_path / 'masks.idx'
+    index_file.write_bytes(index_file.read_bytes()[:-2 * _INDEX_RECORD.size])
+
+    store = MaskStore(tmp_path)
+    assert not store.complete
+    write = _record(monkeypatch, store)
+    write(1, _frame(1))
+    assert MaskStore(tmp_path).complete
+
+
+def test_only_requested_planes_are_stored(tmp_path, monkeypatch):
+    store = MaskStore(tmp_path)
+    write = _record(monkeypatch, store, planes=[1, 2])
+    write(0, _frame(0))
+    write(1, _frame(1))
+
+    assert sorted(store.index) == [(0, 1), (0, 2), (1, 1), (1, 2)]
+    assert MaskStore(tmp_path).complete
+
+
+class _Source:
+    """A clip whose frames are all black but for the ones in edits, recording the frames read."""
+
+    def __init__(self, num_frames, edits=()):
+        self.format = SimpleNamespace(name='Gray8', num_planes=1)
+        self.width, self.height, self.num_frames, self.fps = 4, 2, num_frames, Fraction(24000, 1001)
+        self.edits = set(edits)
+        self.read = []
+
+    def get_frame(self, n):
+        self.read.append(n)
+        return _Frame([np.full((2, 4), 255 if n in self.edits else 0, dtype=np.uint8)])
+
+
+def test_key_samples_frames_spread_over_the_clip():
+    src = _Source(10000)
+    key = mask_cache_key(src, {'h': 720})
+
+    assert src.read[0] == 0 and src.read[-1] == 9999
+    assert len(src.read) == maskcache.KEY_SAMPLES
+    assert max(np.diff(src.read)) <= -(-9999 // (maskcache.KEY_SAMPLES - 1))
+    # an edit to any sampled frame changes the key, as do the parameters
+    for n in src.read:
+        assert mask_cache_key(_Source(10000, [n]), {'h': 720}) != key
+    assert mask_cache_key(src, {'h': 810}) != key
+    # short clips are hashed whole
+    short = _Source(20)
+    mask_cache_key(short, {})
+    assert short.read == list(range(20))
+
+
+def test_explicit_key_replaces_sampling():
+    src = _Source(10000)
+    unsampled = next(n for n in range(10000) if n not in maskcache._key_frames(10000, maskcache.KEY_SAMPLES))
+    # an edit between the samples is missed by the sampled key, but not by a key that changes with the source
+    assert mask_cache_key(_Source(10000, [unsampled]), {}) == mask_cache_key(src, {})
+    keyed = _Source(10000)
+    assert mask_cache_key(keyed, {}, key="v2") != mask_cache_key(keyed, {}, key="v1")
+    assert mask_cache_key(keyed, {}, key="v1") != mask_cache_key(src, {})
+    # no frames are rendered for an explicit key
+    assert keyed.read == []
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+from pathlib import Path
+
+from bvsfunc.util.planner import AudioPlan
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+
+def test_requests_sharing_a_source_keep_their_own_outputs(tmp_path, stages):
+    source = str(tmp_path / "00001.m2ts")
+    plan = AudioPlan()
+    first = plan.add_video_source(source, [24, -24], out_file="ep01", out_dir=str(tmp_path), aac=False)
+    second = plan.add_video_source(source, [24, -24], out_file="ep01_nc", out_dir=str(tmp_path), aac=False)
+    files = plan.run()
+
+    assert files[first] == [str(tmp_path / "ep01_2_cut.flac")]
+    assert files[second] == [str(tmp_path / "ep01_nc_2_cut.flac")]
+    assert all(Path(path).read_bytes() == b'trimmed' for path in files[first] + files[second])
+    # the extract and trim are shared, the encodes are not
+    assert [stage[0] for stage in stages] == ['extract', 'trim', 'flac', 'flac']
+
+
+def test_untrimmed_wav_request_gets_its_own_file(tmp_path, stages):
+    source = str(tmp_path / "00001.m2ts")
+    plan = AudioPlan()
+    first = plan.add_video_source(source, out_file="a", out_dir=str(tmp_path), flac=False, aac=False, wav=True)
+    second = plan.add_video_source(source, out_file="b", out_dir=str(tmp_path), flac=False, aac=False, wav=True)
+    files = plan.run()
+
+    assert files[first] == [str(tmp_path / "a_2.wav")]
+    assert files[second] == [str(tmp_path / "b_2.wav")]
+    assert Path(files[second][0]).read_bytes() == b'raw'
+    assert [stage[0] for stage in stages] == ['extract']
+
+
+def test_shared_flac_stage_verifies_if_any_request_asks(tmp_path, stages):
+    source = str(tmp_path / "00001.m2ts")
+    plan = AudioPlan()
+    plan.add_video_source(source, [24, -24], out_file="ep01", out_dir=str(tmp_path), aac=False)
+    plan.add_video_source(source, [24, -24], out_file="ep01", out_dir=str(tmp_path), aac=False, verify=True)
+    plan.run()
+
+    assert [stage for stage in stages if stage[0] == 'flac'] == [('flac', str(tmp_path / "ep01_2_cut.flac"), True)]
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pickle
+import subprocess
+import sys
+from fractions import Fraction
+
+import pytest
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+_SOURCE = """
+from fractions import Fraction
+from bvsfunc.util.records import AudioTrack, ExtractPart, SourceInfo, TrimPlan
+parts = (ExtractPart(0.0, 12.5, '/tmp/0000_2_part0.wav'), ExtractPart(40.04, 90.09, '/tmp/0000_2_part1.wav'))
+track = AudioTrack(2, -0.042, 'pcm_s24le', 24, None, parts, '/tmp/0000_2.wav', '/tmp/0000_2.flac', None)
+source = SourceInfo(Fraction(24000, 1001), 34046, 1419.97, (track,))
+plan = TrimPlan(((24, 1000), (1200, None)), 34046, 1001 / 24000)
+"""
+
+
+def _records():
+    namespace = {}
+    exec(_SOURCE, namespace)
+    return namespace['source'], namespace['plan']
+
+
+def test_records_pickle_round_trip():
+    for record in _records():
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            restored = pickle.loads(pickle.dumps(record, protocol))
+            assert restored == record
+            assert type(restored) is type(record)
+            assert hash(restored) == hash(record)
+            assert restored.digest == record.digest
+
+
+def test_digest_is_stable_across_processes():
+    digests = [record.digest for record in _records()]
+    script = _SOURCE + "\nprint(source.digest, plan.digest)\n"
+    src = os.path.join(os.path.dirname(__file__), '..', 'src')
+    for seed in ('0', '1', 'random'):
+        # hash() of the str fields changes with the seed; the digest must not
+        env = dict(os.environ, PYTHONHASHSEED=seed,
+                   PYTHONPATH=os.pathsep.join(filter(None, [src, os.environ.get('PYTHONPATH')])))
+        out = subprocess.run([sys.executable, '-c', script], env=env, capture_output=True, text=True, check=True)
+        assert out.stdout.split() == digests
+
+
+def test_digest_follows_contents():
+    source, plan = _records()
+    assert len(source.digest) == 40
+    assert source.replace(framenum=34046).digest == source.digest
+    assert source.replace(framenum=34047).digest != source.digest
+    assert plan.replace(trims=((24, 1000),)).digest != plan.digest
+
+
+def test_replace_returns_a_changed_copy():
+    source, _ = _records()
+    track = source.tracks[0]
+    flac = track.replace(flac='/tmp/other.flac')
+
+    assert flac.flac == '/tmp/other.flac'
+    assert track.flac == '/tmp/0000_2.flac'
+    assert flac.replace(flac=track.flac) == track
+    with pytest.raises(TypeError):
+        track.replace(name='x')
+
+
+def test_with_tracks_updates_every_track():
+    source, _ = _records()
+    source = source.replace(tracks=source.tracks + (source.tracks[0].replace(stream_id=3),))
+    updated = source.with_tracks(lambda track: track.replace(wav=None))
+
+    assert [track.stream_id for track in updated.tracks] == [2, 3]
+    assert all(track.wav is None for track in updated.tracks)
+    assert all(track.wav is not None for track in source.tracks)
+    assert updated.replace(tracks=()) == source.replace(tracks=())
+    assert isinstance(updated.framerate, Fraction)
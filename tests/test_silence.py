@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from bvsfunc.util.AudioProcessor import _trim_times
+from bvsfunc.util.silence import detect_silence, frame_levels, suggest_trims
+from bvsfunc.util.wavio import WavInfo, WavWriter, encode
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+np = pytest.importorskip("numpy")
+
+RATE = 48000
+FPS = 25
+
+
+def _write_wav(path, bits, layout, channels=6):
+    """Writes noise with digital silence over the (start, end) second ranges in layout."""
+    width = bits // 8
+    info = WavInfo(1, channels, RATE, bits, width * channels, 0x3F, 0, 0)
+    seconds = layout[-1][1]
+    samples = np.random.default_rng(1).uniform(-0.25, 0.25, (seconds * RATE, channels))
+    for start, end, silent in layout:
+        if silent:
+            samples[start * RATE:end * RATE] = 0.0
+    with WavWriter(str(path), info) as writer:
+        writer.write(encode(samples, info))
+    return str(path)
+
+
+@pytest.mark.parametrize("bits", [16, 24])
+def test_detect_silence_finds_known_layout(tmp_path, bits):
+    layout = [(0, 4, True), (4, 20, False), (20, 22, True), (22, 50, False), (50, 53, True)]
+    wav = _write_wav(tmp_path / "layout.wav", bits, layout)
+
+    assert detect_silence(wav, FPS) == [(0, 100), (500, 550), (1250, 1325)]
+    # the program starts after the last silence in the head window and ends at the first in the tail window
+    assert suggest_trims(wav, FPS, head_window=30, tail_window=10) == [550, 1250]
+    assert suggest_trims(wav, FPS, head_window=10, tail_window=10) == [100, 1250]
+
+
+def test_frame_levels_match_rms(tmp_path):
+    wav = _write_wav(tmp_path / "noise.wav", 24, [(0, 2, False)])
+    levels = frame_levels(wav, FPS)
+
+    assert len(levels) == 50
+    # uniform noise over +-0.25 has an RMS of 0.25 / sqrt(3); the loudest of 6 channels sits a little above it
+    assert np.allclose(levels, 20 * np.log10(0.25 / np.sqrt(3)), atol=0.3)
+
+
+def test_suggested_trims_cut_delayed_audio_at_the_silences(tmp_path):
+    layout = [(0, 4, True), (4, 50, False), (50, 53, True)]
+    wav = _write_wav(tmp_path / "delayed.wav", 16, layout)
+    # audio delayed by 0.4 s, 10 frames at 25 fps
+    start, end = suggest_trims(wav, FPS, head_window=10, tail_window=10, offset_time=0.4)
+
+    assert [start, end] == [90, 1250]
+    # video_source turns them back into the times the program starts and ends in the wav
+    assert _trim_times((start, end), 1325, 0.4, 1 / FPS) == pytest.approx((4.0, 50.0))
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import subprocess
+import sys
+from fractions import Fraction
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from bvsfunc.util import integrity, vsaudio
+from bvsfunc.util.wavio import WavInfo, decode
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+_AUDIO = SimpleNamespace(bits_per_sample=16, sample_type=0, num_channels=2, sample_rate=48000, channel_layout=3,
+                         num_samples=4800)
+
+
+@pytest.fixture
+def encoders(monkeypatch):
+    """Replaces flac and qaac with processes that copy their input to the -o file, and returns the processes."""
+    procs = []
+
+    class _CopySink(vsaudio._PipeSink):
+        def __init__(self, args, silent):
+            outfile = args[args.index('-o') + 1]
+            self._proc = subprocess.Popen([sys.executable, '-c', 'import shutil, sys; '
+                                           'shutil.copyfileobj(sys.stdin.buffer, open(sys.argv[1], "wb"))', outfile],
+                                          stdin=subprocess.PIPE)
+            procs.append(self._proc)
+
+    monkeypatch.setattr(vsaudio, '_PipeSink', _CopySink)
+    monkeypatch.setattr('shutil.which', lambda name: name)
+    return procs
+
+
+def test_failed_render_stops_encoders_and_removes_partials(tmp_path, encoders, monkeypatch):
+    def blocks(audio, ranges, info, requests):
+        yield b'\x00' * info.block_align * 100
+        raise RuntimeError("frame request failed")
+
+    monkeypatch.setattr(vsaudio, '_audio_blocks', blocks)
+    with pytest.raises(RuntimeError, match="frame request failed"):
+        vsaudio.audio_node_source(_AUDIO, out_file="ep01", out_dir=str(tmp_path), wav=True, silent=False)
+
+    assert len(encoders) == 2 and all(proc.poll() is not None for proc in encoders)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_failed_verification_stops_other_encoders(tmp_path, encoders, monkeypatch):
+    monkeypatch.setattr(vsaudio, '_audio_blocks', lambda audio, ranges, info, requests: iter([b'\x00' * 4 * 4800]))
+    monkeypatch.setattr(integrity, 'flac_streaminfo', lambda path: {'md5': '0' * 32, 'total_samples': 0})
+    with pytest.raises(RuntimeError, match="verification failed"):
+        vsaudio.audio_node_source(_AUDIO, out_file="ep01", out_dir=str(tmp_path), verify=True, silent=False)
+
+    assert all(proc.poll() is not None for proc in encoders)
+    assert list(tmp_path.iterdir()) == []
+
+
+class _Future:
+    def __init__(self, value):
+        self._value = value
+
+    def result(self):
+        return self._value
+
+
+def _clip(num_frames, fps, durations=None):
+    """A clip whose frames only carry their duration properties, for VFR clips."""
+    def get_frame_async(n):
+        num, den = durations[n]
+        return _Future(SimpleNamespace(props={'_DurationNum': num, '_DurationDen': den}))
+    return SimpleNamespace(num_frames=num_frames, fps=fps, get_frame_async=get_frame_async)
+
+
+@pytest.mark.parametrize("fps, trims, expected", [
+    # 1601.6 samples per frame at 29.97 fps: frame edges round to the nearest sample and adjacent trims meet
+    (Fraction(30000, 1001), [[1, 2], [2, 3], [5, 6]], [(1602, 3203), (3203, 4805), (8008, 9610)]),
+    # 2002 samples per frame at 23.976 fps
+    (Fraction(24000, 1001), [[10, 20]], [(20020, 40040)]),
+    # None and negative frames count from the ends of the clip, as in video_source
+    (Fraction(25), [[None, 10], [-10, None]], [(0, 19200), (172800, 192000)]),
+    (Fraction(25), [None, -90], [(0, 19200)]),
+    (Fraction(25), None, [(0, 192000)]),
+])
+def test_frame_sample_ranges_cfr(fps, trims, expected):
+    audio = SimpleNamespace(num_samples=192000, sample_rate=48000)
+    assert vsaudio.frame_sample_ranges(_clip(100, fps), audio, trims) == expected
+
+
+def test_frame_sample_ranges_clamp_to_the_audio():
+    # the video runs on past the end of the audio
+    audio = SimpleNamespace(num_samples=100000, sample_rate=48000)
+    assert vsaudio.frame_sample_ranges(_clip(100, Fraction(25)), audio, [[40, 60], [90, None]]) == \
+        [(76800, 100000), (100000, 100000)]
+
+
+def test_frame_sample_ranges_vfr():
+    durations = [(1, 24)] * 5 + [(1, 30)] * 5
+    audio = SimpleNamespace(num_samples=48000, sample_rate=48000)
+    ranges = vsaudio.frame_sample_ranges(_clip(10, 0, durations), audio, [[3, 7]], requests=2)
+    assert ranges == [(6000, 10000 + 3200)]
+
+
+class _Planes(list):
+    """An audio frame: indexing gives a channel's samples."""
+    def __init__(self, planes, num_samples):
+        super().__init__(planes)
+        self.num_samples = num_samples
+
+
+def _audio(num_samples, channels, bits):
+    """An AudioNode holding sample i of channel c as (i - 5000) * (c + 1)."""
+    import numpy as np
+
+    def get_frame_async(n):
+        first = n * vsaudio.AUDIO_FRAME_SAMPLES
+        count = min(vsaudio.AUDIO_FRAME_SAMPLES, num_samples - first)
+        planes = [(np.arange(first, first + count) - 5000) * (channel + 1) for channel in range(channels)]
+        return _Future(_Planes(planes, count))
+    return SimpleNamespace(num_samples=num_samples, get_frame_async=get_frame_async)
+
+
+@pytest.mark.parametrize("bits", [16, 24])
+def test_audio_blocks_interleave_up_to_the_last_partial_frame(bits):
+    np = pytest.importorskip("numpy")
+    # two whole audio frames and a last one of 100 samples
+    num_samples = 2 * vsaudio.AUDIO_FRAME_SAMPLES + 100
+    info = WavInfo(1, 2, 48000, bits, 2 * bits // 8, 3, 0, 0)
+    ranges = [(10, 20), (3000, num_samples)]
+    raw = b''.join(vsaudio._audio_blocks(_audio(num_samples, 2, bits), ranges, info, requests=2))
+
+    samples = np.round(decode(raw, info) * (1 << (bits - 1))).astype(np.int64)
+    expected = np.concatenate([np.arange(first, last) for first, last in ranges]) - 5000
+    np.testing.assert_array_equal(samples, np.stack([expected, 2 * expected], axis=1))
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from bvsfunc.util.wavio import (WAVE_FORMAT_EXTENSIBLE, WAVE_FORMAT_IEEE_FLOAT, WAVE_FORMAT_PCM, WavInfo, WavWriter,
+                                decode, encode, read_frames, read_wav_info)
+
+__author__ = "begna112"
+__copyright__ = "begna112"
+__license__ = "mit"
+
+np = pytest.importorskip("numpy")
+
+
+def _info(format_tag, channels, bits, channel_mask):
+    width = bits // 8
+    return WavInfo(format_tag, channels, 48000, bits, width * channels, channel_mask, 0, 0)
+
+
+def _samples(frames, channels):
+    # full scale both ways, so clipping and sign extension show
+    samples = np.random.default_rng(1).uniform(-1, 1, (frames, channels))
+    samples[0] = -1.0
+    samples[1] = 1.0 - 1e-9
+    return samples
+
+
+@pytest.mark.parametrize("format_tag, channels, bits, channel_mask", [
+    (WAVE_FORMAT_PCM, 2, 16, 0x3),
+    # 24-bit and more than two channels are written as WAVE_FORMAT_EXTENSIBLE
+    (WAVE_FORMAT_PCM, 2, 24, 0x3),
+    (WAVE_FORMAT_PCM, 6, 24, 0x3F),
+    (WAVE_FORMAT_PCM, 4, 32, 0x33),
+    (WAVE_FORMAT_IEEE_FLOAT, 2, 32, 0x3),
+    (WAVE_FORMAT_IEEE_FLOAT, 8, 32, 0x63F),
+])
+def test_round_trip(tmp_path, format_tag, channels, bits, channel_mask):
+    info = _info(format_tag, channels, bits, channel_mask)
+    samples = _samples(1001, channels)
+    path = str(tmp_path / "round_trip.wav")
+    with WavWriter(path, info) as writer:
+        raw = encode(samples, info)
+        # in uneven pieces, as the trims write them
+        writer.write(raw[:info.block_align * 7])
+        writer.write(raw[info.block_align * 7:])
+
+    read = read_wav_info(path)
+    assert (read.format_tag, read.channels, read.sample_rate, read.bits_per_sample, read.channel_mask) == \
+        (format_tag, channels, 48000, bits, channel_mask)
+    assert read.frames == 1001
+    # the fmt chunk follows the RIFF header and the JUNK chunk reserved for ds64
+    header = open(path, 'rb').read(read.data_offset)
+    assert header[48:52] == b'fmt '
+    assert (int.from_bytes(header[56:58], 'little') == WAVE_FORMAT_EXTENSIBLE) == (channels > 2 or bits > 16)
+
+    decoded = np.concatenate([decode(block, read) for block in read_frames(path, block_frames=100, info=read)])
+    tolerance = 0 if format_tag == WAVE_FORMAT_IEEE_FLOAT else 1 / (1 << (bits - 1))
+    np.testing.assert_allclose(decoded, samples, atol=max(tolerance, 1e-7))
+    assert decoded.min() == -1.0
+    # a range reads the same frames as the whole file
+    np.testing.assert_array_equal(np.concatenate([decode(block, read) for block in read_frames(path, 100, 300)]),
+                                  decoded[100:300])
+
+
+def test_odd_data_size_is_padded(tmp_path):
+    info = _info(WAVE_FORMAT_PCM, 1, 24, 0x4)
+    path = str(tmp_path / "odd.wav")
+    with WavWriter(path, info) as writer:
+        writer.write(encode(_samples(3, 1), info))
+
+    read = read_wav_info(path)
+    assert read.data_size == 9
+    assert len(open(path, 'rb').read()) == read.data_offset + 10
+
+
+@pytest.mark.parametrize("declared", ["written", "zero"])
+def test_truncated_data_chunk(tmp_path, declared):
+    info = _info(WAVE_FORMAT_PCM, 2, 24, 0x3)
+    samples = _samples(1000, 2)
+    path = tmp_path / "truncated.wav"
+    with WavWriter(str(path), info) as writer:
+        writer.write(encode(samples, info))
+    raw = bytearray(path.read_bytes())
+    data_offset = read_wav_info(str(path)).data_offset
+    if declared == "zero":
+        # as written by a tool streaming to a pipe, before it could go back and fill in the size
+        raw[data_offset - 4:data_offset] = bytes(4)
+    # cut the file short in the middle of frame 500
+    path.write_bytes(raw[:data_offset + 500 * info.block_align + 4])
+
+    read = read_wav_info(str(path))
+    assert read.frames == 500
+    decoded = np.concatenate([decode(block, read) for block in read_frames(str(path), info=read)])
+    np.testing.assert_allclose(decoded, samples[:500], atol=1 / (1 << 23))
+
+
+def test_not_a_wav(tmp_path):
+    path = tmp_path / "not.wav"
+    path.write_bytes(b'RIFF\x00\x00\x00\x00AVI LIST')
+    with pytest.raises(ValueError):
+        read_wav_info(str(path))